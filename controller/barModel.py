@@ -0,0 +1,98 @@
+import sys
+
+#Typed records for the recipes, pumps and bottles Main works with.
+#Volumes and amounts are numbers (parsed once when loaded, not on every pour) and names are interned, so every recipe, bottle
+#and lookup that uses an ingredient shares one string. A pump and the bottle on it point at each other, so either is found from the other in O(1).
+
+#Gets a volume (mL) the way pumpConfig.json and the app have always had it: a string, without a trailing .0 for whole numbers
+def format_volume(volume):
+    volume = round(float(volume), 3)
+    if(volume.is_integer()):
+        return str(int(volume))
+    return str(volume)
+
+
+#A cocktail recipe: the amount (in shots) of each ingredient
+class Recipe():
+    __slots__ = ('name', 'ingredients', 'amounts')
+
+    def __init__(self, name, ingredients, amounts):
+        if(len(ingredients) != len(amounts)):
+            raise ValueError('Ingredients and amounts don\'t match for ' + str(name))
+        self.name = sys.intern(str(name))
+        self.ingredients = tuple(sys.intern(i) for i in ingredients)
+        self.amounts = tuple(float(a) for a in amounts)
+
+    #Gets (ingredient, amount) pairs
+    def items(self):
+        return zip(self.ingredients, self.amounts)
+
+    #Gets the recipe as {ingredient: amount}
+    def to_dict(self):
+        return dict(zip(self.ingredients, self.amounts))
+
+
+#A pump: its relay pin, type (regular or soda), the seconds it takes to pour a shot and the bottle on it (None if it has none)
+class Pump():
+    __slots__ = ('num', 'gpio', 'type', 'pump_time', 'bottle')
+
+    def __init__(self, num, gpio, type, pump_time):
+        self.num = num
+        self.gpio = gpio
+        self.type = type
+        self.pump_time = float(pump_time)
+        self.bottle = None
+
+    #Gets the pump as a pumpConfig.json entry
+    def to_dict(self):
+        return {
+            "pumpNum": self.num,
+            "gpio": self.gpio,
+            "type": self.type,
+            "pumpTime": self.pump_time,
+            "currentBottle": self.bottle.to_dict() if self.bottle is not None else {}
+        }
+
+
+#A bottle on a pump, with its current and full volume in mL
+class Bottle():
+    __slots__ = ('name', 'volume', 'original_volume', 'pump')
+
+    def __init__(self, name, volume, original_volume):
+        self.name = sys.intern(str(name))
+        self.volume = float(volume)
+        self.original_volume = float(original_volume)
+        self.pump = None
+
+    #Gets how full the bottle is as a percentage (0 for a bottle with no full volume)
+    def get_percent(self):
+        if(self.original_volume <= 0):
+            return 0.0
+        return self.volume / self.original_volume * 100
+
+    #Gets the bottle as the currentBottle of a pumpConfig.json entry
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "volume": format_volume(self.volume),
+            "originalVolume": format_volume(self.original_volume)
+        }
+
+#Puts a bottle on a pump, taking it off the pump it was on and taking any other bottle off this pump; gets the bottle it replaced (or None)
+def attach_bottle(bottle, pump):
+    replaced = pump.bottle
+    if(replaced is bottle):
+        return None
+    if(replaced is not None):
+        replaced.pump = None
+    if(bottle.pump is not None):
+        bottle.pump.bottle = None
+    bottle.pump = pump
+    pump.bottle = bottle
+    return replaced
+
+#Takes a bottle off its pump
+def detach_bottle(bottle):
+    if(bottle.pump is not None):
+        bottle.pump.bottle = None
+    bottle.pump = None
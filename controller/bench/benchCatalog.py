@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+import logging
+import shutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchStubs
+benchStubs.install() #Must happen before main is imported
+from syntheticCatalog import CatalogProfile, generate_catalog, to_dynamo_items
+
+import main as main_module
+from barModel import Bottle, attach_bottle
+
+#Micro-benchmarks for the catalog and inventory operations of Main, run against synthetic catalogs.
+#Usage (from controller/): python bench/benchCatalog.py [--sizes 1000 10000 100000] [--repeats 5]
+#Results are saved to bench/results/<version>.json and compared against the previous run of a different version.
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+#Runs a function repeatedly and gets the time of each run in seconds
+def measure(function, repeats):
+    times = []
+    for i in range(0, repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+#Summarizes run times; per_call divides by the number of calls made in each run
+def summarize(times, calls=1):
+    return {
+        "median": statistics.median(times) / calls,
+        "min": min(times) / calls,
+        "mean": statistics.mean(times) / calls,
+        "runs": len(times),
+        "calls": calls
+    }
+
+#Builds a Main in a temporary directory with the catalog loaded and the most common ingredients on the pumps
+def make_main(catalog, profile):
+    workdir = benchStubs.make_workdir(catalog)
+    os.chdir(workdir)
+
+    #The in-memory recipe table is what update_local_recipes scans
+    table = sys.modules['boto3'].dynamo.Table('BarBot-Recipe')
+    table.items = {}
+    for item in to_dynamo_items(catalog):
+        table.put_item(Item=item)
+
+    bar = main_module.Main()
+
+    #Put the most common real ingredients on the pumps so a realistic share of the catalog is makeable
+    bar.bottles = {}
+    bottles = profile.most_common(len(bar.pumps))
+    pumps = sorted(bar.pumps.keys())
+    for i in range(0, len(bottles)):
+        bottle = Bottle(bottles[i], 1000, 1000)
+        attach_bottle(bottle, bar.pumps[pumps[i]])
+        bar.bottles[bottle.name] = bottle
+    bar.load_cocktails()
+    return bar
+
+#Runs every benchmark against one catalog size
+def bench_size(size, repeats, profile):
+    catalog = generate_catalog(size, profile)
+    bar = make_main(catalog, profile)
+    names = list(bar.recipes.keys())
+    available = bar.get_cocktail_list()
+
+    def is_available_all():
+        for name in names:
+            bar.is_available(name)
+
+    def can_make_all():
+        for name in available:
+            bar.can_make_cocktail(name)
+
+    results = {
+        "available": len(available),
+        "load_cocktails": summarize(measure(bar.load_cocktails, repeats)),
+        "is_available": summarize(measure(is_available_all, repeats), len(names)),
+        "get_cocktail_list": summarize(measure(bar.get_cocktail_list, repeats)),
+        "can_make_cocktail": summarize(measure(can_make_all, repeats), max(1, len(available))),
+        "update_local_recipes": summarize(measure(bar.update_local_recipes, repeats)),
+        "write_pump_data": summarize(measure(bar.write_pump_data, repeats))
+    }
+
+    bar.pump_workers.stop()
+    workdir = os.getcwd()
+    os.chdir(benchStubs.CONTROLLER_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+#Gets a label for the code being benchmarked (git commit, marked dirty if there are local changes)
+def get_version():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchStubs.CONTROLLER_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--', '.'], cwd=benchStubs.CONTROLLER_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        return commit + ('-dirty' if dirty != '' else '')
+    except Exception:
+        return 'unknown'
+
+#Loads the most recent saved results of a different version (None if there are none)
+def load_previous(version):
+    if(not os.path.exists(RESULTS_DIR)):
+        return None
+
+    previous = None
+    for name in os.listdir(RESULTS_DIR):
+        if(not name.endswith('.json')):
+            continue
+        with open(os.path.join(RESULTS_DIR, name), 'r') as file:
+            data = json.load(file)
+        if(data.get('version') == version):
+            continue
+        if(previous is None or data['timestamp'] > previous['timestamp']):
+            previous = data
+    return previous
+
+#Compares two result sets and gets every operation that got slower than the threshold (as a fraction)
+def find_regressions(current, previous, threshold):
+    regressions = []
+    for size in current['results']:
+        if(size not in previous['results']):
+            continue
+        for op, stats in current['results'][size].items():
+            old = previous['results'][size].get(op)
+            if(not isinstance(stats, dict) or not isinstance(old, dict)):
+                continue
+            change = (stats['median'] - old['median']) / old['median'] if old['median'] > 0 else 0.0
+            if(change > threshold):
+                regressions.append({"size": size, "operation": op, "old": old['median'], "new": stats['median'], "change": change})
+    return regressions
+
+#Prints a results table
+def print_results(data, previous=None):
+    print('BarBot catalog benchmark  version=' + data['version'] + '  python=' + data['python'])
+    for size, ops in data['results'].items():
+        print('\n' + size + ' recipes (' + str(ops['available']) + ' available)')
+        for op, stats in ops.items():
+            if(not isinstance(stats, dict)):
+                continue
+            line = '  %-22s median %12.3f us  min %12.3f us' % (op, stats['median'] * 1e6, stats['min'] * 1e6)
+            if(previous is not None and size in previous['results'] and op in previous['results'][size]):
+                old = previous['results'][size][op]['median']
+                if(old > 0):
+                    line += '  (%+.1f%% vs %s)' % ((stats['median'] - old) / old * 100, previous['version'])
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark catalog and inventory operations against synthetic catalogs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--version', default=None, help='Label for these results (defaults to the git commit)')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Slowdown (as a fraction) reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    profile = CatalogProfile()
+    start_dir = os.getcwd()
+
+    data = {
+        "version": args.version if args.version is not None else get_version(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeats": args.repeats,
+        "results": {}
+    }
+    for size in args.sizes:
+        data['results'][str(size)] = bench_size(size, args.repeats, profile)
+    os.chdir(start_dir)
+
+    previous = load_previous(data['version'])
+    print_results(data, previous)
+
+    if(not args.no_save):
+        if(not os.path.exists(RESULTS_DIR)):
+            os.makedirs(RESULTS_DIR)
+        with open(os.path.join(RESULTS_DIR, data['version'] + '.json'), 'w') as file:
+            json.dump(data, file, indent=2)
+
+    if(previous is not None):
+        regressions = find_regressions(data, previous, args.threshold)
+        for regression in regressions:
+            print('REGRESSION: %s @ %s recipes: %.3f us -> %.3f us (%+.1f%%)' % (regression['operation'], regression['size'], regression['old'] * 1e6, regression['new'] * 1e6, regression['change'] * 100))
+        if(len(regressions) > 0 and args.fail_on_regression):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchStubs
+from benchCatalog import make_main, measure, summarize
+from syntheticCatalog import CatalogProfile, generate_catalog
+
+import cloud
+import recipe
+
+#Compares full recipe refreshes: the sequential page-by-page scan into a dict of json strings (the way update_local_recipes used to
+#work) against the streaming parallel segmented scan, with the in-memory table answering each scan call after a simulated round trip.
+#Usage (from controller/): python bench/benchScan.py [--sizes 1000 10000] [--segments 1 2 4 8] [--page-size 500] [--page-latency 0.02]
+
+#Scans every page of the recipe table in turn into {name: json string} (the scan update_local_recipes used to do)
+def get_all_recipes():
+    table = cloud.get_table(recipe.TABLE_NAME)
+    new_cocktails = {}
+    response = table.scan()
+    for i in response['Items']:
+        new_cocktails[i['cocktailName']] = json.dumps(i, cls=recipe.DecimalEncoder)
+
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+        for i in response['Items']:
+            new_cocktails[i['cocktailName']] = json.dumps(i, cls=recipe.DecimalEncoder)
+    return new_cocktails
+
+#Refreshes cocktails.json the old way: scan every page in turn, then convert and write the whole catalog at once
+def sequential_refresh(bar):
+    new_recipe_raw = get_all_recipes()
+    new_cocktail_JSON = {'cocktails': []}
+    for rec in new_recipe_raw:
+        amount_item = json.loads(new_recipe_raw[rec])['amounts']
+        new_cocktail_JSON['cocktails'].append({
+            "name": rec,
+            "ingredients": list(amount_item.keys()),
+            "amounts": list(amount_item.values())
+        })
+    with open('cocktails.json', 'w') as file:
+        json.dump(new_cocktail_JSON, file)
+    bar.load_cocktails()
+
+#Runs both refreshes against one catalog size
+def bench_size(size, segment_counts, page_size, page_latency, repeats):
+    profile = CatalogProfile()
+    bar = make_main(generate_catalog(size, profile), profile)
+    table = cloud.get_table(recipe.TABLE_NAME)
+    table.page_size = page_size
+    table.page_latency = page_latency
+
+    results = {"sequential": summarize(measure(lambda: sequential_refresh(bar), repeats))}
+    for segments in segment_counts:
+        cloud.settings['scanSegments'] = segments
+        results['parallel' + str(segments)] = summarize(measure(bar.update_local_recipes, repeats))
+        if(len(bar.recipes) != size):
+            logging.error('Parallel scan with %d segments loaded %d of %d recipes', segments, len(bar.recipes), size)
+
+    table.page_latency = 0.0
+    bar.pump_workers.stop()
+    workdir = os.getcwd()
+    os.chdir(benchStubs.CONTROLLER_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sequential against parallel segmented recipe scans')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--page-size', type=int, default=500, help='Items per scan page')
+    parser.add_argument('--page-latency', type=float, default=0.02, help='Simulated seconds per scan call')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Write the results as json to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output = os.path.abspath(args.output) if args.output is not None else None
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = bench_size(size, args.segments, args.page_size, args.page_latency, args.repeats)
+
+        sequential = results[str(size)]['sequential']['median']
+        print('\n%d recipes (%d per page, %.0f ms per page)' % (size, args.page_size, args.page_latency * 1000))
+        print('  %-14s %12s %9s' % ('path', 'median ms', 'speedup'))
+        for name, stats in results[str(size)].items():
+            print('  %-14s %12.1f %8.1fx' % (name, stats['median'] * 1000, sequential / stats['median']))
+
+    if(output is not None):
+        with open(output, 'w') as file:
+            json.dump({"pageSize": args.page_size, "pageLatency": args.page_latency, "results": results}, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import sys
+import types
+import json
+import os
+import shutil
+import random
+import time
+import zlib
+import tempfile
+
+#Stand-ins for the hardware and cloud modules so the controller can be benchmarked on a plain Linux machine.
+#Only used by the benchmarks; BarBot itself always runs against the real modules.
+
+CONTROLLER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Fake RPi.GPIO that just remembers pin levels
+class FakeGPIO(types.ModuleType):
+    BCM = 'BCM'
+    BOARD = 'BOARD'
+    OUT = 'OUT'
+    IN = 'IN'
+    HIGH = 1
+    LOW = 0
+    PUD_DOWN = 'PUD_DOWN'
+    PUD_UP = 'PUD_UP'
+    RISING = 'RISING'
+    FALLING = 'FALLING'
+    BOTH = 'BOTH'
+
+    def __init__(self):
+        super().__init__('RPi.GPIO')
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        self.levels.setdefault(pin, self.HIGH)
+
+    def output(self, pin, value):
+        self.levels[pin] = value
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        pass
+
+
+#In-memory DynamoDB table with the calls recipe.py uses (scan pages like the real table)
+class FakeTable():
+
+    def __init__(self, name, key='cocktailName', page_size=1000):
+        self.name = name
+        self.key = key
+        self.page_size = page_size
+        self.page_latency = 0.0 #Seconds each scan call takes (simulates the round trip to DynamoDB)
+        self.items = {}
+
+    def put_item(self, Item, **kwargs):
+        self.items[Item[self.key]] = Item
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(Key[self.key])
+        if(item is None):
+            return {}
+        return {'Item': item}
+
+    def scan(self, ExclusiveStartKey=None, Segment=None, TotalSegments=None, **kwargs):
+        if(self.page_latency > 0):
+            time.sleep(self.page_latency)
+        keys = sorted(self.items.keys())
+        if(TotalSegments is not None):
+            keys = [k for k in keys if zlib.crc32(k.encode()) % TotalSegments == Segment]
+        start = 0
+        if(ExclusiveStartKey is not None):
+            start = keys.index(ExclusiveStartKey[self.key]) + 1
+        page = keys[start:start + self.page_size]
+
+        response = {'Items': [self.items[k] for k in page], 'Count': len(page)}
+        if(start + self.page_size < len(keys)):
+            response['LastEvaluatedKey'] = {self.key: page[-1]}
+        return response
+
+
+#In-memory DynamoDB resource/client
+class FakeDynamo():
+
+    def __init__(self):
+        self.tables = {}
+        self.unprocessed_rate = 0.0
+        self.meta = types.SimpleNamespace(client=self, endpoint_url='https://dynamodb.us-east-1.amazonaws.com')
+
+    def Table(self, name):
+        if(name not in self.tables):
+            self.tables[name] = FakeTable(name)
+        return self.tables[name]
+
+    #Writes every put request (unprocessed_rate of them are left unprocessed, like a throttled table)
+    def batch_write_item(self, RequestItems, **kwargs):
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            if(len(requests) > 25):
+                raise ValueError('Too many items in batch')
+            for request in requests:
+                if(random.random() < self.unprocessed_rate):
+                    unprocessed.setdefault(name, []).append(request)
+                else:
+                    self.Table(name).put_item(Item=request['PutRequest']['Item'])
+        return {'UnprocessedItems': unprocessed}
+
+    def update_item(self, TableName, Key, **kwargs):
+        return {}
+
+    def put_item(self, TableName, Item, **kwargs):
+        return {}
+
+
+#Fake boto3 module handing out a single shared in-memory DynamoDB
+class FakeBoto3(types.ModuleType):
+
+    def __init__(self):
+        super().__init__('boto3')
+        self.dynamo = FakeDynamo()
+
+    def resource(self, name, **kwargs):
+        return self.dynamo
+
+    def client(self, name, **kwargs):
+        return self.dynamo
+
+
+#Fake AWS IoT MQTT and shadow clients that accept every call
+class FakeIoTClient():
+
+    def __init__(self, *args, **kwargs):
+        self.published = []
+        self.calls = {} #Method name -> times called
+
+    def __getattr__(self, name):
+        if(name.startswith('__')):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return True
+        return call
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, payload))
+        return True
+
+    def createShadowHandlerWithName(self, name, persistent):
+        return FakeIoTClient()
+
+
+#Installs the fake modules (only hardware and cloud modules; everything else is the real thing)
+def install():
+    gpio = FakeGPIO()
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = gpio
+
+    sys.modules['boto3'] = FakeBoto3()
+
+    iot_sdk = types.ModuleType('AWSIoTPythonSDK')
+    mqtt_lib = types.ModuleType('AWSIoTPythonSDK.MQTTLib')
+    mqtt_lib.AWSIoTMQTTClient = FakeIoTClient
+    mqtt_lib.AWSIoTMQTTShadowClient = FakeIoTClient
+    mqtt_lib.DROP_OLDEST = 0
+    mqtt_lib.DROP_NEWEST = 1
+    iot_sdk.MQTTLib = mqtt_lib
+    sys.modules['AWSIoTPythonSDK'] = iot_sdk
+    sys.modules['AWSIoTPythonSDK.MQTTLib'] = mqtt_lib
+
+    #tkinter isn't used by the controller at runtime but main.py imports it
+    try:
+        import tkinter
+    except ImportError:
+        sys.modules['tkinter'] = types.ModuleType('tkinter')
+
+    if(CONTROLLER_DIR not in sys.path):
+        sys.path.insert(0, CONTROLLER_DIR)
+    return gpio
+
+
+#Creates a temporary working directory with copies of the controller config files (so benchmarks never touch the real ones)
+#source_dir can point at a copy of a production controller's config files to start from its exact state
+def make_workdir(cocktails=None, settings_overrides=None, source_dir=CONTROLLER_DIR):
+    workdir = tempfile.mkdtemp(prefix='barbot-bench-')
+    for name in ('pumpConfig.json', 'bottles.json', 'alcohol.json', 'ignoreList.json'):
+        shutil.copy(os.path.join(source_dir, name), workdir)
+
+    #Keep the pumps in-process and tracing/recording off so the benchmark measures the controller itself
+    with open(os.path.join(source_dir, 'settings.json'), 'r') as file:
+        settings = json.load(file)
+    settings['pourProcess'] = {"enabled": False}
+    settings['tracing'] = {"enabled": False}
+    settings['recording'] = {"enabled": False}
+    if(settings_overrides is not None):
+        settings.update(settings_overrides)
+    with open(os.path.join(workdir, 'settings.json'), 'w') as file:
+        json.dump(settings, file)
+
+    if(cocktails is None):
+        shutil.copy(os.path.join(source_dir, 'cocktails.json'), workdir)
+    else:
+        with open(os.path.join(workdir, 'cocktails.json'), 'w') as file:
+            json.dump(cocktails, file)
+    return workdir
+
+#Puts bottles on the pumps of a work directory's pumpConfig.json (None keeps the current ones) and scales every pump time (so simulated pours can be shortened)
+def stock_pumps(workdir, bottles=None, volume='1000', time_scale=1.0):
+    path = os.path.join(workdir, 'pumpConfig.json')
+    with open(path, 'r') as file:
+        pumps = json.load(file)
+
+    for pump in pumps:
+        pump['pumpTime'] = pump['pumpTime'] * time_scale
+
+    if(bottles is not None):
+        regular = [pump for pump in pumps if pump['type'] == 'regular']
+        for pump in pumps:
+            pump['currentBottle'] = {}
+        for i in range(0, min(len(bottles), len(regular))):
+            regular[i]['currentBottle'] = {
+                "name": bottles[i],
+                "volume": str(volume),
+                "originalVolume": str(volume)
+            }
+
+    with open(path, 'w') as file:
+        json.dump(pumps, file)
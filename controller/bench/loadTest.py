@@ -0,0 +1,379 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.parse
+import urllib.error
+import logging
+
+logger = logging.getLogger('loadTest')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchStubs
+from syntheticCatalog import CatalogProfile, generate_catalog, to_dynamo_items
+
+#REST load generator that replays tablet traffic (display/src/api/Control.js) against the controller.
+#By default it starts network.py's app in-process with simulated GPIO and in-memory DynamoDB; --url targets a running BarBot instead.
+#Usage (from controller/): python bench/loadTest.py [--tablets 8] [--phase-time 10] [--output results.json]
+#
+#Phases: idle (polling only), orders (polling plus random orders and order bursts), pour (while a cocktail pours)
+#and removeAllBottles (while every bottle is removed; run last because it empties the pumps).
+
+#Default seconds between requests of one tablet (the menu interval matches HomePage.js)
+HEARTBEAT_INTERVAL = 5.0
+MENU_INTERVAL = 10.0
+VOLUME_INTERVAL = 15.0
+ORDER_INTERVAL = 30.0
+
+#Collects the latency of every request by phase and route
+class Recorder():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = 'idle'
+        self.samples = {} #Phase -> route -> list of (latency, ok)
+        self.phase_times = {} #Phase -> [start, end]
+        self.orders_in_flight = 0
+        self.orders_done = threading.Condition(self.lock)
+
+    #Switches the phase new requests are counted against
+    def set_phase(self, phase):
+        now = time.monotonic()
+        with self.lock:
+            if(self.phase in self.phase_times):
+                self.phase_times[self.phase][1] = now
+            self.phase = phase
+            self.phase_times[phase] = [now, None]
+
+    #Counts an order request starting (1) or finishing (-1)
+    def track_order(self, change):
+        with self.lock:
+            self.orders_in_flight += change
+            if(self.orders_in_flight == 0):
+                self.orders_done.notify_all()
+
+    #Waits until no order requests are outstanding (so the controller is idle again)
+    def wait_for_orders(self, timeout=None):
+        with self.lock:
+            return self.orders_done.wait_for(lambda: self.orders_in_flight == 0, timeout)
+
+    #Ends the current phase
+    def finish(self):
+        with self.lock:
+            if(self.phase in self.phase_times):
+                self.phase_times[self.phase][1] = time.monotonic()
+
+    def record(self, phase, route, latency, ok):
+        with self.lock:
+            self.samples.setdefault(phase, {}).setdefault(route, []).append((latency, ok))
+
+    #Gets throughput and latency percentiles per phase and route
+    def report(self):
+        report = {}
+        with self.lock:
+            for phase, routes in self.samples.items():
+                start, end = self.phase_times.get(phase, [0.0, 0.0])
+                duration = max(0.001, (end if end is not None else time.monotonic()) - start)
+                phase_report = {"duration": duration, "requests": 0, "throughput": 0.0, "routes": {}}
+
+                for route, samples in routes.items():
+                    latencies = sorted(latency for latency, ok in samples)
+                    errors = len([ok for latency, ok in samples if not ok])
+                    phase_report['routes'][route] = {
+                        "count": len(samples),
+                        "errors": errors,
+                        "throughput": len(samples) / duration,
+                        "p50": percentile(latencies, 50),
+                        "p95": percentile(latencies, 95),
+                        "p99": percentile(latencies, 99),
+                        "max": latencies[-1]
+                    }
+                    phase_report['requests'] += len(samples)
+
+                phase_report['throughput'] = phase_report['requests'] / duration
+                report[phase] = phase_report
+        return report
+
+
+#Gets a percentile (nearest rank) of sorted values
+def percentile(values, pct):
+    if(len(values) == 0):
+        return None
+    index = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+#Sends requests like Control.js does and records them against the route template
+class Client():
+
+    def __init__(self, base_url, recorder, timeout=120):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.recorder = recorder
+        self.timeout = timeout
+
+    #Sends a request; gets the response body (None on error)
+    def request(self, path, route, body=None, method=None):
+        phase = self.recorder.phase
+        data = None
+        headers = {}
+        if(body is not None):
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if(method is None):
+            method = 'POST' if body is not None else 'GET'
+        req = urllib.request.Request(self.base_url + path.lstrip('/'), data=data, headers=headers, method=method)
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                text = response.read().decode()
+            ok = True
+        except (urllib.error.URLError, OSError) as e:
+            text = None
+            ok = False
+        self.recorder.record(phase, route, time.perf_counter() - start, ok)
+        return text
+
+    def heartbeat(self):
+        return self.request('heartbeat/', '/heartbeat/')
+
+    def get_menu(self):
+        text = self.request('cocktailList/', '/cocktailList/')
+        try:
+            return json.loads(text) if text is not None else []
+        except ValueError:
+            return []
+
+    def get_all_bottles(self):
+        text = self.request('getAllBottles/', '/getAllBottles/')
+        try:
+            return json.loads(text) if text is not None else []
+        except ValueError:
+            return []
+
+    def get_bottle_name(self, num):
+        return self.request('bottleName/' + str(num) + '/', '/bottleName/<num>/')
+
+    def get_volume(self, bottle):
+        return self.request('volume/' + quote(bottle) + '/', '/volume/<bottle>/')
+
+    def get_init_volume(self, bottle):
+        return self.request('initVolume/' + quote(bottle) + '/', '/initVolume/<bottle>/')
+
+    def get_bottle_percent(self, bottle):
+        return self.request('bottlePercent/' + quote(bottle) + '/', '/bottlePercent/<bottle>/')
+
+    def get_ingredients(self, cocktail):
+        return self.request('ingredients/' + quote(cocktail.lower()) + '/', '/ingredients/<cocktail>/')
+
+    def make_cocktail(self, cocktail):
+        self.recorder.track_order(1)
+        try:
+            return self.request('cocktail/' + quote(cocktail.lower()) + '/', '/cocktail/<name>/')
+        finally:
+            self.recorder.track_order(-1)
+
+    def remove_all_bottles(self):
+        return self.request('removeAllBottles/', '/removeAllBottles/')
+
+
+def quote(text):
+    return urllib.parse.quote(text, safe='')
+
+
+#One tablet: polls the heartbeat, menu and bottle volumes, and orders now and then when orders are allowed
+class Tablet(threading.Thread):
+
+    def __init__(self, client, stop_event, orders_event, speed, seed, bottles):
+        super().__init__(daemon=True)
+        self.client = client
+        self.stop_event = stop_event
+        self.orders_event = orders_event
+        self.speed = speed
+        self.rand = random.Random(seed)
+        self.bottles = bottles
+        self.menu = []
+
+    #Gets a randomized delay so tablets don't poll in lockstep
+    def next_time(self, interval):
+        return time.monotonic() + self.rand.uniform(0.5, 1.5) * interval / self.speed
+
+    def run(self):
+        now = time.monotonic()
+        next_heartbeat = now + self.rand.uniform(0, HEARTBEAT_INTERVAL / self.speed)
+        next_menu = now
+        next_volumes = now + self.rand.uniform(0, VOLUME_INTERVAL / self.speed)
+        next_order = self.next_time(ORDER_INTERVAL)
+
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if(now >= next_heartbeat):
+                self.client.heartbeat()
+                next_heartbeat = self.next_time(HEARTBEAT_INTERVAL)
+            if(now >= next_menu):
+                self.menu = self.client.get_menu()
+                next_menu = self.next_time(MENU_INTERVAL)
+            if(now >= next_volumes):
+                for bottle in list(self.bottles):
+                    self.client.get_volume(bottle)
+                    self.client.get_bottle_percent(bottle)
+                next_volumes = self.next_time(VOLUME_INTERVAL)
+            if(now >= next_order):
+                if(self.orders_event.is_set()):
+                    self.order()
+                next_order = self.next_time(ORDER_INTERVAL)
+
+            wait = min(next_heartbeat, next_menu, next_volumes, next_order) - time.monotonic()
+            self.stop_event.wait(max(0.0, min(wait, 0.5)))
+
+    #Looks at a cocktail's ingredients and orders it (like tapping a menu item)
+    def order(self):
+        if(len(self.menu) == 0):
+            return
+        cocktail = self.rand.choice(self.menu)
+        self.client.get_ingredients(cocktail)
+        self.client.make_cocktail(cocktail)
+
+
+#Starts network.py's app in-process against simulated GPIO and an in-memory recipe table; gets the base url and server
+#bottles (if given) replace whatever is on the pumps; config_dir starts from another controller's config files instead of this one's
+def start_simulated_controller(catalog_size, pour_scale, clean_time, bottles=None, config_dir=None):
+    gpio = benchStubs.install()
+    source_dir = config_dir if config_dir is not None else benchStubs.CONTROLLER_DIR
+
+    if(catalog_size > 0):
+        catalog = generate_catalog(catalog_size, CatalogProfile())
+    else:
+        with open(os.path.join(source_dir, 'cocktails.json'), 'r') as file:
+            catalog = json.load(file)
+
+    #The recipe table is what update_local_recipes scans at startup
+    table = sys.modules['boto3'].resource('dynamodb').Table('BarBot-Recipe')
+    for item in to_dynamo_items(catalog):
+        table.put_item(Item=item)
+
+    workdir = benchStubs.make_workdir(catalog, {"logging": {"level": "WARNING", "structured": False}}, source_dir)
+    benchStubs.stock_pumps(workdir, bottles, time_scale=pour_scale)
+    os.chdir(workdir)
+
+    import network
+    from werkzeug.serving import make_server
+
+    network.main.clean_time = clean_time
+    server = make_server('127.0.0.1', 0, network.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    return 'http://127.0.0.1:' + str(server.server_port) + '/', server
+
+#Runs polling tablets while a phase lasts; phase_action (if any) runs on this thread and the phase lasts at least min_time
+def run_phase(name, recorder, min_time, phase_action=None):
+    logger.warning('Phase: %s', name)
+    recorder.set_phase(name)
+    start = time.monotonic()
+    result = None
+    if(phase_action is not None):
+        result = phase_action()
+    remaining = min_time - (time.monotonic() - start)
+    if(remaining > 0):
+        time.sleep(remaining)
+    return result
+
+#Fires a burst of simultaneous orders (like a crowd at the bar) and waits for them
+def order_burst(client, menu, size, rand):
+    threads = []
+    for i in range(0, size):
+        if(len(menu) == 0):
+            break
+        thread = threading.Thread(target=client.make_cocktail, args=[rand.choice(menu)], daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+#Prints the report as a table
+def print_report(report):
+    for phase, data in report.items():
+        print('\n%s: %d requests in %.1f s (%.1f req/s)' % (phase, data['requests'], data['duration'], data['throughput']))
+        print('  %-26s %7s %7s %9s %9s %9s %9s' % ('route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for route, stats in sorted(data['routes'].items()):
+            print('  %-26s %7d %7d %9.2f %9.2f %9.2f %9.2f' % (route, stats['count'], stats['errors'], stats['throughput'], stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay tablet traffic against the BarBot REST API')
+    parser.add_argument('--url', default=None, help='Target a running BarBot (e.g. http://barbot.local:5000/) instead of a simulated one')
+    parser.add_argument('--tablets', type=int, default=8)
+    parser.add_argument('--speed', type=float, default=1.0, help='Multiplier for how often each tablet polls')
+    parser.add_argument('--phase-time', type=float, default=10.0, help='Minimum seconds of each phase')
+    parser.add_argument('--burst', type=int, default=10, help='Simultaneous orders in each order burst')
+    parser.add_argument('--catalog-size', type=int, default=0, help='Synthetic recipes for the simulated controller (0 uses cocktails.json)')
+    parser.add_argument('--pour-scale', type=float, default=0.1, help='Scales simulated pump times (1.0 pours in real time)')
+    parser.add_argument('--clean-time', type=float, default=2.0, help='Simulated seconds each removeAllBottles flush runs')
+    parser.add_argument('--skip-remove', action='store_true', help='Skip the removeAllBottles phase')
+    parser.add_argument('--output', default=None, help='Write the report as json to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output = os.path.abspath(args.output) if args.output is not None else None
+    rand = random.Random(args.seed)
+
+    server = None
+    if(args.url is not None):
+        base_url = args.url
+    else:
+        bottles = CatalogProfile().most_common(8)
+        base_url, server = start_simulated_controller(args.catalog_size, args.pour_scale, args.clean_time, bottles)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    recorder = Recorder()
+    client = Client(base_url, recorder)
+    bottles = client.get_all_bottles()
+    on_pumps = [b for b in bottles if client.get_volume(b) not in (None, 'N/A')]
+    menu = client.get_menu()
+
+    stop_event = threading.Event()
+    orders_event = threading.Event()
+    tablets = []
+    for i in range(0, args.tablets):
+        tablet = Tablet(Client(base_url, recorder), stop_event, orders_event, args.speed, args.seed + i, on_pumps)
+        tablet.start()
+        tablets.append(tablet)
+
+    run_phase('idle', recorder, args.phase_time)
+
+    orders_event.set()
+    run_phase('orders', recorder, args.phase_time, lambda: order_burst(client, menu, args.burst, rand))
+    orders_event.clear()
+    recorder.set_phase('drain')
+    recorder.wait_for_orders() #The pour and remove phases need an idle controller
+
+    if(len(menu) > 0):
+        result = run_phase('pour', recorder, 0.0, lambda: client.make_cocktail(menu[0]))
+        if(result != 'true'):
+            logger.warning('Pour phase order returned %s', result)
+
+    if(not args.skip_remove):
+        result = run_phase('removeAllBottles', recorder, 0.0, client.remove_all_bottles)
+        if(result != 'true'):
+            logger.warning('removeAllBottles phase returned %s', result)
+
+    recorder.finish()
+    stop_event.set()
+    for tablet in tablets:
+        tablet.join()
+
+    report = recorder.report()
+    print_report(report)
+    if(output is not None):
+        with open(output, 'w') as file:
+            json.dump({"url": base_url, "tablets": args.tablets, "speed": args.speed, "phases": report}, file, indent=2)
+
+    if(server is not None):
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
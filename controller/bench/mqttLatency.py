@@ -0,0 +1,288 @@
+import os
+import sys
+import time
+import json
+import uuid
+import argparse
+import threading
+import logging
+
+logger = logging.getLogger('mqttLatency')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from syntheticCatalog import CatalogProfile
+from loadTest import percentile, start_simulated_controller
+
+#Measures the cloud command path of a simulated controller: the time from an MQTT command being published until the GPIO edge it
+#causes (pumpOn, pumpOff, makeCocktail), and the shadow round trip (desired state published until the device reports it back),
+#at increasing message rates. Commands go through IoTManager exactly as they do from AWS IoT, over an in-process broker by default
+#or a local MQTT broker with --broker (e.g. mosquitto; needs paho-mqtt).
+#Usage (from controller/): python bench/mqttLatency.py [--rates 1,5,20] [--duration 5] [--latency 0.01] [--broker localhost:1883] [--output mqtt.json]
+
+#Sends commands like the app does and collects the edges, acks, results and shadow reports they lead to
+class LatencyProbe():
+
+    def __init__(self, transport, thing_name):
+        import mqttTransport
+        self.transport = transport
+        self.update_topic = mqttTransport.get_shadow_topic(thing_name, 'update')
+        self.lock = threading.Lock()
+        self.edges = [] #(monotonic time, pin, on)
+        self.responses = {} #Command id -> {"ack": (status, time), "result": (result, time)}
+        self.reports = {} #Reported marker -> monotonic time the update was accepted
+
+        self.transport.connect()
+        self.transport.subscribe('barbot-res', self.handle_response)
+        self.transport.subscribe(mqttTransport.get_shadow_topic(thing_name, 'update/accepted'), self.handle_shadow)
+
+    #Edge listener added to every pump worker
+    def on_edge(self, pin, on, timestamp):
+        with self.lock:
+            self.edges.append((timestamp, pin, on))
+
+    def handle_response(self, client, userdata, message):
+        now = time.monotonic()
+        response = json.loads(message.payload)
+        if(response.get('action') not in ('ack', 'result')):
+            return
+        with self.lock:
+            entry = self.responses.setdefault(response['id'], {})
+            if(response['action'] == 'ack'):
+                entry['ack'] = (response['status'], now)
+            else:
+                entry['result'] = (response.get('result', response['status']), now)
+
+    def handle_shadow(self, client, userdata, message):
+        now = time.monotonic()
+        reported = json.loads(message.payload).get('state', {}).get('reported') or {}
+        if(isinstance(reported.get('ignoreList'), list) and len(reported['ignoreList']) == 1):
+            with self.lock:
+                self.reports.setdefault(reported['ignoreList'][0], now)
+
+    #Publishes a command; gets its id and the monotonic time it was sent
+    def send(self, action, data):
+        command_id = uuid.uuid4().hex[:12]
+        sent = time.monotonic()
+        self.transport.publish('barbot-main', json.dumps({"action": action, "data": data, "time": time.time(), "id": command_id}))
+        return command_id, sent
+
+    #Publishes a desired shadow state the way the app does
+    def send_desired(self, state):
+        sent = time.monotonic()
+        self.transport.publish(self.update_topic, json.dumps({"state": {"desired": state}}))
+        return sent
+
+    #Waits until every command has a result (or the timeout passes)
+    def wait_for_results(self, command_ids, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if(all('result' in self.responses.get(c, {}) for c in command_ids)):
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def get_edges(self, since):
+        with self.lock:
+            return sorted(edge for edge in self.edges if edge[0] >= since)
+
+
+#Sends commands at a fixed rate for a duration; command(i) sends the i-th one and gets whatever should be kept for it
+def run_at_rate(rate, duration, command):
+    sent = []
+    start = time.monotonic()
+    count = max(1, int(rate * duration))
+    for i in range(0, count):
+        wait = start + i / rate - time.monotonic()
+        if(wait > 0):
+            time.sleep(wait)
+        sent.append(command(i))
+    return sent
+
+#Matches every command to the first unused edge of its pin (with the expected state) after it was sent
+def match_edges(commands, edges):
+    used = set()
+    latencies = []
+    for sent, pin, on in sorted(commands):
+        for i in range(0, len(edges)):
+            timestamp, edge_pin, edge_on = edges[i]
+            if(i in used or edge_pin != pin or edge_on != on or timestamp < sent):
+                continue
+            used.add(i)
+            latencies.append(timestamp - sent)
+            break
+    return latencies
+
+#Gets the start time of every pour (an on-edge while every other pin was off)
+def get_pour_starts(edges):
+    starts = []
+    active = set()
+    for timestamp, pin, on in edges:
+        if(on):
+            if(len(active) == 0):
+                starts.append(timestamp)
+            active.add(pin)
+        else:
+            active.discard(pin)
+    return starts
+
+#Gets count and latency percentiles
+def summarize(latencies, sent, **counts):
+    latencies = sorted(latencies)
+    summary = {
+        "sent": sent,
+        "matched": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if len(latencies) > 0 else None
+    }
+    summary.update(counts)
+    return summary
+
+#Counts ack statuses and results of a set of commands
+def count_outcomes(probe, command_ids):
+    counts = {}
+    with probe.lock:
+        for command_id in command_ids:
+            response = probe.responses.get(command_id, {})
+            status = response['ack'][0] if 'ack' in response else 'lost'
+            if(status == 'queued'):
+                status = response['result'][0] if 'result' in response else 'noResult'
+            counts[status] = counts.get(status, 0) + 1
+    return counts
+
+#Alternates pumpOn/pumpOff over the regular pumps; latency is publish until the pump's pin switches
+def bench_pumps(probe, main, rate, duration, pumps):
+    def command(i):
+        pump_num = pumps[(i // 2) % len(pumps)]
+        on = i % 2 == 0
+        command_id, sent = probe.send('pumpOn' if on else 'pumpOff', str(pump_num))
+        return (command_id, sent, main.pumps[pump_num].gpio, on)
+
+    start = time.monotonic()
+    sent = run_at_rate(rate, duration, command)
+    command_ids = [c[0] for c in sent]
+    probe.wait_for_results(command_ids, 10)
+
+    edges = probe.get_edges(start)
+    results = {}
+    for on, action in ((True, 'pumpOn'), (False, 'pumpOff')):
+        commands = [(c[1], c[2], c[3]) for c in sent if c[3] == on]
+        ids = [c[0] for c in sent if c[3] == on]
+        results[action] = summarize(match_edges(commands, edges), len(commands), outcomes=count_outcomes(probe, ids))
+    return results
+
+#Orders cocktails; latency is publish until the first pin of the pour switches on (orders that arrive mid-pour come back busy)
+def bench_orders(probe, rate, duration, menu):
+    start = time.monotonic()
+    sent = run_at_rate(rate, duration, lambda i: probe.send('makeCocktail', menu[i % len(menu)]))
+    command_ids = [c[0] for c in sent]
+    probe.wait_for_results(command_ids, 60)
+
+    #Pours run one at a time, so the n-th pour to finish is the n-th pour to start
+    with probe.lock:
+        poured = sorted((probe.responses[c]['result'][1], sent_time) for c, sent_time in sent if probe.responses.get(c, {}).get('result', ('',))[0] in ('true', 'aborted'))
+    starts = get_pour_starts(probe.get_edges(start))
+    latencies = [pour_start - order[1] for order, pour_start in zip(poured, starts)]
+    return {"makeCocktail": summarize(latencies, len(sent), outcomes=count_outcomes(probe, command_ids))}
+
+#Publishes desired ignore lists with a unique marker; latency is publish until the device's report of it is accepted
+def bench_shadow(probe, rate, duration, run):
+    def command(i):
+        marker = 'bench-' + str(run) + '-' + str(i)
+        return (marker, probe.send_desired({"ignoreList": [marker]}))
+
+    sent = run_at_rate(rate, duration, command)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with probe.lock:
+            if(all(marker in probe.reports for marker, sent_time in sent)):
+                break
+        time.sleep(0.01)
+
+    with probe.lock:
+        latencies = [probe.reports[marker] - sent_time for marker, sent_time in sent if marker in probe.reports]
+    probe.send_desired({"ignoreList": []})
+    return {"shadow": summarize(latencies, len(sent))}
+
+#Prints one table per rate
+def print_report(report):
+    for run in report['runs']:
+        print('\n%.1f msg/s (%.1f s)' % (run['rate'], run['duration']))
+        print('  %-14s %6s %8s %9s %9s %9s %9s  %s' % ('action', 'sent', 'matched', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'outcomes'))
+        for action, stats in run['actions'].items():
+            values = [stats[key] * 1000 if stats[key] is not None else float('nan') for key in ('p50', 'p95', 'p99', 'max')]
+            outcomes = ' '.join('%s=%d' % item for item in sorted(stats.get('outcomes', {}).items()))
+            print('  %-14s %6d %8d %9.2f %9.2f %9.2f %9.2f  %s' % (action, stats['sent'], stats['matched'], values[0], values[1], values[2], values[3], outcomes))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MQTT command and shadow latency through IoTManager')
+    parser.add_argument('--rates', default='1,5,20', help='Comma separated message rates (per second) to run')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds each action is sent at each rate')
+    parser.add_argument('--latency', type=float, default=0.0, help='One-way delay added by the in-process broker (seconds)')
+    parser.add_argument('--broker', default=None, help='host:port of a local MQTT broker to use instead of the in-process one')
+    parser.add_argument('--no-shadow-service', action='store_true', help='The --broker has its own shadow service (don\'t start one)')
+    parser.add_argument('--pour-scale', type=float, default=0.01, help='Scales simulated pump times (1.0 pours in real time)')
+    parser.add_argument('--skip', default='', help='Comma separated benchmarks to skip (pumps, orders, shadow)')
+    parser.add_argument('--output', default=None, help='Write the report as json to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output = os.path.abspath(args.output) if args.output is not None else None
+    rates = [float(rate) for rate in args.rates.split(',')]
+    skip = set(args.skip.split(','))
+
+    start_simulated_controller(0, args.pour_scale, 0.01, CatalogProfile().most_common(8))
+    import mqttTransport
+    import network
+
+    iot_manager = network.iot_manager
+    main = network.main
+    thing_name = iot_manager.thing_name
+    if(args.broker is not None):
+        host, port = args.broker.split(':')
+        settings = {"transport": 'local', "host": host, "port": int(port)}
+        if(not args.no_shadow_service):
+            mqttTransport.ShadowService(mqttTransport.create_transport(dict(settings, clientId='bench-shadow')))
+        device = mqttTransport.create_transport(dict(settings, clientId='barbot-bench'))
+        app = mqttTransport.create_transport(dict(settings, clientId='bench-app'))
+    else:
+        broker = mqttTransport.MemoryBroker(args.latency)
+        device = mqttTransport.MemoryTransport(broker, 'barbot-bench')
+        app = mqttTransport.MemoryTransport(broker, 'bench-app')
+
+    iot_manager.connect(device)
+    if(iot_manager.disabled):
+        logger.error('Could not connect the controller to the broker')
+        return
+    probe = LatencyProbe(app, thing_name)
+    for worker in main.pump_workers.workers.values():
+        listener = worker.edge_listener
+        worker.edge_listener = lambda pin, on, timestamp, listener=listener: (listener(pin, on, timestamp) if listener is not None else None, probe.on_edge(pin, on, timestamp))
+
+    pumps = [num for num in main.pumps if main.pumps[num].type == 'regular']
+    menu = main.get_cocktail_list()
+    if(len(menu) == 0):
+        logger.warning('No cocktails can be made with the simulated bottles; skipping makeCocktail')
+        skip.add('orders')
+
+    report = {"broker": args.broker if args.broker is not None else 'memory', "latency": args.latency, "runs": []}
+    for run, rate in enumerate(rates):
+        logger.warning('Rate: %.1f msg/s', rate)
+        actions = {}
+        if('pumps' not in skip):
+            actions.update(bench_pumps(probe, main, rate, args.duration, pumps))
+        if('orders' not in skip):
+            actions.update(bench_orders(probe, rate, args.duration, menu))
+        if('shadow' not in skip):
+            actions.update(bench_shadow(probe, rate, args.duration, run))
+        report['runs'].append({"rate": rate, "duration": args.duration, "actions": actions})
+
+    print_report(report)
+    if(output is not None):
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import json
+import gzip
+import types
+import argparse
+import threading
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadTest import Recorder, Client, percentile, start_simulated_controller
+
+logger = logging.getLogger('replayTrace')
+
+#Plays a command trace recorded by commandRecorder.py back into a simulated controller (or a running BarBot with --url).
+#Every command is sent at its recorded offset divided by --speed, each on its own thread, so overlapping commands overlap again.
+#Usage (from controller/): python bench/replayTrace.py logs/commands.jsonl.1 logs/commands.jsonl [--speed 10] [--config-dir saved/] [--output replay.json]
+
+#Loads and merges trace files (plain or gzipped), oldest command first
+def load_trace(paths):
+    commands = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as file:
+            for line in file:
+                line = line.strip()
+                if(line == ''):
+                    continue
+                try:
+                    commands.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Skipping bad trace line in %s', path)
+    commands.sort(key=lambda c: c['t'])
+    return commands
+
+
+#Replays commands and collects what happened
+class Replayer():
+
+    def __init__(self, client, recorder, iot_manager=None, shadow_service=None):
+        self.client = client
+        self.recorder = recorder
+        self.iot_manager = iot_manager
+        self.shadow_service = shadow_service
+        self.lock = threading.Lock()
+        self.results = {} #Route -> {"busy": n, "recorded": [seconds]}
+        self.lag = [] #Seconds each command was sent later than scheduled
+        self.skipped = 0
+        self.threads = []
+
+    def note(self, route, recorded=None, busy=False):
+        with self.lock:
+            result = self.results.setdefault(route, {"busy": 0, "recorded": []})
+            if(recorded is not None):
+                result['recorded'].append(recorded)
+            if(busy):
+                result['busy'] += 1
+
+    #Sends a recorded REST request
+    def send_rest(self, command):
+        text = self.client.request(command['p'], command['r'], command.get('b'), command['m'])
+        self.note(command['r'], command.get('d'), text == 'busy')
+
+    #Feeds a recorded MQTT message to the IoT manager, keeping the delay it originally arrived with
+    def send_mqtt(self, command):
+        try:
+            payload = json.loads(command['b'])
+        except ValueError:
+            payload = None
+
+        route = 'mqtt ' + str(payload.get('action')) if isinstance(payload, dict) else 'mqtt'
+        if(isinstance(payload, dict) and 'time' in payload):
+            payload['time'] = time.time() - (command['t'] - payload['time'])
+
+        message = types.SimpleNamespace(topic=command.get('q'), payload=json.dumps(payload) if payload is not None else command['b'])
+        phase = self.recorder.phase
+        start = time.perf_counter()
+        self.iot_manager.parse_message(None, None, message)
+        self.recorder.record(phase, route, time.perf_counter() - start, True)
+        self.note(route)
+
+    #Sends every command at its (scaled) recorded time
+    def replay(self, commands, speed):
+        if(len(commands) == 0):
+            return
+        first = commands[0]['t']
+        start = time.monotonic()
+
+        for command in commands:
+            due = start + (command['t'] - first) / speed
+            wait = due - time.monotonic()
+            if(wait > 0):
+                time.sleep(wait)
+            self.lag.append(max(0.0, time.monotonic() - due))
+
+            if(command['k'] == 'rest'):
+                target = self.send_rest
+            elif(command['k'] == 'mqtt' and self.iot_manager is not None):
+                target = self.send_mqtt
+            else:
+                self.skipped += 1
+                continue
+
+            thread = threading.Thread(target=target, args=[command], daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        for thread in self.threads:
+            thread.join()
+
+    #Adds the recorded latency and busy counts to the loadTest report of each route
+    def report(self):
+        report = self.recorder.report().get('replay', {"routes": {}})
+        for route, stats in report['routes'].items():
+            result = self.results.get(route, {"busy": 0, "recorded": []})
+            recorded = sorted(result['recorded'])
+            stats['busy'] = result['busy']
+            stats['recordedP50'] = percentile(recorded, 50)
+            stats['recordedP95'] = percentile(recorded, 95)
+
+        lag = sorted(self.lag)
+        report['maxLag'] = lag[-1] if len(lag) > 0 else 0.0
+        report['p99Lag'] = percentile(lag, 99)
+        report['skipped'] = self.skipped
+        if(self.shadow_service is not None):
+            report['shadowUpdates'] = self.shadow_service.updates
+        return report
+
+
+#Prints the replay report, with the recorded latency next to the replayed one
+def print_report(report, commands):
+    print('Replayed %d commands in %.1f s (%.1f/s); max send lag %.1f ms; %d skipped' % (len(commands) - report['skipped'], report.get('duration', 0.0), report.get('throughput', 0.0), report['maxLag'] * 1000, report['skipped']))
+    if('shadowUpdates' in report):
+        print('Shadow updates: %d' % report['shadowUpdates'])
+    print('  %-32s %7s %7s %9s %9s %9s %13s' % ('route', 'count', 'busy', 'p50 ms', 'p95 ms', 'p99 ms', 'recorded p50'))
+    for route, stats in sorted(report['routes'].items()):
+        recorded = '%13.2f' % (stats['recordedP50'] * 1000) if stats['recordedP50'] is not None else '%13s' % '-'
+        print('  %-32s %7d %7d %9.2f %9.2f %9.2f %s' % (route, stats['count'], stats['busy'], stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000, recorded))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded BarBot command trace')
+    parser.add_argument('traces', nargs='+', help='Trace files (rotated files are merged in time order)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier (pumps and cleaning are sped up to match)')
+    parser.add_argument('--url', default=None, help='Replay REST commands against a running BarBot instead (MQTT commands are skipped)')
+    parser.add_argument('--config-dir', default=None, help='Start from a copy of the recorded controller\'s config files')
+    parser.add_argument('--catalog-size', type=int, default=0, help='Synthetic recipes for the simulated controller (0 uses the config cocktails.json)')
+    parser.add_argument('--output', default=None, help='Write the report as json to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    traces = [os.path.abspath(path) for path in args.traces]
+    output = os.path.abspath(args.output) if args.output is not None else None
+    commands = load_trace(traces)
+
+    server = None
+    iot_manager = None
+    shadow_service = None
+    if(args.url is not None):
+        base_url = args.url
+    else:
+        base_url, server = start_simulated_controller(args.catalog_size, 1.0 / args.speed, 8.0 / args.speed, None, args.config_dir)
+        import network
+        import mqttTransport
+
+        #Let MQTT commands through to an in-process broker whose shadow service counts the updates
+        broker = mqttTransport.MemoryBroker()
+        iot_manager = network.iot_manager
+        iot_manager.connect(mqttTransport.MemoryTransport(broker))
+        shadow_service = broker.shadow_service
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    recorder = Recorder()
+    recorder.set_phase('replay')
+    replayer = Replayer(Client(base_url, recorder), recorder, iot_manager, shadow_service)
+    replayer.replay(commands, args.speed)
+    recorder.finish()
+
+    report = replayer.report()
+    print_report(report, commands)
+    if(output is not None):
+        with open(output, 'w') as file:
+            json.dump({"traces": traces, "speed": args.speed, "commands": len(commands), "report": report}, file, indent=2)
+
+    if(server is not None):
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
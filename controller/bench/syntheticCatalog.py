@@ -0,0 +1,93 @@
+import random
+import json
+import os
+import collections
+import decimal
+
+#Generates synthetic recipe catalogs whose ingredient mix follows the real cocktails.json
+
+CONTROLLER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Ingredient/amount/recipe-size distributions taken from a real cocktails.json
+class CatalogProfile():
+
+    def __init__(self, path=None):
+        if(path is None):
+            path = os.path.join(CONTROLLER_DIR, 'cocktails.json')
+        with open(path, 'r') as file:
+            cocktails = json.load(file)['cocktails']
+
+        ingredient_counts = collections.Counter()
+        size_counts = collections.Counter()
+        self.amounts = []
+        for cocktail in cocktails:
+            size_counts[len(cocktail['ingredients'])] += 1
+            for i in range(0, len(cocktail['ingredients'])):
+                ingredient_counts[cocktail['ingredients'][i]] += 1
+                self.amounts.append(float(cocktail['amounts'][i]))
+
+        self.ingredients = list(ingredient_counts.keys())
+        self.ingredient_weights = [ingredient_counts[i] for i in self.ingredients]
+        self.sizes = list(size_counts.keys())
+        self.size_weights = [size_counts[s] for s in self.sizes]
+
+    #Gets the ingredients ordered from most to least common
+    def most_common(self, count):
+        ranked = sorted(zip(self.ingredients, self.ingredient_weights), key=lambda e: -e[1])
+        return [name for name, weight in ranked[:count]]
+
+
+#Generates a catalog of recipes as {'cocktails': [{'name', 'ingredients', 'amounts'}]}
+#Large catalogs add a long tail of made-up ingredients (tail_fraction of picks) so most recipes are not makeable, like a real recipe database
+def generate_catalog(size, profile=None, seed=0, tail_fraction=0.2):
+    if(profile is None):
+        profile = CatalogProfile()
+    rand = random.Random(seed)
+    tail_size = max(10, size // 20)
+
+    catalog = {'cocktails': []}
+    for n in range(0, size):
+        recipe_size = rand.choices(profile.sizes, profile.size_weights)[0]
+        ingredients = []
+        while len(ingredients) < recipe_size:
+            if(rand.random() < tail_fraction):
+                ingredient = 'ingredient ' + str(rand.randrange(tail_size))
+            else:
+                ingredient = rand.choices(profile.ingredients, profile.ingredient_weights)[0]
+            if(ingredient not in ingredients):
+                ingredients.append(ingredient)
+
+        catalog['cocktails'].append({
+            "name": 'cocktail ' + str(n),
+            "ingredients": ingredients,
+            "amounts": [rand.choice(profile.amounts) for i in ingredients]
+        })
+    return catalog
+
+#Converts a catalog into the {name: json string} form returned by the sequential scan in benchScan.get_all_recipes
+def to_recipe_scan(catalog):
+    recipes = {}
+    for cocktail in catalog['cocktails']:
+        amounts = {}
+        for i in range(0, len(cocktail['ingredients'])):
+            amounts[cocktail['ingredients'][i]] = cocktail['amounts'][i]
+        recipes[cocktail['name']] = json.dumps({
+            'cocktailName': cocktail['name'],
+            'ingredients': cocktail['ingredients'],
+            'amounts': amounts
+        })
+    return recipes
+
+#Converts a catalog into DynamoDB items as stored by recipe.upload_recipe
+def to_dynamo_items(catalog):
+    items = []
+    for cocktail in catalog['cocktails']:
+        amounts = {}
+        for i in range(0, len(cocktail['ingredients'])):
+            amounts[cocktail['ingredients'][i]] = decimal.Decimal(str(cocktail['amounts'][i]))
+        items.append({
+            'cocktailName': cocktail['name'],
+            'ingredients': cocktail['ingredients'],
+            'amounts': amounts
+        })
+    return items
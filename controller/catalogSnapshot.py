@@ -0,0 +1,274 @@
+import collections.abc
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+import logging
+import metrics
+from barModel import Recipe
+
+#Precompiled binary copy of cocktails.json that the controller memory-maps instead of parsing the json on every load.
+#
+#  header       magic, version, recipe count, ingredient count, stamp (size and mtime) of the cocktails.json it was built from,
+#               crc32 of everything after the header and the offset of each section
+#  ingredients  interned ingredient table: count + 1 uint32 offsets into a blob of utf-8 names
+#  names        recipe names sorted by their utf-8 bytes (so a name is found by binary search): count + 1 uint32 offsets into a name blob
+#  records      count uint32 offsets into the record blob; each record is a uint16 ingredient count, that many uint16 ingredient ids
+#               (padded to 4 bytes) and that many float32 amounts
+#
+#Only the header and the ingredient table are read up front; each recipe is decoded into a Recipe the first time it's used.
+
+MAGIC = b'BBCS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQqIIII') #magic, version, unused, recipes, ingredients, source size, source mtime ns, crc, ingredients/names/records offsets
+
+logger = logging.getLogger(__name__)
+
+snapshot_builds = metrics.counter('barbot_catalog_snapshot_builds_total', 'Times the catalog snapshot was rebuilt', ['reason'])
+snapshot_build_latency = metrics.histogram('barbot_catalog_snapshot_build_seconds', 'Time taken to compile the catalog snapshot')
+
+#Gets the (size, mtime ns) stamp of a file, or (0, 0) if it doesn't exist
+def get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0, 0
+    return stat.st_size, stat.st_mtime_ns
+
+#Packs offsets into a uint32 index (with the end of the blob as the last entry) followed by the blob
+def pack_strings(values):
+    offsets = [0]
+    blob = bytearray()
+    for value in values:
+        blob += value
+        offsets.append(len(blob))
+    blob += b'\0' * (-len(blob) % 4)
+    return struct.pack('<%dI' % len(offsets), *offsets) + bytes(blob)
+
+
+#Collects recipes and compiles them into the snapshot body (the same recipes always give the same bytes, whatever order they came in)
+class SnapshotBuilder():
+
+    def __init__(self):
+        self.ingredient_ids = {}
+        self.recipes = {} #utf-8 name -> (ingredient ids, amounts); a name added twice keeps its last recipe
+        self.built = None
+
+    def add(self, name, ingredients, amounts):
+        if(len(ingredients) != len(amounts)):
+            raise ValueError('Ingredients and amounts don\'t match for ' + str(name))
+        ids = []
+        for ingredient in ingredients:
+            if(ingredient not in self.ingredient_ids):
+                self.ingredient_ids[ingredient] = len(self.ingredient_ids)
+            ids.append(self.ingredient_ids[ingredient])
+        self.recipes[str(name).encode('utf-8')] = (ids, [float(amount) for amount in amounts])
+        self.built = None
+
+    def __len__(self):
+        return len(self.recipes)
+
+    #Gets (crc, body, ingredient count, recipe count, names offset, records offset) for everything after the header
+    def build(self):
+        if(self.built is not None):
+            return self.built
+
+        #Number the ingredients in name order so the body doesn't depend on the order recipes were added in
+        ingredients = sorted(self.ingredient_ids.keys())
+        renumber = [0] * len(ingredients)
+        for new_id in range(0, len(ingredients)):
+            renumber[self.ingredient_ids[ingredients[new_id]]] = new_id
+
+        names = sorted(self.recipes.keys())
+        records = []
+        for name in names:
+            ids, amounts = self.recipes[name]
+            count = len(ids)
+            record = struct.pack('<H%dH' % count, count, *[renumber[i] for i in ids])
+            record += b'\0' * (-len(record) % 4)
+            records.append(record + struct.pack('<%df' % count, *amounts))
+
+        ingredient_section = pack_strings([i.encode('utf-8') for i in ingredients])
+        name_section = pack_strings(names)
+        body = ingredient_section + name_section + pack_strings(records)
+        names_offset = HEADER.size + len(ingredient_section)
+        self.built = (zlib.crc32(body), body, len(ingredients), len(names), names_offset, names_offset + len(name_section))
+        return self.built
+
+    def get_crc(self):
+        return self.build()[0]
+
+    #Writes the snapshot atomically, stamped with the json file it was built from
+    def write(self, path, source_stamp):
+        crc, body, ingredient_count, recipe_count, names_offset, records_offset = self.build()
+        header = HEADER.pack(MAGIC, VERSION, 0, recipe_count, ingredient_count, source_stamp[0], source_stamp[1], crc, HEADER.size, names_offset, records_offset)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(header)
+            file.write(body)
+        os.replace(path + '.tmp', path)
+
+
+#Read only view of a snapshot file. Recipes are found by binary search over the sorted names and decoded on first use.
+class CatalogSnapshot():
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self.data, 0)
+        if(fields[0] != MAGIC or fields[1] != VERSION):
+            raise ValueError('Not a version ' + str(VERSION) + ' catalog snapshot: ' + path)
+        self.recipe_count = fields[3]
+        self.source_stamp = (fields[5], fields[6])
+        self.crc = fields[7]
+        self.names_offset = fields[9]
+        self.records_offset = fields[10]
+        if(self.get_end(self.records_offset, self.recipe_count) != len(self.data)):
+            raise ValueError('Truncated catalog snapshot: ' + path)
+
+        self.ingredient_names = [sys.intern(self.get_string(fields[8], fields[4], i).decode('utf-8')) for i in range(0, fields[4])]
+        self.recipes = {} #Recipe index -> Recipe, filled as recipes are used
+        self.index = None #Name -> recipe index, once load_index has run (binary search until then)
+
+    def __len__(self):
+        return self.recipe_count
+
+    #Gets where a string section ends
+    def get_end(self, offset, count):
+        length = struct.unpack_from('<I', self.data, offset + count * 4)[0]
+        return offset + (count + 1) * 4 + length + (-length % 4)
+
+    #Gets the bytes of entry i of a string section
+    def get_string(self, offset, count, i):
+        start, end = struct.unpack_from('<II', self.data, offset + i * 4)
+        blob = offset + (count + 1) * 4
+        return self.data[blob + start:blob + end]
+
+    def get_name(self, index):
+        return self.get_string(self.names_offset, self.recipe_count, index).decode('utf-8')
+
+    def names(self):
+        if(self.index is not None):
+            return iter(self.index)
+        return (self.get_name(index) for index in range(0, self.recipe_count))
+
+    #Decodes every name at once into a name -> index dict (only names, the records stay undecoded)
+    def load_index(self):
+        if(self.index is None):
+            offsets = struct.unpack_from('<%dI' % (self.recipe_count + 1), self.data, self.names_offset)
+            blob_start = self.names_offset + (self.recipe_count + 1) * 4
+            blob = self.data[blob_start:blob_start + offsets[-1]]
+            self.index = {blob[offsets[i]:offsets[i + 1]].decode('utf-8'): i for i in range(0, self.recipe_count)}
+        return self.index
+
+    #Gets the index of a recipe (-1 if it isn't in the snapshot)
+    def index_of(self, name):
+        if(self.index is not None):
+            return self.index.get(name, -1)
+        key = name.encode('utf-8')
+        low = 0
+        high = self.recipe_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.get_string(self.names_offset, self.recipe_count, middle)
+            if(current == key):
+                return middle
+            if(current < key):
+                low = middle + 1
+            else:
+                high = middle
+        return -1
+
+    #Gets the position of a record in the file
+    def get_record_position(self, index):
+        start = struct.unpack_from('<I', self.data, self.records_offset + index * 4)[0]
+        return self.records_offset + (self.recipe_count + 1) * 4 + start
+
+    #Gets the ingredient ids of a recipe (indexes into ingredient_names) without decoding it
+    def get_ingredient_ids(self, index):
+        position = self.get_record_position(index)
+        count = struct.unpack_from('<H', self.data, position)[0]
+        return struct.unpack_from('<%dH' % count, self.data, position + 2)
+
+    #Gets the Recipe at an index
+    def get_record(self, index):
+        record = self.recipes.get(index)
+        if(record is None):
+            position = self.get_record_position(index)
+            count = struct.unpack_from('<H', self.data, position)[0]
+            ids = struct.unpack_from('<%dH' % count, self.data, position + 2)
+            amounts = struct.unpack_from('<%df' % count, self.data, position + ((2 + count * 2 + 3) & ~3))
+            #float32 keeps about 7 significant digits, so round back to the amount that was stored (0.33, not 0.33000001311)
+            record = Recipe(self.get_name(index), [self.ingredient_names[i] for i in ids], [float('%.7g' % amount) for amount in amounts])
+            self.recipes[index] = record
+        return record
+
+    #Gets a Recipe by name (None if it isn't in the snapshot)
+    def get(self, name):
+        index = self.index_of(name)
+        if(index < 0):
+            return None
+        return self.get_record(index)
+
+
+#Dict-like view of the recipes in a snapshot, name -> Recipe (what Main keeps as recipes)
+class RecipeView(collections.abc.Mapping):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, name):
+        record = self.snapshot.get(name) if isinstance(name, str) else None
+        if(record is None):
+            raise KeyError(name)
+        return record
+
+    def __contains__(self, name):
+        return isinstance(name, str) and self.snapshot.index_of(name) >= 0
+
+    def __iter__(self):
+        return self.snapshot.names()
+
+    def __len__(self):
+        return len(self.snapshot)
+
+
+#Gets the crc and source stamp of a snapshot file from its header (None if it can't be read)
+def read_header(path):
+    try:
+        with open(path, 'rb') as file:
+            fields = HEADER.unpack(file.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if(fields[0] != MAGIC or fields[1] != VERSION):
+        return None
+    return {"crc": fields[7], "sourceStamp": (fields[5], fields[6]), "recipes": fields[3], "ingredients": fields[4]}
+
+#Compiles a snapshot from a cocktails.json file
+def compile_snapshot(source, path, reason='stale'):
+    with metrics.Timer(snapshot_build_latency):
+        stamp = get_stamp(source) #Taken first, so a json file replaced while compiling just gets compiled again next time
+        with open(source, 'r') as file:
+            data = json.load(file)
+        builder = SnapshotBuilder()
+        for cocktail in data['cocktails']:
+            builder.add(cocktail['name'], cocktail['ingredients'], cocktail['amounts'])
+        builder.write(path, stamp)
+    snapshot_builds.inc(1, {'reason': reason})
+    logger.info('Compiled %d cocktails into %s (%s)', len(builder), path, reason)
+
+#Opens the snapshot of a cocktails.json file, compiling it first if it's missing or was built from a different version of the json
+def load_snapshot(source='cocktails.json', path='cocktails.bin'):
+    try:
+        snapshot = CatalogSnapshot(path)
+        if(snapshot.source_stamp == get_stamp(source)):
+            return snapshot
+        reason = 'stale'
+    except (OSError, ValueError, struct.error) as e:
+        reason = 'missing' if not os.path.exists(path) else 'invalid'
+        if(reason == 'invalid'):
+            logger.warning('Rebuilding catalog snapshot: %s', e)
+
+    compile_snapshot(source, path, reason)
+    return CatalogSnapshot(path)
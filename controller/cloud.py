@@ -0,0 +1,219 @@
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from urllib.parse import urlparse
+import socket
+import threading
+import time
+import logging
+import metrics
+
+#Shared access to DynamoDB for recipe.py and cocktailStats.py: one client (and so one pooled HTTP connection) with short timeouts,
+#behind a circuit breaker. Once the cloud can't be reached a few times in a row the breaker opens and every call fails fast with
+#CircuitOpen, so callers go straight to their local fallback while a background probe waits for the network to come back.
+
+REGION = 'us-east-1'
+logger = logging.getLogger(__name__)
+
+breaker_open = metrics.gauge('barbot_cloud_breaker_open', 'Whether the cloud circuit breaker is open (1) or closed (0)')
+breaker_trips = metrics.counter('barbot_cloud_breaker_trips_total', 'Times the cloud circuit breaker opened')
+breaker_rejections = metrics.counter('barbot_cloud_breaker_rejections_total', 'Cloud calls failed fast while the breaker was open', ['operation'])
+
+settings = {}
+resource = None #Shared DynamoDB resource (created on first use)
+tables = {}
+resource_lock = threading.Lock()
+
+#Raised instead of calling the cloud while the breaker is open
+class CircuitOpen(Exception):
+    pass
+
+
+#Fails calls fast after repeated connection failures. While open, the controller scheduler starts a probe (or, without one,
+#the first call after reset_timeout is let through as a trial) and the breaker closes again once the cloud answers.
+class CircuitBreaker():
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0, max_reset_timeout=300.0, probe=None):
+        self.failure_threshold = failure_threshold
+        self.base_timeout = reset_timeout
+        self.reset_timeout = reset_timeout #Doubles every time a probe or trial fails
+        self.max_reset_timeout = max_reset_timeout
+        self.probe_function = probe #Gets True once the cloud can be reached
+        self.scheduler = None
+        self.lock = threading.Lock()
+        self.state = 'closed' #closed, open or halfOpen (a trial call is in flight)
+        self.failures = 0
+        self.opened_at = None
+        self.retry_at = 0.0
+        self.probing = False
+        self.listeners = [] #Called (on the thread that closed the breaker) when the cloud is reachable again
+        breaker_open.set(0)
+
+    #Runs probes on the controller scheduler instead of waiting for a trial call
+    def set_scheduler(self, scheduler):
+        self.scheduler = scheduler
+        if(self.is_open()):
+            self.schedule_probe()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def is_open(self):
+        return self.state != 'closed'
+
+    #Gets whether a call may go through now
+    def allow(self):
+        with self.lock:
+            if(self.state == 'closed'):
+                return True
+            if(self.state == 'open' and self.scheduler is None and time.monotonic() >= self.retry_at):
+                self.state = 'halfOpen'
+                return True
+            return False
+
+    #Runs function(*args) for an operation through the breaker
+    def call(self, operation, function, *args, **kwargs):
+        if(not self.allow()):
+            breaker_rejections.inc(1, {'operation': operation})
+            raise CircuitOpen('Cloud unreachable, skipping ' + operation)
+
+        try:
+            result = function(*args, **kwargs)
+        except ClientError:
+            self.record_success() #The cloud answered, the request itself was bad
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def record_success(self):
+        with self.lock:
+            was_open = self.state != 'closed'
+            self.state = 'closed'
+            self.failures = 0
+            self.reset_timeout = self.base_timeout
+        if(was_open):
+            breaker_open.set(0)
+            logger.info('Cloud reachable again, closing circuit breaker')
+            for listener in self.listeners:
+                try:
+                    listener()
+                except Exception as e:
+                    logger.exception('Error in circuit breaker listener')
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if(self.state == 'closed' and self.failures < self.failure_threshold):
+                return
+            if(self.state == 'halfOpen'):
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            elif(self.state == 'closed'):
+                self.opened_at = time.time()
+                breaker_trips.inc()
+            self.state = 'open'
+            self.retry_at = time.monotonic() + self.reset_timeout
+        breaker_open.set(1)
+        logger.warning('Cloud unreachable, circuit breaker open for %.1f s', self.reset_timeout)
+        self.schedule_probe()
+
+    def schedule_probe(self):
+        if(self.scheduler is not None and self.probe_function is not None):
+            self.scheduler.once(max(0.0, self.retry_at - time.monotonic()), self.start_probe, 'cloud.probe')
+
+    #Starts a probe on its own thread, so its connect timeout (and the listeners run once it succeeds) never hold up other scheduler jobs
+    def start_probe(self):
+        with self.lock:
+            if(self.probing):
+                return
+            self.probing = True
+        threading.Thread(target=self.run_probe, name='cloud-probe', daemon=True).start()
+
+    def run_probe(self):
+        try:
+            self.probe()
+        finally:
+            with self.lock:
+                self.probing = False
+
+    #Checks whether the cloud is reachable again (runs on a probe thread while the breaker is open)
+    def probe(self):
+        if(self.state == 'closed'):
+            return
+        try:
+            reachable = self.probe_function()
+        except Exception as e:
+            reachable = False
+        if(reachable):
+            self.record_success()
+            return
+
+        with self.lock:
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self.retry_at = time.monotonic() + self.reset_timeout
+        self.schedule_probe()
+
+    #Gets the breaker state as a json friendly object
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "openedAt": self.opened_at if self.state != 'closed' else None,
+            "retryIn": max(0.0, self.retry_at - time.monotonic()) if self.state != 'closed' else None
+        }
+
+
+#Gets whether a TCP connection to the DynamoDB endpoint can be opened (cheap and needs no credentials)
+def probe_endpoint():
+    endpoint = urlparse(get_client().meta.endpoint_url)
+    with socket.create_connection((endpoint.hostname, endpoint.port or 443), timeout=settings.get('connectTimeout', 2)):
+        return True
+
+breaker = CircuitBreaker(probe=probe_endpoint)
+
+#Gets the botocore config for the shared client: short timeouts, few retries and a small reused connection pool
+def get_config():
+    return Config(
+        region_name=REGION,
+        connect_timeout=settings.get('connectTimeout', 2),
+        read_timeout=settings.get('readTimeout', 3),
+        retries={'max_attempts': settings.get('maxAttempts', 2), 'mode': 'standard'},
+        max_pool_connections=settings.get('maxPoolConnections', 4),
+        tcp_keepalive=True
+    )
+
+#Gets the shared DynamoDB resource
+def get_resource():
+    global resource
+    with resource_lock:
+        if(resource is None):
+            resource = boto3.resource('dynamodb', region_name=REGION, config=get_config())
+        return resource
+
+#Gets a DynamoDB table (backed by the shared client)
+def get_table(name):
+    if(name not in tables):
+        tables[name] = get_resource().Table(name)
+    return tables[name]
+
+#Gets the low level DynamoDB client (the same one the resource uses, so both share its connection pool)
+def get_client():
+    return get_resource().meta.client
+
+#Runs a cloud call through the circuit breaker
+def call(operation, function, *args, **kwargs):
+    return breaker.call(operation, function, *args, **kwargs)
+
+#Applies the optional 'cloud' block of settings.json (must run before the first cloud call)
+def setup_cloud(cloud_settings=None):
+    global settings, resource, tables
+    settings = cloud_settings if cloud_settings is not None else {}
+    breaker.failure_threshold = settings.get('failureThreshold', 3)
+    breaker.base_timeout = settings.get('resetTimeout', 10.0)
+    breaker.reset_timeout = breaker.base_timeout
+    breaker.max_reset_timeout = settings.get('maxResetTimeout', 300.0)
+    with resource_lock:
+        resource = None
+        tables = {}
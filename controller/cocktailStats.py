@@ -1,39 +1,79 @@
 import json
-import boto3
+import threading
+import cloud
+import metrics
+import tracing
+import logging
 
-dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+TABLE_NAME = 'BarBot-cocktailStats'
+logger = logging.getLogger(__name__)
 
-#Update the number of times a specific cocktail has been created
-def increment_cocktail(cocktail_name):
+dynamo_latency = metrics.histogram('barbot_dynamodb_call_seconds', 'Latency of DynamoDB calls', ['operation'])
+dynamo_errors = metrics.counter('barbot_dynamodb_errors_total', 'DynamoDB calls that raised an error', ['operation'])
+
+pending = {} #Cocktail name -> pours not counted in the cloud yet (made while it was unreachable)
+pending_lock = threading.Lock()
+
+#Update the number of times a specific cocktail has been created; gets False if the cloud couldn't be reached (the count is kept for later)
+def increment_cocktail(cocktail_name, count=1):
     try:
-        res = dynamodb.update_item(
-            TableName='BarBot-cocktailStats',
-            Key={
-                'cocktailName': {
-                    'S': cocktail_name
-                }
-            },
-            ExpressionAttributeNames= {
-                '#count': 'count'
-            },
-            ExpressionAttributeValues = {
-                ':inc': {
-                    'N': '1'
-                }
-            },
-            UpdateExpression="SET #count = #count + :inc",
-            ReturnValues='UPDATED_NEW'
-        )
+        try:
+            with tracing.span('dynamodb.stats_update_item'), metrics.Timer(dynamo_latency, {'operation': 'stats_update_item'}, dynamo_errors):
+                res = cloud.call('stats_update_item', cloud.get_client().update_item,
+                    TableName=TABLE_NAME,
+                    Key={
+                        'cocktailName': {
+                            'S': cocktail_name
+                        }
+                    },
+                    ExpressionAttributeNames= {
+                        '#count': 'count'
+                    },
+                    ExpressionAttributeValues = {
+                        ':inc': {
+                            'N': str(count)
+                        }
+                    },
+                    UpdateExpression="SET #count = #count + :inc",
+                    ReturnValues='UPDATED_NEW'
+                )
+        except cloud.ClientError as e:
+            logger.info('%s not in database yet. Creating...', cocktail_name)
+            with tracing.span('dynamodb.stats_put_item'), metrics.Timer(dynamo_latency, {'operation': 'stats_put_item'}, dynamo_errors):
+                cloud.call('stats_put_item', cloud.get_client().put_item,
+                    TableName=TABLE_NAME,
+                    Item={
+                        'cocktailName': {
+                            'S': cocktail_name
+                        },
+                        'count': {
+                            'N': str(count)
+                        }
+                    }
+                )
     except Exception as e:
-        print(cocktail_name + ' not in database yet. Creating...')
-        dynamodb.put_item(
-            TableName='BarBot-cocktailStats',
-            Item={
-                'cocktailName': {
-                    'S': cocktail_name
-                },
-                'count': {
-                    'N': '1'
-                }
-            }
-        )
\ No newline at end of file
+        #Keep the count until the cloud is back (covers the put too, so a failed create isn't lost either)
+        logger.warning('Could not update stats for %s, keeping it for later: %s', cocktail_name, e)
+        with pending_lock:
+            pending[cocktail_name] = pending.get(cocktail_name, 0) + count
+        return False
+    return True
+
+#Uploads the counts kept while the cloud was unreachable
+def flush_pending():
+    with pending_lock:
+        counts = dict(pending)
+        pending.clear()
+    names = list(counts.keys())
+    for i in range(0, len(names)):
+        if(not increment_cocktail(names[i], counts[names[i]])):
+            #The cloud is gone again: that count was kept by increment_cocktail, keep the rest without trying each of them
+            with pending_lock:
+                for name in names[i + 1:]:
+                    pending[name] = pending.get(name, 0) + counts[name]
+            logger.info('Uploaded stats kept while offline for %d of %d cocktails', i, len(names))
+            return
+    if(len(names) > 0):
+        logger.info('Uploaded stats kept while offline for %d cocktails', len(names))
+
+cloud.breaker.add_listener(flush_pending)
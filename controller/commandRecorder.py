@@ -0,0 +1,90 @@
+import json
+import os
+import logging
+import logging.handlers
+import queue
+import logConfig
+
+#Records every incoming REST and MQTT command, one compact json object per line, so bench/replayTrace.py can play it back.
+#REST: {"t": arrival unix time, "k": "rest", "m": method, "p": path, "r": route, "b": json body, "s": status, "d": seconds taken}
+#MQTT: {"t": arrival unix time, "k": "mqtt", "q": topic, "b": raw payload}
+
+command_logger = logging.getLogger('barbot.commands')
+command_logger.propagate = False #Commands only go to the trace file, never to stdout
+listener = None
+enabled = False
+excluded = set() #Routes that aren't recorded (e.g. metrics scrapes)
+
+#Formats the command attached to a log record as a compact json line
+class CommandFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.command, separators=(',', ':'), default=str)
+
+
+#Records a REST request
+def record_rest(timestamp, method, path, route, body, status, duration):
+    if(not enabled or route in excluded):
+        return
+    command_logger.info('', extra={'command': {
+        "t": round(timestamp, 4),
+        "k": 'rest',
+        "m": method,
+        "p": path,
+        "r": route,
+        "b": body,
+        "s": status,
+        "d": round(duration, 5)
+    }})
+
+#Records an MQTT message as it arrived
+def record_mqtt(timestamp, topic, payload):
+    if(not enabled):
+        return
+    if(isinstance(payload, bytes)):
+        payload = payload.decode('utf-8', 'replace')
+    command_logger.info('', extra={'command': {
+        "t": round(timestamp, 4),
+        "k": 'mqtt',
+        "q": topic,
+        "b": payload
+    }})
+
+#Sets up the rotating command trace file; settings is the optional 'recording' block of settings.json
+def setup_recording(settings=None):
+    global listener, enabled, excluded
+    if(settings is None):
+        settings = {}
+
+    if(listener is not None):
+        listener.stop()
+        listener = None
+
+    enabled = settings.get('enabled', False)
+    excluded = set(settings.get('exclude', ['/metrics']))
+    if(not enabled):
+        return
+
+    path = settings.get('path', './logs/commands.jsonl')
+    directory = os.path.dirname(path)
+    if(directory != '' and not os.path.exists(directory)):
+        os.makedirs(directory)
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=settings.get('maxBytes', 10*1024*1024), backupCount=settings.get('backupCount', 5))
+    file_handler.setFormatter(CommandFormatter())
+
+    command_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(command_queue, file_handler)
+    listener.start()
+
+    for handler in list(command_logger.handlers):
+        command_logger.removeHandler(handler)
+    command_logger.addHandler(logConfig.DeferredQueueHandler(command_queue))
+    command_logger.setLevel(logging.INFO)
+
+#Flushes and stops the command writer
+def stop_recording():
+    global listener
+    if(listener is not None):
+        listener.stop()
+        listener = None
@@ -0,0 +1,202 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import threading
+import logging
+import metrics
+
+#Hot reload of the controller config files.
+#The config directory is watched with inotify (through libc, so there is nothing to install; where inotify isn't available the files'
+#stamps are polled on the scheduler instead). Only the file that changed is parsed, and its handler validates the whole file before
+#applying any of it, so a bad push is rejected and logged and the running config stays as it was.
+#Files the controller writes itself are noted with note_write so they aren't reloaded.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080 #Files replaced atomically (written to a temporary file, then renamed)
+EVENT = struct.Struct('iIII') #wd, mask, cookie, name length
+
+logger = logging.getLogger(__name__)
+
+reloads = metrics.counter('barbot_config_reloads_total', 'Config file reloads by file and result (applied, rejected, deferred)', ['file', 'result'])
+
+watcher = None
+
+#Raised by a handler that can't apply a change right now (e.g. while pouring); the reload is tried again shortly
+class RetryLater(Exception):
+    pass
+
+
+#Gets the (size, mtime ns) stamp of a file, or None if it doesn't exist
+def get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+#Reads inotify events for a directory on its own thread and calls on_change(file name) for every file written or moved into it
+class InotifyWatcher():
+
+    def __init__(self, directory, on_change):
+        self.directory = directory
+        self.on_change = on_change
+        self.running = False
+        self.thread = None
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if(self.fd < 0):
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if(libc.inotify_add_watch(self.fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0):
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for ' + directory)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='config-watch', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if(self.thread is not None):
+            self.thread.join(2)
+        os.close(self.fd)
+
+    def run(self):
+        while self.running:
+            readable = select.select([self.fd], [], [], 1.0)[0]
+            if(len(readable) == 0):
+                continue
+            data = os.read(self.fd, 4096)
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                length = EVENT.unpack_from(data, offset)[3]
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += EVENT.size + length
+                try:
+                    self.on_change(name)
+                except Exception as e:
+                    logger.exception('Error handling change to %s', name)
+
+
+#Hot reloads config files: handlers maps each watched file name to a function taking the parsed json that validates and applies it
+#(raising ValueError to reject the file or RetryLater to try again)
+class ConfigWatcher():
+
+    def __init__(self, directory, handlers, scheduler, debounce=0.2, poll_interval=2.0):
+        self.directory = os.path.abspath(directory)
+        self.handlers = handlers
+        self.scheduler = scheduler
+        self.debounce = debounce #Seconds to wait for a burst of writes to one file to settle
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.stamps = {} #File name -> stamp of the version that is applied (or that the controller wrote itself)
+        self.status = {} #File name -> result of its last reload
+        self.inotify = None
+        self.poll_job = None
+        for name in handlers:
+            self.stamps[name] = get_stamp(self.get_path(name))
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def start(self):
+        try:
+            self.inotify = InotifyWatcher(self.directory, self.on_change)
+            self.inotify.start()
+            logger.info('Watching %s for config changes', self.directory)
+        except (OSError, AttributeError, TypeError) as e:
+            #No inotify (not Linux), so poll the stamps instead
+            logger.warning('inotify unavailable (%s), polling config files every %.1f s', e, self.poll_interval)
+            self.poll_job = self.scheduler.every(self.poll_interval, self.poll, 'config.poll')
+
+    def stop(self):
+        if(self.inotify is not None):
+            self.inotify.stop()
+            self.inotify = None
+        if(self.poll_job is not None):
+            self.poll_job.cancel()
+            self.poll_job = None
+
+    #Records a write the controller made itself so it isn't reloaded
+    def note_write(self, name):
+        if(name in self.handlers):
+            with self.lock:
+                self.stamps[name] = get_stamp(self.get_path(name))
+
+    #Called for every file written in the directory
+    def on_change(self, name):
+        if(name in self.handlers):
+            self.scheduler.once(self.debounce, lambda: self.reload(name), 'config.' + name)
+
+    def poll(self):
+        for name in self.handlers:
+            if(get_stamp(self.get_path(name)) != self.stamps.get(name)):
+                self.reload(name)
+
+    #Parses, validates and applies one file (runs on the scheduler)
+    def reload(self, name):
+        path = self.get_path(name)
+        stamp = get_stamp(path)
+        with self.lock:
+            if(stamp is None or stamp == self.stamps.get(name)):
+                return #Deleted, or already applied (including the controller's own writes)
+
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+            self.handlers[name](data)
+        except RetryLater as e:
+            self.status[name] = {"result": 'deferred', "error": str(e), "stamp": stamp[1]}
+            reloads.inc(1, {'file': name, 'result': 'deferred'})
+            logger.info('Deferring reload of %s: %s', name, e)
+            self.scheduler.once(max(1.0, self.debounce), lambda: self.reload(name), 'config.' + name)
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            #Keep the stamp of the rejected version so it's only reported once
+            with self.lock:
+                self.stamps[name] = stamp
+            self.status[name] = {"result": 'rejected', "error": str(e), "stamp": stamp[1]}
+            reloads.inc(1, {'file': name, 'result': 'rejected'})
+            logger.error('Rejected change to %s: %s', name, e)
+            return
+
+        with self.lock:
+            self.stamps[name] = get_stamp(path) #A handler may have written the file back
+        self.status[name] = {"result": 'applied', "error": None, "stamp": stamp[1]}
+        reloads.inc(1, {'file': name, 'result': 'applied'})
+        logger.info('Applied change to %s', name)
+
+    #Gets the result of the last reload of each file as a json friendly object
+    def to_dict(self):
+        return {
+            "directory": self.directory,
+            "mode": 'inotify' if self.inotify is not None else 'poll',
+            "files": {name: self.status.get(name) for name in self.handlers}
+        }
+
+
+#Starts watching the config files; settings is the optional 'configWatch' block of settings.json
+def setup_config_watch(settings, handlers, scheduler, directory='.'):
+    global watcher
+    if(settings is None or not settings.get('enabled', False)):
+        return None
+    watcher = ConfigWatcher(directory, handlers, scheduler, settings.get('debounce', 0.2), settings.get('pollInterval', 2.0))
+    watcher.start()
+    return watcher
+
+#Records a write the controller made to a config file (does nothing if the files aren't watched)
+def note_write(name):
+    if(watcher is not None):
+        watcher.note_write(name)
+
+def stop_config_watch():
+    global watcher
+    if(watcher is not None):
+        watcher.stop()
+        watcher = None
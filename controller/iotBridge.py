@@ -1,116 +1,365 @@
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient, AWSIoTMQTTClient
 import time
 import json
-from os import path
 import sys
 from datetime import datetime, timezone
-import schedule
 import threading
+import queue
+import uuid
+import metrics
+import tracing
+import commandRecorder
+import mqttTransport
+import telemetry
+import logging
 
-#Class manages interfacing with AWS IoT Core
+logger = logging.getLogger(__name__)
+
+mqtt_receive_delay = metrics.histogram('barbot_mqtt_receive_delay_seconds', 'Delay between an MQTT command being sent and received', ['action'], buckets=[0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0])
+mqtt_messages = metrics.counter('barbot_mqtt_messages_total', 'MQTT commands received by action and outcome', ['action', 'outcome'])
+mqtt_queue_wait = metrics.histogram('barbot_mqtt_queue_wait_seconds', 'Time an MQTT command waited for a dispatch worker', ['action'])
+mqtt_queue_depth = metrics.gauge('barbot_mqtt_queue_depth', 'MQTT commands waiting for a dispatch worker')
+
+#Class manages interfacing with AWS IoT Core (or any other MQTT transport from mqttTransport.py)
 class IoTManager():
 
-    #Initializes device details and creates IoT Core MQTT connection
-    def __init__(self, main):
+    #Initializes device details and creates the MQTT connection; transport_settings is the optional 'mqtt' block of settings.json
+    def __init__(self, main, dispatch_settings=None, transport_settings=None):
         self.main = main
-        self.iot_details = {}
-        self.thing_name = 'BarBot'
+        if(transport_settings is None):
+            transport_settings = {}
+        self.thing_name = transport_settings.get('thingName', 'BarBot')
         self.disabled = False #TODO: load this from the settings file
+        self.online = False #Whether the MQTT connection is currently up
 
-        schedule.every(30).seconds.do(self.ping)
+        self.shadow_lock = threading.Lock()
+        self.shadow_version = None #Version of the last shadow delta applied
+        self.applied_refresh = None #Last recipeRefresh value applied
+        self.delta_lock = threading.Lock()
+        self.pending_delta = None #Newest shadow delta not applied yet (kept out of the command queue so it can't be dropped)
 
-        alive_thread = threading.Thread(target=self.keep_alive, daemon=True)
-        alive_thread.start()
+        #Commands run on dispatch workers so the SDK's callback thread is never blocked by a pour
+        self.start_dispatch(dispatch_settings if dispatch_settings is not None else {})
 
-        if not path.exists('./certs/iotDetails.json'):
+        try:
+            transport = mqttTransport.create_transport(transport_settings)
+        except mqttTransport.TransportUnavailable as e:
             self.disabled = True
-            print('IoT files don\'t exist')
+            logger.warning('%s', e)
             return
-        
-        #Load AWS IoT Core details from json file
-        with open('./certs/iotDetails.json', 'r') as file:
-            self.iot_details = json.load(file)
+        self.connect(transport)
 
-        self.mqtt_client = AWSIoTMQTTClient('barbot')
-        self.mqtt_client.configureEndpoint(self.iot_details['endpoint'], 8883)
-        self.mqtt_client.configureCredentials('./certs/root-CA.crt', './certs/BarBot-private.pem.key', './certs/BarBot-certificate.pem.crt')
-
-        self.mqtt_client.configureOfflinePublishQueueing(-1)
-        self.mqtt_client.configureDrainingFrequency(2)
-        self.mqtt_client.configureConnectDisconnectTimeout(15)
-        self.mqtt_client.configureMQTTOperationTimeout(5)
+    #Connects over a transport, subscribes to commands and starts syncing the shadow
+    def connect(self, transport):
+        self.mqtt_client = transport
+        self.mqtt_client.set_connection_callbacks(self.on_online, self.on_offline)
 
         try:
             self.mqtt_client.connect()
-            self.mqtt_client.subscribe('barbot-main', 0, self.parse_message)
-            print('Connected to AWS IoT Core!')
+            self.disabled = False
+            self.online = True
+            self.mqtt_client.subscribe('barbot-main', self.parse_message)
 
-            #Setup Shadow handler
-            self.shadow_client = AWSIoTMQTTShadowClient('barbot-shadow')
-            self.shadow_client.configureEndpoint(self.iot_details['endpoint'], 8883)
-            self.shadow_client.configureCredentials('./certs/root-CA.crt', './certs/BarBot-private.pem.key', './certs/BarBot-certificate.pem.crt')
-            self.shadow_client.configureAutoReconnectBackoffTime(1, 32, 20)
-            self.shadow_client.configureConnectDisconnectTimeout(10)
-            self.shadow_client.configureMQTTOperationTimeout(5)
+            self.shadow_handler = self.mqtt_client.create_shadow_handler(self.thing_name)
 
-            self.shadow_client.connect()
-            print("Connected to BarBot's IoT Shadow")
+            #Keep config in sync with the shadow's desired state
+            self.start_shadow_sync()
 
-            self.shadow_handler = self.shadow_client.createShadowHandlerWithName(self.thing_name, True)
+            #Only ping once there is a connection to ping over
+            self.main.scheduler.every(30, self.ping, 'iot.ping', jitter=1.0)
         except Exception as e:
-            print(e)
+            logger.error('Error connecting to MQTT: %s', e)
             self.disabled = True
 
-    #Parses incoming message from MQTT topic and routes to proper function
+    #Starts the dispatch workers and the thread that publishes responses
+    def start_dispatch(self, settings):
+        self.command_queue = queue.Queue(maxsize=settings.get('queueSize', 20))
+        self.response_queue = queue.Queue()
+        mqtt_queue_depth.set_function(self.command_queue.qsize)
+
+        self.dispatch_workers = []
+        for i in range(0, settings.get('workers', 2)):
+            worker = threading.Thread(target=self.dispatch_worker, name='mqtt-dispatch-' + str(i), daemon=True)
+            worker.start()
+            self.dispatch_workers.append(worker)
+
+        responder = threading.Thread(target=self.response_worker, name='mqtt-responses', daemon=True)
+        responder.start()
+
+    #Parses incoming message from MQTT topic and hands it to the dispatch workers (runs on the SDK's callback thread, so it must not block)
     def parse_message(self, client, userdata, message):
-        print('PARSE MESSAGE')
+        logger.debug('PARSE MESSAGE')
         if(self.disabled):
             return
+        commandRecorder.record_mqtt(time.time(), message.topic, message.payload)
         
         try:
             real_message = json.loads(message.payload)
             action = real_message['action']
-            print('Received MQTT message with action: ' + str(action))
-            if('data' in real_message):
-                data = real_message['data']
+            data = real_message.get('data')
+            command_id = str(real_message.get('id', uuid.uuid4().hex[:12]))
+            trace_id, parent_id = tracing.parse_traceparent(real_message.get('traceparent'))
+        except Exception as e:
+            logger.exception('Error decoding MQTT message')
+            return
 
-            time_recv = real_message['time']
-            time_delay = int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()) - time_recv
+        with tracing.start_trace('MQTT ' + str(action), {'mqtt.topic': message.topic, 'mqtt.action': str(action), 'mqtt.id': command_id}, trace_id, parent_id) as span:
+            try:
+                logger.info('Received MQTT message with action: %s', action, extra={'data': {'id': command_id}})
 
-            if(time_delay > 5):
-                print('Message took too long to receive')
-                return
+                time_recv = real_message['time']
+                now = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+                time_delay = int(now) - time_recv
+                mqtt_receive_delay.observe(now - time_recv, {'action': action})
 
-            if(action == 'makeCocktail'):
-                #print('Making cocktail: ' + str(data.lower()))
-                self.main.make_cocktail(data.lower())
-            elif(action == 'alcoholMode'):
-                if(data == True or data == False):
-                    self.main.set_alcohol_mode(data)
+                if(time_delay > 5):
+                    logger.warning('Message took too long to receive', extra={'data': {'action': action, 'id': command_id, 'delay': now - time_recv}})
+                    mqtt_messages.inc(1, {'action': action, 'outcome': 'expired'})
+                    self.send_ack(command_id, action, 'expired')
+                    return
+
+                if(self.queue_command(command_id, action, data, span)):
+                    mqtt_messages.inc(1, {'action': action, 'outcome': 'accepted'})
+                    self.send_ack(command_id, action, 'queued')
                 else:
-                    print('Not a valid alcoholMode setting!')
-            elif(action == 'getMenu'):
-                cocktail_array = self.main.get_cocktail_list()
-                ret_package = {
-                    'state': {
-                        'desired': {
-                            'menu': cocktail_array
-                        }
+                    mqtt_messages.inc(1, {'action': action, 'outcome': 'rejected'})
+                    self.send_ack(command_id, action, 'rejected')
+            except Exception as e:
+                logger.exception('Error handling MQTT message')
+
+    #Hands a command to the dispatch workers; gets False if the queue is full
+    def queue_command(self, command_id, action, data, span=None):
+        command = {
+            "id": command_id,
+            "action": action,
+            "data": data,
+            "received": time.monotonic(),
+            "span": span
+        }
+        try:
+            self.command_queue.put_nowait(command)
+        except queue.Full:
+            logger.warning('MQTT dispatch queue is full', extra={'data': {'action': action, 'id': command_id}})
+            return False
+        return True
+
+    #Runs queued MQTT commands and publishes their result
+    def dispatch_worker(self):
+        while True:
+            command = self.command_queue.get()
+            if(command is None):
+                break
+
+            mqtt_queue_wait.observe(time.monotonic() - command['received'], {'action': command['action']})
+            status = 'done'
+            result = None
+            with tracing.span('mqtt.dispatch', {'mqtt.action': str(command['action']), 'mqtt.id': command['id']}, parent=command['span']):
+                try:
+                    result = self.route_message(command['action'], command['data'])
+                except Exception as e:
+                    logger.exception('Error handling MQTT message')
+                    status = 'error'
+
+            response = {
+                "action": "result",
+                "id": command['id'],
+                "command": command['action'],
+                "status": status
+            }
+            if(isinstance(result, (str, bool))):
+                response['result'] = result
+            self.send_response(response)
+
+    #Acknowledges an MQTT command (queued, rejected or expired)
+    def send_ack(self, command_id, action, status):
+        self.send_response({
+            "action": "ack",
+            "id": command_id,
+            "command": action,
+            "status": status
+        })
+
+    #Stops the dispatch workers once the commands already queued are done
+    def stop_dispatch(self):
+        for worker in self.dispatch_workers:
+            self.command_queue.put(None)
+        self.response_queue.put(None)
+
+    #Runs the Main function for an MQTT action; gets its result
+    def route_message(self, action, data):
+        if(action == 'makeCocktail'):
+            return self.main.make_cocktail(data.lower())
+        elif(action == 'alcoholMode'):
+            if(data == True or data == False):
+                self.main.set_alcohol_mode(data)
+                return 'true'
+            else:
+                logger.warning('Not a valid alcoholMode setting!')
+                return 'false'
+        elif(action == 'getMenu'):
+            cocktail_array = self.main.get_cocktail_list()
+            ret_package = {
+                'state': {
+                    'desired': {
+                        'menu': cocktail_array
                     }
                 }
-                
-                #Update the shadow
-                self.update_shadow(ret_package)
-            elif(action == 'message'):
-                print(data)
-            elif(action == 'pumpOn'):
-                self.main.pump_on(int(data))
-            elif(action == 'pumpOff'):
-                self.main.pump_off(int(data))
+            }
+            
+            #Update the shadow
+            self.update_shadow(ret_package)
+            return 'true'
+        elif(action == 'message'):
+            logger.info('%s', data)
+            return 'true'
+        elif(action == 'pumpOn'):
+            self.main.pump_on(int(data))
+            return 'true'
+        elif(action == 'pumpOff'):
+            self.main.pump_off(int(data))
+            return 'true'
+        elif(action == 'shadowDelta'):
+            return self.apply_pending_delta()
+        return 'unknown'
+
+    #Subscribes to shadow deltas, reports the config this device has now and fetches anything it missed while offline
+    def start_shadow_sync(self):
+        self.shadow_handler.shadowRegisterDeltaCallback(self.shadow_delta_callback)
+        self.report_config()
+        self.shadow_handler.shadowGet(self.shadow_get_callback, 5)
+
+    #Gets the config state that is synced through the shadow
+    def get_config_state(self):
+        return {
+            "alcoholMode": self.main.alcohol_mode,
+            "ignoreList": sorted(self.main.ignore_list)
+        }
+
+    #Reports the config this device has applied
+    def report_config(self):
+        self.update_shadow({'state': {'reported': self.get_config_state()}})
+
+    #Called by the SDK when desired state differs from reported state (runs on the SDK's callback thread, so it only queues the delta)
+    def shadow_delta_callback(self, payload, response_status, token):
+        try:
+            delta = json.loads(payload)
         except Exception as e:
-            print(e)
+            logger.error('Error decoding shadow delta: %s', e)
+            return
+        self.queue_shadow_delta('delta-' + str(delta.get('version')), {'version': delta.get('version'), 'state': delta.get('state', {})})
+
+    #Called with the full shadow after connecting; applies whatever changed while this device was offline
+    def shadow_get_callback(self, payload, response_status, token):
+        if(response_status != 'accepted'):
+            logger.warning('Could not get shadow: %s', response_status)
+            return
+        try:
+            document = json.loads(payload)
+        except Exception as e:
+            logger.error('Error decoding shadow: %s', e)
+            return
+
+        state = document.get('state', {})
+        delta = state.get('delta', {})
+        self.queue_shadow_delta('get-' + str(document.get('version')), {'version': document.get('version'), 'state': delta, 'reported': state.get('reported', {})})
+
+    #Keeps a shadow delta in the pending slot (replacing any older one there) and queues a command to apply it
+    def queue_shadow_delta(self, command_id, delta):
+        with self.delta_lock:
+            pending = self.pending_delta
+            if(pending is not None and pending.get('version') is not None and delta.get('version') is not None and pending['version'] > delta['version']):
+                return #A newer delta is already waiting
+            if(pending is not None and 'reported' in pending and 'reported' not in delta):
+                delta['reported'] = pending['reported']
+            self.pending_delta = delta
+        self.flush_shadow_delta(command_id)
+
+    #Queues a command to apply the pending shadow delta; if the queue is full the delta stays pending and this is tried again shortly
+    def flush_shadow_delta(self, command_id='delta-retry'):
+        with self.delta_lock:
+            if(self.pending_delta is None):
+                return
+        if(not self.queue_command(command_id, 'shadowDelta', None)):
+            logger.warning('Shadow delta not queued (dispatch queue full); retrying in 1 s')
+            self.main.scheduler.once(1.0, self.flush_shadow_delta, 'iot.shadowDelta')
+
+    #Applies the pending shadow delta (a command that finds the slot empty had its delta applied by an earlier one)
+    def apply_pending_delta(self):
+        with self.delta_lock:
+            delta = self.pending_delta
+            self.pending_delta = None
+        if(delta is None):
+            return 'stale'
+        try:
+            return self.apply_shadow_delta(delta)
+        except Exception:
+            #Put it back for the next try unless a newer delta arrived meanwhile
+            with self.delta_lock:
+                if(self.pending_delta is None):
+                    self.pending_delta = delta
+            self.main.scheduler.once(1.0, self.flush_shadow_delta, 'iot.shadowDelta')
+            raise
+
+    #Applies desired config from the shadow to Main (idempotent; older versions than the last one applied are ignored) and reports it back
+    def apply_shadow_delta(self, delta):
+        with self.shadow_lock:
+            version = delta.get('version')
+            if(version is not None and self.shadow_version is not None and version <= self.shadow_version):
+                logger.debug('Ignoring stale shadow delta %s (applied %s)', version, self.shadow_version)
+                return 'stale'
+
+            if('recipeRefresh' in delta.get('reported', {}) and self.applied_refresh is None):
+                self.applied_refresh = delta['reported']['recipeRefresh']
+
+            state = delta.get('state', {})
+            reported = {}
+
+            if(isinstance(state.get('alcoholMode'), bool)):
+                if(state['alcoholMode'] != self.main.alcohol_mode):
+                    self.main.set_alcohol_mode(state['alcoholMode'])
+                reported['alcoholMode'] = state['alcoholMode']
+
+            if(isinstance(state.get('ignoreList'), list)):
+                self.main.set_ignore_list(state['ignoreList'])
+                reported['ignoreList'] = sorted(self.main.ignore_list)
+
+            #Any new value of recipeRefresh (e.g. a timestamp) triggers one refresh
+            if('recipeRefresh' in state):
+                if(state['recipeRefresh'] != self.applied_refresh):
+                    self.main.refresh('recipes')
+                    self.applied_refresh = state['recipeRefresh']
+                reported['recipeRefresh'] = state['recipeRefresh']
+
+            if(version is not None):
+                self.shadow_version = version
+
+        if(len(reported) > 0):
+            logger.info('Applied shadow config', extra={'data': {'version': version, 'reported': reported}})
+            self.update_shadow({'state': {'reported': reported}})
+        return 'true'
+
+    #Called by the SDK when the MQTT connection comes up
+    def on_online(self):
+        self.online = True
+        logger.info('MQTT connection online')
+        telemetry.flush_soon() #Send anything spooled while offline
+
+    #Called by the SDK when the MQTT connection drops
+    def on_offline(self):
+        self.online = False
+        logger.warning('MQTT connection offline')
+
+    #Whether telemetry can be published right now
+    def is_online(self):
+        return not self.disabled and self.online
+
+    #Publishes a compressed telemetry batch
+    def publish_telemetry(self, topic, payload):
+        if(not self.is_online()):
+            return False
+        return self.mqtt_client.publish(topic, bytearray(payload))
 
     #Updates BarBot's IoT shadow    
+    @tracing.traced('iot.update_shadow')
     def update_shadow(self, json_data):
         if(self.disabled):
             return
@@ -121,25 +370,35 @@ class IoTManager():
         if(self.disabled):
             return
         if(response_status == 'timeout'):
-            print('There was a timeout updating the shadow')
+            logger.warning('There was a timeout updating the shadow')
         elif(response_status == 'accepted'):
-            print("Successfully updated barbot's shadow")
+            logger.debug("Successfully updated barbot's shadow")
         elif(response_status == 'rejected'):
-            print("Shadow update was rejected")
-            print(payload)
+            logger.warning('Shadow update was rejected: %s', payload)
 
-    #Send a message to response MQTT topic
+    #Send a message to response MQTT topic (published by the response thread, never from the SDK's callback thread)
     def send_response(self, data):
-        self.mqtt_client.publish('barbot-res', json.dumps(data), 0)
-        print('Sending ping')
+        self.response_queue.put(data)
+
+    #Publishes queued responses
+    def response_worker(self):
+        while True:
+            data = self.response_queue.get()
+            if(data is None):
+                break
+            if(self.disabled):
+                continue
+            try:
+                self.mqtt_client.publish('barbot-res', json.dumps(data))
+                logger.debug('Sent response: %s', data.get('action'))
+            except Exception as e:
+                logger.error('Error publishing MQTT response: %s', e)
 
+    #Lets the cloud know BarBot is online (run every 30 seconds by the controller scheduler)
     def ping(self):
+        if(self.disabled):
+            return
         data = {
             "action": "ping"
         }
-        self.send_response(data)
-
-    def keep_alive(self):
-        while(True):
-            schedule.run_pending()
-            time.sleep(15)
\ No newline at end of file
+        self.send_response(data)
\ No newline at end of file
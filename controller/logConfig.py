@@ -0,0 +1,139 @@
+import logging
+import logging.handlers
+import queue
+import json
+import sys
+import time
+
+listener = None #QueueListener that formats and writes records off the calling threads
+record_filters = [] #Filters for the root handler, kept across setup_logging calls (e.g. the tracing trace id stamp)
+IMMUTABLE = (str, bytes, int, float, bool, type(None)) #Log arguments that can't change before the listener formats them
+
+#Queue handler that hands the raw record to the listener, so message formatting usually happens off the calling thread.
+#The trade-off is that arguments are only rendered later, so a dict, list or other object the caller changes in the meantime
+#would be logged as it is then. Records with such arguments are formatted on the calling thread instead, and the 'data' extra
+#is copied; records with only plain string and number arguments (most of them) are still deferred.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        if(record.args):
+            values = record.args.values() if isinstance(record.args, dict) else record.args
+            if(not all(isinstance(value, IMMUTABLE) for value in values)):
+                record.msg = record.getMessage()
+                record.args = None
+        if(isinstance(getattr(record, 'data', None), dict)):
+            record.data = dict(record.data)
+        return record
+
+
+#Formats records as one json object per line
+class StructuredFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage()
+        }
+
+        #Extra structured fields passed as logger.info(..., extra={'data': {...}})
+        if(isinstance(getattr(record, 'data', None), dict)):
+            data.update(record.data)
+
+        #Trace id stamped on the calling thread by the tracing filter
+        if(getattr(record, 'traceId', None) is not None):
+            data['traceId'] = record.traceId
+
+        if(record.exc_info):
+            data['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + ('.%03d' % record.msecs)
+
+
+#Sets up leveled logging for the controller; settings is the optional 'logging' block of settings.json
+def setup_logging(settings=None):
+    global listener
+    if(settings is None):
+        settings = {}
+
+    if(listener is not None):
+        listener.stop()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if(settings.get('structured', True)):
+        stream_handler.setFormatter(StructuredFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = DeferredQueueHandler(log_queue)
+    for record_filter in record_filters:
+        handler.addFilter(record_filter)
+    root.addHandler(handler)
+    root.setLevel(settings.get('level', 'INFO'))
+
+    #Per-module levels, e.g. {"main": "DEBUG"}
+    levels = settings.get('levels', {})
+    for name in levels:
+        logging.getLogger(name).setLevel(levels[name])
+
+    return listener
+
+
+#Adds a filter to the root handler, now and whenever setup_logging replaces it (runs on the calling thread, before the record is queued)
+def add_record_filter(record_filter):
+    if(record_filter not in record_filters):
+        record_filters.append(record_filter)
+    for handler in logging.getLogger().handlers:
+        if(record_filter not in handler.filters):
+            handler.addFilter(record_filter)
+
+#Replaces the queue handler with a direct one (used in forked processes, where the listener thread doesn't exist)
+def setup_child_logging():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter())
+    root.addHandler(stream_handler)
+
+
+#Sets the level of a logger at runtime ('' or 'root' for the root logger)
+def set_level(name, level):
+    if(name == 'root'):
+        name = ''
+    level = str(level).upper()
+    if(level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', 'NOTSET')):
+        raise ValueError('Unknown log level: ' + level)
+    logging.getLogger(name).setLevel(level)
+
+
+#Gets the configured level of the root logger and every module logger that has one
+def get_levels():
+    levels = {
+        "root": logging.getLevelName(logging.getLogger().level)
+    }
+    for name, logger in list(logging.Logger.manager.loggerDict.items()):
+        if(isinstance(logger, logging.Logger) and logger.level != logging.NOTSET):
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+#Flushes and stops the background listener
+def stop_logging():
+    global listener
+    if(listener is not None):
+        listener.stop()
+        listener = None
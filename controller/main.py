@@ -3,44 +3,84 @@ import time
 import tkinter as tk
 import traceback
 import threading
-from recipe import upload_recipe, get_recipe, get_all_recipes
+from recipe import upload_recipe, get_recipe, scan_recipes, recipe_cache
+from recipeImport import BulkImporter
+from catalogSnapshot import SnapshotBuilder, RecipeView, load_snapshot, read_header, get_stamp
+from barModel import Pump, Bottle, attach_bottle, detach_bottle, format_volume
 from utils import name_to_upper
 from cocktailStats import increment_cocktail
+from pourTimeline import PourTimeline
+from pumpWorker import PumpWorkerPool
+from pourProcess import PourProcess
+from pourTiming import PourTimingStats
+from scheduler import Scheduler
+from refreshPipeline import RefreshPipeline
+import metrics
+import tracing
+import telemetry
+import configWatcher
+import logging
 import json
+import os
 import subprocess
-from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+order_latency = metrics.histogram('barbot_order_seconds', 'Cocktail order latency by phase', ['phase'])
+orders_total = metrics.counter('barbot_orders_total', 'Cocktail orders by result', ['result'])
+order_queue_depth = metrics.gauge('barbot_order_queue_depth', 'Cocktail orders currently waiting or pouring')
+file_write_latency = metrics.histogram('barbot_file_write_seconds', 'Time taken to write a local config file', ['file'])
+abort_latency = metrics.histogram('barbot_abort_latency_seconds', 'Time from abort trigger until every pin was off', buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0])
+bottle_volume = metrics.gauge('barbot_bottle_volume_ml', 'Current volume of each bottle on a pump', ['bottle'])
 
 #This is the class where BarBot's primary functionality is defined
 class Main():
 
-    #Initialize all class variables
-    def __init__(self):
+    #Initialize all class variables; pour_process is the PourProcess started by start_pour_process, if there is one
+    def __init__(self, pour_process=None):
         self.polarity_pins = []
         self.pressure_pins = []
         self.abort_pins = [] #In, out
         self.polarity_normal = True
-        self.cocktail_ingredients = {}
-        self.cocktail_amounts = {}
+        self.recipes = {} #Cocktail name -> Recipe
         self.cocktail_buttons = {}
         self.cocktail_available = {}
+        self.servings = {} #Available cocktail name -> servings the bottles can still pour (None if no bottle limits it)
+        self.ingredient_users = {} #Ingredient -> available cocktails that pour it, so a volume change only recounts those
         self.ignore_list = set()
         self.alcohol_list = set()
         self.alcohol_mode = False
         self.new_bottles = set()
-        self.pump_map = {}
-        self.pump_data = {}
+        self.bottles = {} #Bottle name -> Bottle on a pump
+        self.pumps = {} #Pump number -> Pump
         self.cocktail_count = 0
+        self.catalog = None #Memory-mapped CatalogSnapshot of cocktails.json
         self.clean_time = 8  #Regular Time: 12 seconds
         self.shot_volume = 44.36 #mL
         self.busy_flag = False
+        self.busy_lock = threading.Lock() #Guards checking and setting busy_flag (commands are dispatched on more than one thread)
         self.window = None
-        self.start_time = 0.0 #Time that pumps started
-        self.abort_time = 0.0 #Time that abort was triggered
         self.current_cocktail = '' #Name of cocktail being made
+        self.current_timeline = None #PourTimeline of the pour in progress
+        self.pump_workers = None #Owner of every pump/pressure pin (PumpWorkerPool or PourProcess)
+        self.pour_process = pour_process
+        self.pour_process_settings = {}
+        self.pour_timing = PourTimingStats() #Edge log and timing accuracy histograms for every pump
+        self.scheduler = Scheduler() #Shared timer for every periodic/one-shot housekeeping job
+        self.refresh_pipeline = self.create_refresh_pipeline() #Recomputes only the state that depends on what changed
+        self.recipe_lock = threading.Lock() #One recipe refresh at a time (they all stream into cocktails.json.tmp)
+        bottle_volume.set_function(self.get_bottle_volumes)
+        self.abort_lock = threading.Lock()
+        self.abort_stats = {
+            "count": 0,
+            "lastLatency": None, #Seconds from abort trigger until every pin was off
+            "maxLatency": 0.0,
+            "lastRefund": {} #mL refunded per ingredient by the last abort
+        }
 
         #Configure hardware and load data from cloud & local config files
         self.load_settings() #Load settings file
-        self.load_pump_config() #Load configuration of pumpMap and pumpData
+        self.load_pump_config() #Load the pumps and the bottles on them
         self.setup_pins() #Setup GPIO pins
         self.load_new_bottles() #Load bottle list from local file
         self.load_alcohol_list() #Load list of ingredients listed as alcohol
@@ -51,13 +91,13 @@ class Main():
     #Sets up pins by setting gpio mode and setting initial output
     def setup_pins(self):
         try:
-            print("Setting up pump pins...")
+            logger.info('Setting up pump pins...')
             GPIO.setmode(GPIO.BCM)
 
             #Set all peristaltic pump relay pins to HIGH (turns pumps off)
-            for pump in self.pump_data:
-                GPIO.setup(self.pump_data[pump]['gpio'], GPIO.OUT)
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.HIGH)
+            for pump in self.pumps.values():
+                GPIO.setup(pump.gpio, GPIO.OUT)
+                GPIO.output(pump.gpio, GPIO.HIGH)
 
             #Turn off signal for #1 relay
             GPIO.setup(self.polarity_pins[0], GPIO.OUT)
@@ -72,39 +112,113 @@ class Main():
                 GPIO.setup(self.pressure_pins[pump], GPIO.OUT)
                 GPIO.output(self.pressure_pins[pump], GPIO.HIGH)
 
-            #Setup abort pins
-            #GPIO.setup(self.abort_pins[0], GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-            #GPIO.add_event_detect(self.abort_pins[0], GPIO.RISING, callback=self.abort_pumps, bouncetime=200)
+            #Hand every pump and pressure pin to its owner (only the owner ever writes to the pin)
+            if(self.pour_process_settings.get('enabled', False)):
+                if(self.pour_process is None):
+                    #Only when Main is built on its own (e.g. the benchmarks); threads are already running by now
+                    logger.info('Starting pour process...')
+                    self.pour_process = PourProcess(self.pour_process_settings.get('priority', 0), self.pour_process_settings.get('cpu', None))
+                self.pour_process.edge_listener = self.pour_timing.record_edge
+                self.pump_workers = self.pour_process
+            else:
+                self.pump_workers = PumpWorkerPool(self.set_pin, self.pour_timing.record_edge)
+
+            for pump in self.pumps.values():
+                self.pump_workers.add(pump.gpio, pump.num)
+            for pump in self.pressure_pins:
+                self.pump_workers.add(self.pressure_pins[pump], 'pressure-' + str(pump))
+
+            #Setup abort pins (abort button triggers an interrupt on the rising edge)
+            if(len(self.abort_pins) > 0):
+                GPIO.setup(self.abort_pins[0], GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+                GPIO.add_event_detect(self.abort_pins[0], GPIO.RISING, callback=self.abort_pumps, bouncetime=200)
 
-            print("Pins successfully setup!")
+            logger.info('Pins successfully setup!')
         except Exception as e:
-            print("Error setting up pump pins: " + str(e))
+            logger.error('Error setting up pump pins: %s', e)
             exit(1)
 
 
     #Load pump configuration
+    @tracing.traced('main.load_pump_config')
     def load_pump_config(self):
         data = []
         with open('pumpConfig.json', 'r') as file:
             data = json.load(file)
 
-        #Save data into class variable
-        for pump in data:
-            self.pump_data[pump['pumpNum']] = {
-                "pumpNum": pump['pumpNum'],
-                "gpio": pump['gpio'],
-                "type": pump['type'],
-                "pumpTime": pump['pumpTime']
-            }
+        self.pumps, self.bottles = self.parse_pump_config(data)
+
+    #Builds the pumps and the bottles on them from the pumpConfig.json entries; raises ValueError if they aren't valid
+    def parse_pump_config(self, data):
+        if(not isinstance(data, list)):
+            raise ValueError('pumpConfig.json must hold a list of pumps')
+
+        #Volumes are stored as strings in the file
+        pumps = {}
+        bottles = {}
+        for entry in data:
+            if(not isinstance(entry.get('pumpNum'), int) or not isinstance(entry.get('gpio'), int)):
+                raise ValueError('Pump numbers and pins must be integers')
+            if(entry['pumpNum'] in pumps):
+                raise ValueError('Pump ' + str(entry['pumpNum']) + ' is listed twice')
+            if(entry.get('type') not in ('regular', 'soda')):
+                raise ValueError('Unknown type for pump ' + str(entry['pumpNum']) + ': ' + str(entry.get('type')))
+            pump = Pump(entry['pumpNum'], entry['gpio'], entry['type'], entry['pumpTime'])
+            if(pump.pump_time <= 0):
+                raise ValueError('Pump time must be positive for pump ' + str(pump.num))
+            if(pump.type == 'soda' and str(pump.num) not in self.pressure_pins):
+                raise ValueError('Soda pump ' + str(pump.num) + ' has no pressure pin in settings.json')
+            pumps[pump.num] = pump
+
+            #Make sure there is a bottle on the pump before adding it
+            if(entry.get('currentBottle', {}) != {}):
+                bottle = Bottle(entry['currentBottle']['name'], entry['currentBottle']['volume'], entry['currentBottle']['originalVolume'])
+                if(bottle.name in bottles):
+                    raise ValueError(bottle.name + ' is on more than one pump')
+                if(bottle.volume < 0 or bottle.original_volume < 0):
+                    raise ValueError('Negative volume for ' + bottle.name)
+                attach_bottle(bottle, pump)
+                bottles[bottle.name] = bottle
+
+        return pumps, bottles
+
+    #Applies a pumpConfig.json edited on disk (bottles, volumes and calibration; pin changes need a restart)
+    def apply_pump_config(self, data):
+        pumps, bottles = self.parse_pump_config(data)
+        if({num: pump.gpio for num, pump in pumps.items()} != {num: pump.gpio for num, pump in self.pumps.items()}):
+            raise ValueError('Pumps or pins changed; restart BarBot to apply them')
+
+        #run_lock first (a running refresh may hold it for a while), then busy_lock only for the check and the swap, so a pour can't
+        #start in between and pour from the old bottles, and claim_busy never waits behind a refresh
+        with self.refresh_pipeline.run_lock:
+            with self.busy_lock:
+                if(self.busy_flag):
+                    raise configWatcher.RetryLater('pouring')
+                self.pumps = pumps
+                self.bottles = bottles
+        self.refresh('bottles')
+
+    #Applies an alcohol.json edited on disk
+    def apply_alcohol_list(self, data):
+        if(not isinstance(data, dict) or not all(isinstance(value, bool) for value in data.values())):
+            raise ValueError('alcohol.json must map ingredients to true or false')
+        self.alcohol_list = set(key for key in data if data[key])
+        self.refresh('alcohol')
+
+    #Applies an ignoreList.json edited on disk
+    def apply_ignore_list(self, data):
+        if(not isinstance(data, list) or not all(isinstance(item, str) for item in data)):
+            raise ValueError('ignoreList.json must be a list of ingredients')
+        self.ignore_list = set(data)
+        self.refresh('ignore')
 
-            #Make sure there is a bottle on the pump before adding to pump_map
-            if(pump['currentBottle'] != {}):
-                self.pump_map[pump['currentBottle']['name']] = {
-                    "name": pump['currentBottle']['name'],
-                    "volume": pump['currentBottle']['volume'],
-                    "originalVolume": pump['currentBottle']['originalVolume'],
-                    "pumpNum": pump['pumpNum'] #NOTE: Should be removed before writing back to file
-                }
+    #Checks the settings Main uses from a settings.json edited on disk (the pins and pour process can only change with a restart)
+    def apply_settings(self, data):
+        for key in ('polarityPins', 'pressurePins', 'abortPins'):
+            if(key not in data):
+                raise ValueError('settings.json is missing ' + key)
+        if(data['polarityPins'] != self.polarity_pins or data['pressurePins'] != self.pressure_pins or data['abortPins'] != self.abort_pins or data.get('pourProcess', {}) != self.pour_process_settings):
+            logger.warning('Pins or pourProcess changed in settings.json; restart BarBot to apply them')
 
     #Loads settings from file
     def load_settings(self):
@@ -115,79 +229,219 @@ class Main():
         self.polarity_pins = data['polarityPins']
         self.pressure_pins = data['pressurePins']
         self.abort_pins = data['abortPins']
+        self.pour_process_settings = data.get('pourProcess', {}) #Optional isolated process for pump timing
 
 
     #Test function that runs all of the pumps for 3 seconds each
     def test_pumps(self):
         try:
-            for pump in self.pump_data:
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.LOW)
-                print("Turning on pin " + str(pump['gpio']))
-                time.sleep(3)
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.HIGH)
-                time.sleep(1)
+            for pump in self.pumps.values():
+                logger.info('Turning on pin %s', pump.gpio)
+                self.pump_workers.on(pump.gpio, 3)
+                time.sleep(4)
         except KeyboardInterrupt:
-            print('Exitting early')
+            logger.info('Exitting early')
             GPIO.cleanup()
             exit()
 
-    #Load cocktails from local recipe cache file
-    def load_cocktails(self):
-        data = {}
-        with open('cocktails.json', 'r') as file:
-            data = json.load(file)
+    #Builds the refresh pipeline: which derived state depends on which data source
+    #  bottles  which bottle is on which pump          recipes  the recipes in the cloud
+    #  alcohol, ignore, mode  alcohol list, ignore list and alcohol mode
+    #Volume and calibration changes aren't a source: pours write pumpConfig.json directly so they never wait behind a running refresh
+    def create_refresh_pipeline(self):
+        pipeline = RefreshPipeline()
+        for source in ('bottles', 'recipes', 'alcohol', 'ignore', 'mode'):
+            pipeline.add_source(source)
+        pipeline.add_step('pumpConfig', ['bottles'], self.write_pump_data)
+        pipeline.add_step('catalog', ['recipes'], self.refresh_catalog)
+        pipeline.add_step('menu', ['bottles', 'alcohol', 'ignore', 'mode', 'catalog'], self.update_availability)
+        return pipeline
+
+    #Catalog refresh step; raises when the scan fails, so 'recipes' is kept as failed (scanned again by the next refresh('recipes')) and
+    #the menu keeps using the local catalog
+    def refresh_catalog(self):
+        if(not self.update_local_recipes(check_availability=False)):
+            raise RuntimeError('Recipe scan failed')
+
+    #Recomputes the state that depends on the changed data sources (see create_refresh_pipeline)
+    @tracing.traced('main.refresh')
+    def refresh(self, *sources):
+        try:
+            self.refresh_pipeline.run(*sources)
+        except Exception as e:
+            logger.exception('Error refreshing after changes to %s', ', '.join(sources))
+            return 'error'
+        return 'true'
 
-        self.cocktail_available = {}
-        self.cocktail_amounts = {}
-        self.cocktail_ingredients = {}
-        i = 0
-        #Loads all cocktail details into separate python objects
-        for cocktails in data['cocktails']:
-            cocktail_name = str(data['cocktails'][i]['name'])
-            self.cocktail_ingredients[cocktail_name] = data['cocktails'][i]['ingredients']
-            self.cocktail_amounts[cocktail_name] = data['cocktails'][i]['amounts']
-            self.cocktail_available[cocktail_name] = self.is_available(cocktail_name)
-            print(cocktail_name + " available: " + str(self.cocktail_available[cocktail_name]))
-            i = i+1
-        self.cocktail_count = i
-
-
-    #Aborts all pump functions
-    def abort_pumps(self, channel):
-        print('ABORTING ALL FUNCTIONS')
-        self.abort_time = datetime.now().timestamp()
-        #Turns off all pumps and solenoids
-        for pump_num in self.pump_data:
-            pin = self.pump_data[pump_num]['gpio']
-            GPIO.output(pin, GPIO.HIGH)
-        
-        #Turns of all pressure pumps
-        for press_pin in self.pressure_pins:
-            GPIO.output(pin, GPIO.HIGH)
+    #Rebuilds everything: reloads every local file, scans the cloud recipes and recomputes the menu (admin operation)
+    @tracing.traced('main.rebuild_all')
+    def rebuild_all(self):
+        try:
+            logger.info('Rebuilding all cocktail files...')
+            self.write_pump_data()
+            self.load_pump_config()
+            self.load_alcohol_list()
+            self.load_ignore_list()
+            self.refresh_pipeline.mark_all()
+            self.refresh_pipeline.run()
+        except Exception as e:
+            logger.exception('Error rebuilding cocktail files')
+            return 'error'
+        return 'true'
+
+    #Load cocktails from the snapshot of the local recipe cache file (compiled from cocktails.json only when that file changed)
+    @tracing.traced('main.load_cocktails')
+    def load_cocktails(self, check_availability=True):
+        self.catalog = load_snapshot('cocktails.json', 'cocktails.bin')
+        self.recipes = RecipeView(self.catalog)
+        self.cocktail_count = len(self.catalog)
+        if(check_availability):
+            self.update_availability()
+
+    #Works out which cocktails of the loaded catalog can be made with the bottles on the pumps
+    def update_availability(self):
+        #Work out once which interned ingredients are on hand, then check each recipe by ingredient id without decoding it
+        on_hand = [i in self.bottles or i in self.ignore_list for i in self.catalog.ingredient_names]
+        alcohol = [i in self.alcohol_list for i in self.catalog.ingredient_names]
+        cocktail_available = {}
+        for cocktail_name, index in self.catalog.load_index().items():
+            cocktail_available[cocktail_name] = self.ids_available(self.catalog.get_ingredient_ids(index), on_hand, alcohol)
+        self.cocktail_available = cocktail_available
+        logger.debug('%d of %d cocktails available', sum(cocktail_available.values()), self.cocktail_count)
+        self.update_all_servings()
+
+    #Counts the servings of every available cocktail and indexes which of them pour each ingredient
+    def update_all_servings(self):
+        servings = {}
+        users = {}
+        for cocktail_name, available in self.cocktail_available.items():
+            if(not available):
+                continue
+            for ingredient, amount in self.get_poured_items(cocktail_name):
+                users.setdefault(ingredient, []).append(cocktail_name)
+            servings[cocktail_name] = self.count_servings(cocktail_name)
+        self.ingredient_users = users
+        self.servings = servings
+
+    #Recounts the servings of only the cocktails that pour these ingredients (after their volumes changed)
+    def update_servings(self, ingredients):
+        names = set()
+        for ingredient in ingredients:
+            names.update(self.ingredient_users.get(ingredient, ()))
+        for cocktail_name in names:
+            self.servings[cocktail_name] = self.count_servings(cocktail_name)
+
+    #Gets the (ingredient, amount) pairs of a cocktail that are really poured (not ignored, and only alcohol in alcohol mode)
+    def get_poured_items(self, cocktail_name):
+        items = []
+        for ingredient, amount in self.recipes[cocktail_name].items():
+            if(amount <= 0 or ingredient in self.ignore_list):
+                continue
+            if(self.alcohol_mode and ingredient not in self.alcohol_list):
+                continue
+            items.append((ingredient, amount))
+        return items
+
+    #Gets how many servings of a cocktail the bottles can still pour (None if none of its ingredients come from a bottle)
+    def count_servings(self, cocktail_name):
+        servings = None
+        for ingredient, amount in self.get_poured_items(cocktail_name):
+            bottle = self.bottles.get(ingredient)
+            count = 0 if bottle is None else max(0, int(bottle.volume // (amount*self.shot_volume)))
+            if(servings is None or count < servings):
+                servings = count
+        return servings
+
+    #Checks availability like is_available, from a recipe's ingredient ids and per-id on hand/alcohol flags
+    def ids_available(self, ids, on_hand, alcohol):
+        if(not self.alcohol_mode):
+            for i in ids:
+                if(not on_hand[i]):
+                    return False
+            return True
+
+        alc_count = 0
+        for i in ids:
+            if(alcohol[i]):
+                alc_count += 1
+                if(not on_hand[i]):
+                    return False
+        return alc_count > 0 #Make sure it's not a non-alcoholic drink
+
+
+    #Aborts all pump functions (called from the abort pin interrupt)
+    def abort_pumps(self, channel=None):
+        trigger_time = time.monotonic()
+        logger.warning('ABORTING ALL FUNCTIONS')
+
+        timeline = self.current_timeline
+        if(timeline is not None):
+            timeline.cancel() #Keeps any pin in the timeline from switching back on
+
+        #Turns off all pumps, solenoids and pressure pumps through their workers
+        self.pump_workers.cancel_all()
+        if(not self.pump_workers.wait_all_off(0.5)):
+            #A worker didn't respond in time, so force every pin off directly
+            logger.error('Pump workers did not stop in time! Forcing pins off')
+            for pin in self.pump_workers.get_pins():
+                self.set_pin(pin, False)
+
+        off_time = time.monotonic()
+        latency = off_time - trigger_time
+        abort_latency.observe(latency)
+
+        with self.abort_lock:
+            self.abort_stats['count'] += 1
+            self.abort_stats['lastLatency'] = latency
+            if(latency > self.abort_stats['maxLatency']):
+                self.abort_stats['maxLatency'] = latency
+
+        logger.warning('All pins off %.3f ms after abort', latency*1000, extra={'data': {'abortLatency': latency}})
 
         #Fix all volume adjustments that were made
-        self.abort_fix_volumes()
+        if(timeline is not None):
+            self.abort_fix_volumes(timeline, off_time)
 
-    #Fix volume adjustments that were made since the cocktail was aborted
-    def abort_fix_volumes(self):
-        
-        time_spent = self.abort_time - self.start_time
-        i = 0
-        for ingredient in self.cocktail_ingredients[self.current_cocktail]:
-            amount_desired = self.cocktail_amounts[self.current_cocktail][i] #Num of shots desired
-            pump_num = self.pump_map[ingredient]['pumpNum']
-            time_expected = amount_desired * self.pump_data[pump_num]['pumpTime']
-
-            #Nothing to change
-            if(time_expected <= time_spent):
-                i += 1
-                continue
-            
-            amount_dispensed = (time_spent / self.pump_data[pump_num]['pumpTime'])*self.shot_volume  #Total mL dispensed
-            amount_diff = amount_desired*self.shot_volume - amount_dispensed #Calculate amount not dispensed
-            self.pump_map[ingredient]['volume'] = str(float(self.pump_map[ingredient]['volume']) + amount_diff) #Add to amount stored in file
-            i += 1
+    #Refunds the volume of every ingredient that wasn't dispensed before the abort
+    def abort_fix_volumes(self, timeline, off_time):
+        refund = {}
+
+        with self.abort_lock:
+            #Only refund each timeline once, even if the abort pin bounces
+            if(timeline.refunded):
+                return
+            timeline.refunded = True
+
+            for entry in timeline.entries:
+                if(entry['kind'] != 'pump' or entry['ingredient'] not in self.bottles):
+                    continue
+
+                #Actual shots dispensed from the time the pin was really on
+                on_time = timeline.get_on_time(entry, off_time)
+                shots_dispensed = min(entry['amount'], on_time / self.pumps[entry['pumpNum']].pump_time)
+                amount_diff = (entry['amount'] - shots_dispensed)*self.shot_volume #Amount not dispensed (mL)
+
+                if(amount_diff <= 0):
+                    continue
+
+                ingredient = entry['ingredient']
+                self.bottles[ingredient].volume += amount_diff #Add to amount stored in file
+                refund[ingredient] = refund.get(ingredient, 0.0) + amount_diff
+
+            self.abort_stats['lastRefund'] = refund
+
+        logger.info('Refunded after abort: %s', refund, extra={'data': {'refund': refund}})
+        telemetry.record('refund', {"cocktail": timeline.cocktail_name, "refund": refund})
+        self.update_servings(refund.keys())
         self.write_pump_data()
+        timeline.refund_event.set()
+
+    #Gets the abort statistics
+    def get_abort_stats(self):
+        with self.abort_lock:
+            stats = self.abort_stats.copy()
+            stats['lastRefund'] = stats['lastRefund'].copy()
+        return stats
 
     #Loads the list of ingredients to ignore when considering availablity & making cocktail
     def load_ignore_list(self):
@@ -203,10 +457,12 @@ class Main():
     def write_ignore_list(self):
         ignore_arr = list(self.ignore_list)
 
-        with open('ignoreList.json', 'w') as file:
-            json.dump(ignore_arr, file)
+        with metrics.Timer(file_write_latency, {'file': 'ignoreList.json'}):
+            with open('ignoreList.json', 'w') as file:
+                json.dump(ignore_arr, file)
+        configWatcher.note_write('ignoreList.json')
 
-        print('Updated ignore list file')
+        logger.info('Updated ignore list file')
 
 
     #Loads the list of ingredients that are alcohol
@@ -216,24 +472,33 @@ class Main():
         with open('alcohol.json', 'r') as file:
             data = json.load(file)
         
-        for key in data:
-            if(data[key] == True):
-                self.alcohol_list.add(key)
+        self.alcohol_list = set(key for key in data if data[key] == True)
 
     #Adds item to ignore list
     def add_ignore_item(self, item):
-        print('Adding: ' + item + ' to ignore list!')
+        logger.info('Adding: %s to ignore list!', item)
         self.ignore_list.add(item)
         self.write_ignore_list() #Update local storage
-        self.load_cocktails()  #Reload cocktails with new ignored ingredients
+        self.refresh('ignore')  #Update the menu with the new ignored ingredients
 
     #Removes item from ignore list
     def remove_ignore_item(self, item):
         if(item in self.ignore_list):
-            print('Removing ' + item + ' from ignore list!')
+            logger.info('Removing %s from ignore list!', item)
             self.ignore_list.remove(item)
             self.write_ignore_list()  #Updates local storage file
-            self.load_cocktails()  #Reload cocktail list
+            self.refresh('ignore')  #Update the menu
+
+    #Replaces the whole ignore list (one file write and menu reload); does nothing if it is unchanged
+    def set_ignore_list(self, items):
+        items = set(items)
+        if(items == self.ignore_list):
+            return False
+        logger.info('Setting ignore list to: %s', sorted(items))
+        self.ignore_list = items
+        self.write_ignore_list()
+        self.refresh('ignore')
+        return True
 
     #Get ignore ingredient list
     def get_ignore_ingredients(self):
@@ -247,7 +512,7 @@ class Main():
         all_bottles = self.new_bottles
 
         #Add bottles that are currently on pumps
-        for bottle in self.pump_map.keys():
+        for bottle in self.bottles.keys():
             all_bottles.add(bottle)
 
         #Go through all ingredients and construct object
@@ -258,27 +523,30 @@ class Main():
             else:
                 data[ingredient] = False
 
-        with open('alcohol.json', 'w') as file:
-            json.dump(data, file)
+        with metrics.Timer(file_write_latency, {'file': 'alcohol.json'}):
+            with open('alcohol.json', 'w') as file:
+                json.dump(data, file)
+        configWatcher.note_write('alcohol.json')
 
-        print('Updated alcohol list file')
+        logger.info('Updated alcohol list file')
 
     
     #Add a bottle to alcohol list
     def add_to_alcohol_list(self, bottle_name):
         self.alcohol_list.add(bottle_name)
         self.write_alcohol_list()
+        self.refresh('alcohol')
 
     #Get number/details of bottles supported by Barbot
     def get_pump_support_details(self):
         pump_arr = []
 
         #Get details of every pump
-        for num in self.pump_data:
+        for pump in self.pumps.values():
             pump_obj = {
-                "pumpNum": num,
-                "pumpTime": self.pump_data[num]['pumpTime'],
-                "type": self.pump_data[num]['type']
+                "pumpNum": pump.num,
+                "pumpTime": pump.pump_time,
+                "type": pump.type
             }
             pump_arr.append(pump_obj)
 
@@ -287,69 +555,105 @@ class Main():
         return pump_arr
     
     #Add cocktail recipe to BarBot-Recipes Table in DynamoDB
+    @tracing.traced('main.add_cocktail_recipe')
     def add_cocktail_recipe(self, recipe):
         if(upload_recipe(recipe)):
             #Updates the local recipe cache json file
-            res = self.update_local_recipes()
-            if(res == False):
+            if(self.refresh('recipes') != 'true'):
                 return 'false'
             return 'true'
         return 'false'
 
-    #Updates cocktails.json with data from the Dynamodb table
-    def update_local_recipes(self):
-        new_recipe_raw = get_all_recipes()
+    #Imports (line number, row) pairs of recipes in bulk, then refreshes the local recipes once
+    @tracing.traced('main.import_recipes')
+    def import_recipes(self, rows, workers=4):
+        report = BulkImporter(workers).run(rows)
+        recipe_cache.clear()
+        if(report['written'] > 0):
+            report['refreshed'] = self.refresh('recipes') == 'true'
+        return report
+
+    #Updates cocktails.json with data from the Dynamodb table.
+    #Recipes are streamed from a parallel scan straight into a temporary file, which replaces cocktails.json only once the scan finished.
+    @tracing.traced('main.update_local_recipes')
+    def update_local_recipes(self, check_availability=True):
+        with self.recipe_lock:
+            return self.scan_local_recipes(check_availability)
+
+    #Scans the recipes into cocktails.json (call update_local_recipes, which holds recipe_lock)
+    def scan_local_recipes(self, check_availability):
+        start = time.monotonic()
+        self.refresh_start = start
+        self.recipe_refresh = {"state": 'scanning', "items": 0, "segmentsDone": 0, "segments": None, "seconds": 0.0}
+        count = 0
+        snapshot = SnapshotBuilder()
 
-        if(new_recipe_raw == {}):
-            print('Error getting recipes from DynamoDB')
-            self.load_cocktails()
+        try:
+            with open('cocktails.json.tmp', 'w') as file:
+                file.write('{"cocktails": [')
+                for item in scan_recipes(progress=self.set_refresh_progress):
+                    if(count > 0):
+                        file.write(', ')
+                    ingredients = list(item['amounts'].keys())
+                    amounts = list(item['amounts'].values())
+                    json.dump({"name": item['cocktailName'], "ingredients": ingredients, "amounts": amounts}, file)
+                    snapshot.add(item['cocktailName'], ingredients, amounts)
+                    count += 1
+                file.write(']}')
+        except Exception as e:
+            logger.error('Error scanning recipes: %s', e)
+            count = 0
+
+        self.recipe_refresh['seconds'] = time.monotonic() - start
+        if(count == 0):
+            logger.error('Error getting recipes from DynamoDB')
+            self.recipe_refresh['state'] = 'failed'
+            if(os.path.exists('cocktails.json.tmp')):
+                os.remove('cocktails.json.tmp')
+            self.load_cocktails(check_availability)
             return False
 
-        new_cocktail_JSON = {'cocktails': []}
-
-        for rec in new_recipe_raw:
-            amount_item = json.loads(new_recipe_raw[rec])['amounts']
-            
-            ingredient_arr = []
-            amounts_arr = []
-            for ingredient in amount_item:
-                ingredient_arr.append(ingredient)
-                amounts_arr.append(amount_item[ingredient])
-            
-            new_itew = {
-                "name": rec,
-                "ingredients": ingredient_arr,
-                "amounts": amounts_arr
-            }
-
-            new_cocktail_JSON['cocktails'].append(new_itew)
-
-        with open('cocktails.json', 'w') as file:
-            json.dump(new_cocktail_JSON, file)
-
-        print('Wrote new cocktails to file')
-        self.load_cocktails()
+        #Only replace the files (and so recompile the snapshot) when the recipes changed; the scan order alone doesn't count
+        current = read_header('cocktails.bin')
+        if(current is not None and current['crc'] == snapshot.get_crc() and current['sourceStamp'] == get_stamp('cocktails.json')):
+            os.remove('cocktails.json.tmp')
+            logger.info('Recipes unchanged, keeping cocktails.json')
+        else:
+            #Only the swap and the snapshot are timed; the json was written as the scan went
+            with metrics.Timer(file_write_latency, {'file': 'cocktails.json'}):
+                os.replace('cocktails.json.tmp', 'cocktails.json')
+                snapshot.write('cocktails.bin', get_stamp('cocktails.json'))
+        self.recipe_refresh['state'] = 'done'
+        logger.info('Wrote %d cocktails to file', count, extra={'data': {'seconds': self.recipe_refresh['seconds']}})
+        self.load_cocktails(check_availability)
 
         return True
 
+    #Records how far the recipe scan got (served at /refreshRecipes/progress/)
+    def set_refresh_progress(self, items, segments_done, segments):
+        previous = self.recipe_refresh['segmentsDone']
+        self.recipe_refresh.update({"items": items, "segmentsDone": segments_done, "segments": segments, "seconds": time.monotonic() - self.refresh_start})
+        if(segments_done != previous):
+            logger.debug('Recipe scan: %d items, %d/%d segments done', items, segments_done, segments)
+
 
     #Scans through the ingredients on each pump and the ingredients needed for this cocktail to determine availability
     def is_available(self, cocktail_name):    
         if(not self.alcohol_mode):
-            for ingredient in self.cocktail_ingredients[cocktail_name]:
-                if(ingredient not in self.pump_map.keys() and ingredient not in self.ignore_list):
-                    print(ingredient + " not available!")
+            for ingredient in self.recipes[cocktail_name].ingredients:
+                if(ingredient not in self.bottles and ingredient not in self.ignore_list):
+                    logger.debug('%s not available!', ingredient)
                     return False
                 elif(ingredient in self.ignore_list):
-                    print("CAN IGNORE INGREDIENT: " + ingredient + '  FOR COCKTAIL: ' + cocktail_name)
+                    logger.debug('CAN IGNORE INGREDIENT: %s  FOR COCKTAIL: %s', ingredient, cocktail_name)
             return True
         else:
             alc_count = 0
-            for ingredient in self.cocktail_ingredients[cocktail_name]:
+            for ingredient in self.recipes[cocktail_name].ingredients:
                 if(ingredient in self.alcohol_list):
                     alc_count += 1
-                    if(ingredient not in self.pump_map.keys() and ingredient not in self.ignore_list):
-                        print(ingredient + " not available!")
+                    if(ingredient not in self.bottles and ingredient not in self.ignore_list):
+                        logger.debug('%s not available!', ingredient)
                         return False
             
             #Make sure it's not a non-alcoholic drink
@@ -365,24 +669,24 @@ class Main():
             data = json.load(file)
 
         self.new_bottles = set(data)
-        print('NEW BOTTLES:')
-        print(self.new_bottles)
+        logger.debug('NEW BOTTLES: %s', self.new_bottles)
 
 
     #Write bottles list to the bottles.json file
     def write_new_bottles(self):
-        with open('bottles.json', 'w') as file:
-            json.dump(list(self.new_bottles), file)
+        with metrics.Timer(file_write_latency, {'file': 'bottles.json'}):
+            with open('bottles.json', 'w') as file:
+                json.dump(list(self.new_bottles), file)
 
     
     #Adds new bottle to the bottle list
     def add_new_bottle_to_list(self, bottle_name):
-        print("ADDING " + bottle_name + " TO BOTTLE LIST")
+        logger.info('ADDING %s TO BOTTLE LIST', bottle_name)
         if(bottle_name.lower() not in self.new_bottles):
             self.new_bottles.add(bottle_name.lower())
             self.write_new_bottles()
         else:
-            print('Bottle: ' + bottle_name + "  is already in the list")
+            logger.info('Bottle: %s  is already in the list', bottle_name)
 
 
     #Removes bottle from bottle list
@@ -391,140 +695,207 @@ class Main():
             self.new_bottles.remove(bottle_name)
             self.write_new_bottles()
         else:
-            print("Bottle: " + bottle_name + "  not in list to begin with!")
+            logger.info('Bottle: %s  not in list to begin with!', bottle_name)
 
 
     #Function that crafts the cocktail requested
+    @tracing.traced('main.make_cocktail')
     def make_cocktail(self, cocktail_name):
-        if(self.busy_flag):
-            print('Busy making cocktail!')
+        order_queue_depth.inc()
+        try:
+            res = self.pour_cocktail(cocktail_name, time.monotonic())
+        finally:
+            order_queue_depth.dec()
+        orders_total.inc(1, {'result': res})
+        return res
+
+    #Claims the pumps for one action (checking and setting busy_flag at once, so two commands can't both start); gets False if they're busy
+    def claim_busy(self):
+        with self.busy_lock:
+            if(self.busy_flag):
+                return False
+            self.busy_flag = True
+            return True
+
+    #Checks, pours and records a single cocktail order
+    def pour_cocktail(self, cocktail_name, order_time):
+        if(not self.claim_busy()):
+            logger.info('Busy making cocktail!')
             return 'busy'
         
-        #Check whether the cocktail is available or not
-        if(not self.cocktail_available[cocktail_name]):
-            print('This cocktail is not avialable!')
-            return 'available'
-        
-        #Check whether there are enough ingredients
-        if(not self.can_make_cocktail(cocktail_name)):
-            print('Not enough ingredients to make this cocktail.')
-            return 'ingredients'
-        
         try:
-            print('Making cocktail ' + cocktail_name)
-            self.busy_flag = True
+            #Check whether the cocktail is available or not
+            if(not self.cocktail_available.get(cocktail_name, False)):
+                logger.info('This cocktail is not avialable!')
+                self.busy_flag = False
+                return 'available'
+
+            #Check whether there are enough ingredients
+            if(not self.can_make_cocktail(cocktail_name)):
+                logger.info('Not enough ingredients to make this cocktail.')
+                self.busy_flag = False
+                return 'ingredients'
+
+            logger.info('Making cocktail %s', cocktail_name)
             #self.setup_pins()
 
-            #Now we need to turn on pumps for respective ingredients for specified times
-            i = 0
-            wait_time = 0
-            biggest_time = 0
-            self.current_cocktail = cocktail_name
-            self.start_time = datetime.now().timestamp()
-            for ingredient in self.cocktail_ingredients[cocktail_name]:
+            #Compile the pour timeline: which pins turn on and for how long
+            timeline = PourTimeline(cocktail_name)
+            timeline.order_time = order_time
+            for ingredient, amount in self.recipes[cocktail_name].items():
                 #Skip pumping non-alcohol ingredients
                 if(self.alcohol_mode and ingredient not in self.alcohol_list):
-                    print(ingredient + ' is not alcohol. Skipping to next ingredient...')
-                    i += 1
+                    logger.debug('%s is not alcohol. Skipping to next ingredient...', ingredient)
                     continue
 
                 if(ingredient in self.ignore_list):
-                    print(ingredient + ' is in ignore list. Skipping to next ingredient...')
-                    i += 1
+                    logger.debug('%s is in ignore list. Skipping to next ingredient...', ingredient)
                     continue
 
-                print('Starting pump for ingredient: ' + ingredient)
-
-                pump_num = self.pump_map[ingredient]['pumpNum']
-                #Create threads to handle running the pumps
-                pump_thread = threading.Thread(target=self.pump_toggle, args=[pump_num, self.cocktail_amounts[cocktail_name][i]])
-                pump_thread.start()
+                pump = self.bottles[ingredient].pump
+                timeline.add_entry(pump.gpio, amount * pump.pump_time, 'pump', pump.num, ingredient, amount)
 
                 #Determine if pressure pumps should be triggered
-                if(self.pump_data[pump_num]['type'] == 'soda'):
-                    percent = float(self.get_bottle_percentage(ingredient))/100
-                    pressure_time = self.cocktail_amounts[cocktail_name][i] * self.pump_data[pump_num]['pumpTime'] * 0.75  #pressure pump time in seconds
-
-                    pressure_thread = threading.Thread(target=self.pressure_toggle, args=[pump_num, pressure_time])
-                    pressure_thread.start()
-
-                #Adjust volume tracking for each of the pumps
-                print('Ingredient: ' + str(ingredient) + ' --- Amount: ' + str(self.cocktail_amounts[cocktail_name][i]*self.shot_volume) + ' mL')
-                self.adjust_volume_data(ingredient, self.cocktail_amounts[cocktail_name][i])
+                if(pump.type == 'soda'):
+                    pressure_time = amount * pump.pump_time * 0.75  #pressure pump time in seconds
+                    timeline.add_entry(self.pressure_pins[str(pump.num)], pressure_time, 'pressure', pump.num)
+
+                #Adjust volume tracking for each of the pumps (refunded by abort_fix_volumes if aborted)
+                logger.debug('Ingredient: %s --- Amount: %s mL', ingredient, amount*self.shot_volume)
+                self.adjust_volume_data(ingredient, amount, write_file=False)
+            self.update_servings(self.recipes[cocktail_name].ingredients)
+            self.write_pump_data()
 
-                #Finds which ingredient has the longest pump time required
-                if(self.cocktail_amounts[cocktail_name][i] * self.pump_data[pump_num]['pumpTime'] > biggest_time):
-                    biggest_time = (self.cocktail_amounts[cocktail_name][i]) * self.pump_data[pump_num]['pumpTime']
-                i += 1
-            
-            wait_time = biggest_time
-            print('Wait Time: ' + str(wait_time))
-            time.sleep(wait_time)
+            #Hand the timeline to the pump workers
+            self.current_cocktail = cocktail_name
+            timeline.start()
+            self.current_timeline = timeline
+            with tracing.span('gpio.schedule', {'entries': len(timeline.entries)}):
+                self.pump_workers.run_timeline(timeline)
+            #Compiling the timeline and writing pumpConfig.json (time waiting for a dispatch worker is barbot_mqtt_queue_wait_seconds)
+            order_latency.observe(timeline.start_time - order_time, {'phase': 'prepare'})
+
+            wait_time = timeline.get_total_time()
+            logger.debug('Wait Time: %s', wait_time)
+            timeline.wait()
+            order_latency.observe(time.monotonic() - timeline.start_time, {'phase': 'pour'})
+            self.pour_timing.record_timeline(timeline, self.shot_volume)
+            self.trace_timeline(timeline)
+            if(timeline.is_cancelled()):
+                timeline.refund_event.wait(5) #Let the abort finish refunding before taking new orders
             self.busy_flag = False
-            self.start_time = 0.0
+            self.current_timeline = None
             self.current_cocktail = ''
-            print("Done making cocktail!")
+
+            self.record_pour_telemetry(timeline, order_time)
+
+            if(timeline.is_cancelled()):
+                logger.warning('Cocktail was aborted!')
+                return 'aborted'
+            logger.info('Done making cocktail!')
 
         except Exception as e:
-            print(e)
+            logger.exception('Error making cocktail %s', cocktail_name)
             self.busy_flag = False
+            self.current_timeline = None
             return 'error'
 
         #Update cloud details (separate from above to avoid returning error if this fails)
         try:
             #Update Stat tracking in the cloud
-            increment_cocktail(cocktail_name)
+            with metrics.Timer(order_latency, {'phase': 'stats_upload'}):
+                increment_cocktail(cocktail_name)
         except Exception as e:
-            print(e)
+            logger.exception('Error updating cocktail stats')
 
         return 'true'
 
+    #Records a finished (or aborted) pour as a telemetry event with the mL poured and what's left in each bottle
+    def record_pour_telemetry(self, timeline, order_time):
+        poured = {}
+        for entry in timeline.entries:
+            if(entry['kind'] == 'pump'):
+                poured[entry['ingredient']] = poured.get(entry['ingredient'], 0.0) + entry['amount']*self.shot_volume
+        telemetry.record('pour', {
+            "cocktail": timeline.cocktail_name,
+            "result": 'aborted' if timeline.is_cancelled() else 'done',
+            "seconds": round(time.monotonic() - order_time, 3),
+            "poured": poured,
+            "remaining": {ingredient: self.bottles[ingredient].volume for ingredient in poured if ingredient in self.bottles}
+        })
+
+    #Adds a span for every pin of a finished pour, using the edge times recorded by the pump scheduler
+    def trace_timeline(self, timeline):
+        for entry in timeline.entries:
+            if(entry['onTime'] is None or entry['offTime'] is None):
+                continue
+            tracing.record_span('gpio.' + entry['kind'], tracing.monotonic_to_unix_ns(entry['onTime']), tracing.monotonic_to_unix_ns(entry['offTime']), attributes={
+                'pin': entry['pin'],
+                'pumpNum': entry['pumpNum'],
+                'ingredient': entry['ingredient'] if entry['ingredient'] is not None else '',
+                'requestedSeconds': float(entry['duration']),
+                'cancelled': timeline.is_cancelled()
+            })
+
+    #Sets a relay pin on or off (relays are active low)
+    def set_pin(self, pin, on):
+        GPIO.output(pin, GPIO.LOW if on else GPIO.HIGH)
+
     #Toggles specific pumps for specific amount of time
-    def pump_toggle(self, num, amt):
-        pump_pin = self.pump_data[num]['gpio']
-        GPIO.output(pump_pin, GPIO.LOW)
-        time.sleep(self.pump_data[num]['pumpTime']*amt)
-        GPIO.output(pump_pin, GPIO.HIGH)
+    def pump_toggle(self, num, amt, timeline=None, entry=None):
+        self.pump_workers.on(self.pumps[num].gpio, self.pumps[num].pump_time*amt, timeline, entry)
 
     #Turns on a specific pump for indefinite amount of time
     def pump_on(self, num):
-        pump_pin = self.pump_data[num]['gpio']
-        print('Turning on pump: ' + str(num))
-        GPIO.output(pump_pin, GPIO.LOW)
+        pump_pin = self.pumps[num].gpio
+        logger.info('Turning on pump: %s', num)
+        self.pump_workers.on(pump_pin)
 
     #Turns off a specific pump for indefinite amount of time
     def pump_off(self, num):
-        pump_pin = self.pump_data[num]['gpio']
-        print("Turning off pump: " + str(num))
-        GPIO.output(pump_pin, GPIO.HIGH)
+        pump_pin = self.pumps[num].gpio
+        logger.info('Turning off pump: %s', num)
+        self.pump_workers.off(pump_pin)
 
     #Turn pressure pump on
     def pressure_on(self, num):
         pin = self.pressure_pins[str(num)]
-        print('Turning on pressure pump: ' + str(num))
-        GPIO.output(pin, GPIO.LOW)
+        logger.info('Turning on pressure pump: %s', num)
+        self.pump_workers.on(pin)
 
     #Turn pressure pump off
     def pressure_off(self, num):
         pin = self.pressure_pins[str(num)]
-        print('Turning on pressure pump: ' + str(num))
-        GPIO.output(pin, GPIO.HIGH)
+        logger.info('Turning off pressure pump: %s', num)
+        self.pump_workers.off(pin)
 
     #Toggle pressure pump for certain amount of time
-    def pressure_toggle(self, num, pressure_time):
-        self.pressure_on(num)
-        time.sleep(pressure_time)
-        self.pressure_off(num)
+    def pressure_toggle(self, num, pressure_time, timeline=None, entry=None):
+        self.pump_workers.on(self.pressure_pins[str(num)], pressure_time, timeline, entry)
+
+    #Gets whether each pump is currently on, keyed by pump number
+    def get_pump_states(self):
+        pin_states = self.pump_workers.get_states()
+        states = {}
+        for num, pump in self.pumps.items():
+            states[num] = pin_states.get(pump.gpio, False)
+        return states
+
+    #Gets whether each pressure pump is currently on, keyed by pump number
+    def get_pressure_states(self):
+        pin_states = self.pump_workers.get_states()
+        states = {}
+        for num in self.pressure_pins:
+            states[num] = pin_states.get(self.pressure_pins[num], False)
+        return states
 
-    
     #Calibrates a specific pump by setting it's specific pumping time
     def calibrate_pump(self, pump_num, calib_time):
         try:
-            self.pump_data[pump_num]['pumpTime'] = calib_time
+            self.pumps[pump_num].pump_time = float(calib_time)
             self.write_pump_data()
         except Exception as e:
-            print('ERROR: CALIBRATING PUMP FAILED')
-            print(e)
+            logger.exception('ERROR: CALIBRATING PUMP FAILED')
             return 'false'
 
         return 'true' #Success
@@ -547,35 +918,33 @@ class Main():
 
             self.polarity_normal = True
         
-        print('Done reversing polarities!')
+        logger.info('Done reversing polarities!')
         return self.polarity_normal
 
 
     #Cleans Pumps by flushin them for time specified in self.cleanTime
+    @tracing.traced('main.clean_pumps')
     def clean_pumps(self, remove_ignore=False):
-        if(self.busy_flag and not remove_ignore):
+        if(not remove_ignore and not self.claim_busy()):
             return 'busy'
 
-        print('Cleaning pumps!')
-
-        if(not remove_ignore):
-            self.busy_flag = True
+        logger.info('Cleaning pumps!')
 
         #Turn all pumps on (except for soda pumps)
-        for pump in self.pump_data:
-            if(remove_ignore and self.pump_data[pump]['type'] == 'regular'):
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.LOW)
+        for pump in self.pumps.values():
+            if(remove_ignore and pump.type == 'regular'):
+                self.pump_workers.on(pump.gpio)
             elif(not remove_ignore):
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.LOW) #TODO: SEE IF THIS IS NECESSARY TO CHECK REMOVE_IGNORE
+                self.pump_workers.on(pump.gpio) #TODO: SEE IF THIS IS NECESSARY TO CHECK REMOVE_IGNORE
 
         time.sleep(self.clean_time)
 
         #Turn all pumps off (ignore soda pumps)
-        for pump in self.pump_data:
-            if(remove_ignore and self.pump_data[pump]['type'] == 'regular'):
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.HIGH)
+        for pump in self.pumps.values():
+            if(remove_ignore and pump.type == 'regular'):
+                self.pump_workers.off(pump.gpio)
             elif(not remove_ignore):
-                GPIO.output(self.pump_data[pump]['gpio'], GPIO.HIGH)
+                self.pump_workers.off(pump.gpio)
         
         if(not remove_ignore):
             self.busy_flag = False
@@ -583,68 +952,91 @@ class Main():
         return 'true'
 
     #Adjusts the volume an ingredient after a certain amount is poured
-    def adjust_volume_data(self, ingredient_name, shot_amount):
-        print('Value: ' + str(self.pump_map[ingredient_name]['volume']))
-        new_val = float(self.pump_map[ingredient_name]['volume']) - (self.shot_volume*shot_amount)
-        print('New Value: ' + str(new_val))
-        self.pump_map[ingredient_name]['volume'] = str(new_val)
-        self.write_pump_data()
+    def adjust_volume_data(self, ingredient_name, shot_amount, write_file=True):
+        bottle = self.bottles[ingredient_name]
+        logger.debug('Value: %s', bottle.volume)
+        bottle.volume -= self.shot_volume*shot_amount
+        logger.debug('New Value: %s', bottle.volume)
+        if(write_file):
+            self.update_servings([ingredient_name])
+            self.write_pump_data()
 
 
     #Assemble ingredient info packet for mobile app
     def get_ingredient_volume(self, ingredient):
+        bottle = self.bottles[ingredient]
         vol_obj = {}
         vol_obj['ingredient'] = ingredient
-        vol_obj['volume'] = self.pump_map[ingredient]['volume']
-        vol_obj['originalVolume'] = self.pump_map[ingredient]['originalVolume']
-        percent = (int(vol_obj['volume']) / int(vol_obj['originalVolume']))*100
-        vol_obj['percent'] = round(percent)
+        vol_obj['volume'] = format_volume(bottle.volume)
+        vol_obj['originalVolume'] = format_volume(bottle.original_volume)
+        vol_obj['percent'] = round(bottle.get_percent())
 
         return vol_obj
 
     
     #Checks whether it is possible to make a given cocktail
+    @tracing.traced('main.can_make_cocktail')
     def can_make_cocktail(self, name):
-        i = 0
-        for ingredient in self.cocktail_ingredients[name]:
+        for ingredient, amount in self.recipes[name].items():
             #Check for alcohol mode
             if(self.alcohol_mode and ingredient not in self.alcohol_list):
-                i += 1
                 continue
             #Check for ignore list
             if(ingredient in self.ignore_list):
-                i += 1
                 continue
 
-            available_amt = float(self.pump_map[ingredient]['volume'])
-            need_amt = float(self.cocktail_amounts[name][i])*self.shot_volume
-            print('Ingredient: ' + ingredient + '   availableAmt: ' + str(available_amt) + '   needAmt: ' + str(need_amt))
-            i += 1
+            available_amt = self.bottles[ingredient].volume
+            need_amt = amount*self.shot_volume
+            logger.debug('Ingredient: %s   availableAmt: %s   needAmt: %s', ingredient, available_amt, need_amt)
             if((available_amt - need_amt) < 0):
                 return False
         return True
 
 
     #Get the cocktail list from available ingredients
-    def get_cocktail_list(self):
+    #with_servings gets {"name", "servings"} objects instead of names; min_servings drops cocktails with fewer servings left and
+    #sort orders them by 'name' or by 'servings' (most first)
+    def get_cocktail_list(self, with_servings=False, sort=None, min_servings=None):
         available_cocktails = []
         count = 0
-        for cocktail_name in self.cocktail_ingredients.keys():
+        for cocktail_name in self.cocktail_available:
 
             if(self.cocktail_available[cocktail_name]):
                 available_cocktails.append(cocktail_name)
                 count += 1
             else:
-                print('Cocktail: ' + cocktail_name + ' is not available!')
-
+                logger.debug('Cocktail: %s is not available!', cocktail_name)
+
+        if(min_servings is not None):
+            available_cocktails = [name for name in available_cocktails if self.get_servings_key(name) >= min_servings]
+        if(sort == 'name'):
+            available_cocktails.sort()
+        elif(sort == 'servings'):
+            available_cocktails.sort(key=lambda name: (-self.get_servings_key(name), name))
+        elif(sort is not None):
+            raise ValueError('Unknown sort: ' + str(sort))
+
+        if(with_servings):
+            return [{"name": name, "servings": self.servings.get(name, 0)} for name in available_cocktails]
         return available_cocktails
 
+    #Gets the servings of a cocktail for comparisons (a cocktail no bottle limits has unlimited servings)
+    def get_servings_key(self, cocktail_name):
+        servings = self.servings.get(cocktail_name, 0)
+        return float('inf') if servings is None else servings
+
     
     #Get the ingredients of a specific cocktail from DynamoDB (CLOUD ONLY VERSION)
     def get_cloud_ingredients(self, name):
         response = get_recipe(name)
         recipe = {}
 
+        #Fall back to the local copy when the cloud can't be reached
+        if('amounts' not in response):
+            if(name in self.recipes):
+                return self.get_ingredients(name)
+            return recipe
+
         #Convert Decimals back to floats
         for key in response['amounts']:
             recipe[key] = float(response['amounts'][key])
@@ -653,15 +1045,8 @@ class Main():
 
     #Get's ingredients for a specified recipe
     def get_ingredients(self, name):
-        print("GETTING INGREDIENTS")
-        recipe = {}
-
-        i = 0
-        for ingredient in self.cocktail_ingredients[name]:
-            recipe[ingredient] = float(self.cocktail_amounts[name][i])
-            i += 1
-
-        return recipe
+        logger.debug('GETTING INGREDIENTS')
+        return self.recipes[name].to_dict()
 
     #Get's the percentage full a bottle is
     def get_bottle_percentage(self, bottle_name):
@@ -673,69 +1058,66 @@ class Main():
             percent = (now/full)*100
             return str(int(percent))
         except Exception as e:
-            print('Error getting bottle percentage!')
-            print(e)
+            logger.exception('Error getting bottle percentage!')
             return 'N/A'
 
     #Gets the current volume of a bottle
     def get_bottle_volume(self, bottle_name):
-        if(bottle_name in self.pump_map):
-            vol = round(float(self.pump_map[bottle_name]['volume']))
-            return vol
+        if(bottle_name in self.bottles):
+            return round(self.bottles[bottle_name].volume)
         else:
             return -1
 
+    #Gets the current volume of every bottle on a pump, keyed by (bottle name,)
+    def get_bottle_volumes(self):
+        volumes = {}
+        for bottle_name, bottle in list(self.bottles.items()):
+            volumes[(bottle_name,)] = bottle.volume
+        return volumes
+
     #Gets the initial volume of a bottle
     def get_bottle_init_volume(self, bottle_name):
-        if(bottle_name in self.pump_map):
-            vol = round(float(self.pump_map[bottle_name]['originalVolume']))
-            return vol
+        if(bottle_name in self.bottles):
+            return round(self.bottles[bottle_name].original_volume)
         else:
             return -1
 
     #Gets the name of the bottle on a given pump
     def get_bottle_name(self, bottle_num):
-        try:
-
-            #TODO: Make this more efficient; maybe have a hashmap
-            for ingredient in self.pump_map:
-                if(self.pump_map[ingredient]['pumpNum'] == bottle_num):
-                    bottle_name = ingredient
-                    return bottle_name
-            return 'N/A'
-        except Exception as e:
-            print('Error getting bottle name!')
-            print(e)
+        pump = self.pumps.get(bottle_num)
+        if(pump is None or pump.bottle is None):
             return 'N/A'
+        return pump.bottle.name
 
 
     #Enables Barbot's "alcohol mode" (only outputting ingredients that alcohol)
+    @tracing.traced('main.set_alcohol_mode')
     def set_alcohol_mode(self, mode_setting):
         self.alcohol_mode = mode_setting
-        self.refresh_cocktail_files()
-        print("Alcohol mode: " + str(mode_setting))
+        self.refresh('mode')
+        logger.info('Alcohol mode: %s', mode_setting)
 
     
     #Remove all bottles from pumps
+    @tracing.traced('main.remove_all_bottles')
     def remove_all_bottles(self):
 
-        if(self.busy_flag):
+        if(not self.claim_busy()):
             return 'busy'
         
         try:
-            self.busy_flag = True
             #First reverse the polarity
             self.reverse_polarity()
 
             #Make a copy of the bottles
-            total_bottles = list(self.pump_map.keys())
+            total_bottles = list(self.bottles.keys())
 
             #Next remove all bottles
             for bottle_name in total_bottles:
                 self.remove_bottle(bottle_name, skip_pumps=True)
             
-            #Refresh files after removing all bottles
-            self.refresh_cocktail_files()
+            #Refresh once after removing all bottles
+            self.refresh('bottles')
             
             #Run a the clean function to turn on all pumps
             self.clean_pumps(remove_ignore=True)
@@ -744,16 +1126,21 @@ class Main():
             self.reverse_polarity()
             self.busy_flag = False
         except Exception as e:
-            print(e)
+            logger.exception('Error removing all bottles')
             return 'error'
         return 'true'
 
-    #Remove bottle from pumpMap
+    #Takes a bottle off its pump
+    @tracing.traced('main.remove_bottle')
     def remove_bottle(self, bottle_name, skip_pumps=False):
-        pump_num = self.pump_map[bottle_name]['pumpNum']
+        if(bottle_name not in self.bottles):
+            logger.error('Error removing bottle: %s is not on a pump', bottle_name)
+            return 'false'
+        pump_num = self.bottles[bottle_name].pump.num
 
-        if(bottle_name in self.pump_map and not self.busy_flag and not skip_pumps and self.pump_data[pump_num]['type'] == 'regular'):
-            self.busy_flag = True
+        if(not skip_pumps and self.pumps[pump_num].type == 'regular'):
+            if(not self.claim_busy()):
+                return 'busy'
             
             #Reverse pump polarity
             self.reverse_polarity()
@@ -771,91 +1158,66 @@ class Main():
         elif(self.busy_flag and not skip_pumps):
             return 'busy'
         
-        #Try to remove bottleName from pumpMap
-        try:
-            self.pump_map.pop(bottle_name)
-        except KeyError as e:
-            print('Error removing bottle')
-            print(e)
+        #Take the bottle off its pump
+        bottle = self.bottles.pop(bottle_name, None)
+        if(bottle is None):
+            logger.error('Error removing bottle: %s is not on a pump', bottle_name)
             return 'false'
+        detach_bottle(bottle)
 
         self.add_new_bottle_to_list(bottle_name)
+        telemetry.record('bottle', {"action": 'remove', "bottle": bottle_name, "pumpNum": pump_num})
 
         #Don't want to refresh too many times
         if(not skip_pumps):
-            self.refresh_cocktail_files()
+            self.refresh('bottles')
 
         return 'true'
 
-    #Adds bottle to pumpMap
+    #Puts a bottle on a pump
+    @tracing.traced('main.add_bottle')
     def add_bottle(self, bottle_name, pump_num, volume, original_volume):
-        self.pump_map[bottle_name] = {}
-        self.pump_map[bottle_name]['name'] = bottle_name
-        self.pump_map[bottle_name]['pumpNum'] = pump_num
-        self.pump_map[bottle_name]['volume'] = volume
-        self.pump_map[bottle_name]['originalVolume'] = original_volume
+        bottle = self.bottles.get(bottle_name)
+        if(bottle is None):
+            bottle = Bottle(bottle_name, volume, original_volume)
+        else:
+            bottle.volume = float(volume)
+            bottle.original_volume = float(original_volume)
+
+        #A pump holds one bottle, so whatever was on it goes back to the bottle list
+        replaced = attach_bottle(bottle, self.pumps[pump_num])
+        if(replaced is not None):
+            self.bottles.pop(replaced.name, None)
+            self.add_new_bottle_to_list(replaced.name)
+        self.bottles[bottle.name] = bottle
         self.remove_bottle_from_list(bottle_name)
-        self.refresh_cocktail_files()
+        telemetry.record('bottle', {"action": 'add', "bottle": bottle_name, "pumpNum": pump_num, "volume": volume})
+        self.refresh('bottles')
 
-    #Formats and writes pump_map and pump_data objects to the pumpConfig.json file
+    #Formats and writes the pumps and the bottles on them to the pumpConfig.json file
+    @tracing.traced('main.write_pump_data')
     def write_pump_data(self):
-        main_arr = []
-        pumps_done = set()
-
-        for ingredient in self.pump_map:
-            pump_num = self.pump_map[ingredient]['pumpNum']
-            data_obj = self.pump_data[pump_num].copy()
-            map_obj = self.pump_map[ingredient].copy()
-            map_obj.pop('pumpNum')
-            data_obj['currentBottle'] = map_obj
-            pumps_done.add(pump_num)
-
-            main_arr.append(data_obj)
-
-        #Add pumps that aren't in pumpMap already (i.e. no bottle connected)
-        for pump in self.pump_data:
-            if(pump in pumps_done):
-                continue
-            
-            data_obj = self.pump_data[pump]
-            map_obj = {}
-            data_obj['currentBottle'] = map_obj
-            pumps_done.add(pump)
-
-            main_arr.append(data_obj)
+        main_arr = [pump.to_dict() for pump in self.pumps.values()]
         
-        with open('pumpConfig.json', 'w') as file:
-            json.dump(main_arr, file)
+        with metrics.Timer(file_write_latency, {'file': 'pumpConfig.json'}):
+            with open('pumpConfig.json', 'w') as file:
+                json.dump(main_arr, file)
+        configWatcher.note_write('pumpConfig.json')
 
-        print('Wrote pump config to file')
-
-    #Refreshes all of the local cache files
-    def refresh_cocktail_files(self):
-        try:
-            print("Refreshing cocktail files...")
-            self.write_pump_data()
-            self.load_pump_config()
-            self.update_local_recipes()
-            self.load_cocktails()
-            self.load_alcohol_list()
-            self.load_ignore_list()
-        except Exception as e:
-            print(e)
-            return 'error'
-        return 'true'
+        logger.info('Wrote pump config to file')
 
     #Updates to newest software from git
     def update(self):
         try:
             subprocess.Popen('/home/pi/BarBot/update.sh')
         except Exception as e:
-            print(e)
+            logger.exception('Error starting update')
 
     #Reboot's BarBot Raspberry Pi
     def reboot(self):
         try:
             subprocess.Popen('/home/pi/BarBot/reboot.sh')
         except Exception as e:
-            print(e)
+            logger.exception('Error rebooting')
 
         
\ No newline at end of file
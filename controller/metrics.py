@@ -0,0 +1,268 @@
+import threading
+import bisect
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Default bucket bounds in seconds for latency histograms
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+#Histogram with fixed bucket upper bounds (any observation above the last bound goes to +Inf)
+class Histogram():
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    #Records a single value
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if(self.min is None or value < self.min):
+                self.min = value
+            if(self.max is None or value > self.max):
+                self.max = value
+
+    #Gets a copy of the histogram as a json friendly object
+    def snapshot(self):
+        with self.lock:
+            buckets = {}
+            for i in range(0, len(self.buckets)):
+                buckets[str(self.buckets[i])] = self.counts[i]
+            buckets['+Inf'] = self.counts[-1]
+
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": (self.sum / self.count) if self.count > 0 else None,
+                "min": self.min,
+                "max": self.max,
+                "buckets": buckets #Number of observations <= each bound (not cumulative)
+            }
+
+    #Gets the cumulative bucket counts, sum and count in one consistent read
+    def cumulative(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        cumulative = []
+        running = 0
+        for i in range(0, len(self.buckets)):
+            running += counts[i]
+            cumulative.append((self.buckets[i], running))
+        cumulative.append(('+Inf', count))
+        return cumulative, total, count
+
+
+#Base class for a named metric with optional labels
+class Metric():
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {} #Label values tuple -> value
+        self.lock = threading.Lock()
+
+    #Converts a labels dict into the tuple used as key
+    def label_key(self, labels):
+        if(labels is None):
+            return ()
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    #Formats label values for the text exposition format
+    def format_labels(self, key, extra=None):
+        pairs = []
+        for i in range(0, len(self.label_names)):
+            pairs.append(self.label_names[i] + '="' + escape_label(key[i]) + '"')
+        if(extra is not None):
+            pairs.append(extra)
+        if(len(pairs) == 0):
+            return ''
+        return '{' + ','.join(pairs) + '}'
+
+    #Gets the current samples as a list of (label key, value)
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    #Renders the metric in the Prometheus text exposition format
+    def render(self):
+        lines = [
+            '# HELP ' + self.name + ' ' + self.help_text,
+            '# TYPE ' + self.name + ' ' + self.metric_type
+        ]
+        for key, value in self.samples():
+            lines.append(self.name + self.format_labels(key) + ' ' + format_value(value))
+        return lines
+
+
+#Value that only goes up
+class Counter(Metric):
+    metric_type = 'counter'
+
+    #Adds to the counter
+    def inc(self, amount=1, labels=None):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+#Value that can go up and down, or be read from a function when scraped
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self.function = None
+
+    #Sets the gauge
+    def set(self, value, labels=None):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    #Adds to the gauge
+    def inc(self, amount=1, labels=None):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    #Subtracts from the gauge
+    def dec(self, amount=1, labels=None):
+        self.inc(-amount, labels)
+
+    #Reads the gauge from a function at scrape time; it returns a number, or a dict of label values tuple -> number
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if(self.function is None):
+            return super().samples()
+
+        try:
+            result = self.function()
+        except Exception as e:
+            logger.error('Error reading gauge %s: %s', self.name, e)
+            return []
+
+        if(not isinstance(result, dict)):
+            return [((), result)]
+        return [(tuple(str(v) for v in key), value) for key, value in result.items()]
+
+
+#Histogram per set of label values
+class HistogramMetric(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    #Records a value
+    def observe(self, value, labels=None):
+        key = self.label_key(labels)
+        histogram = self.values.get(key)
+        if(histogram is None):
+            with self.lock:
+                histogram = self.values.setdefault(key, Histogram(self.buckets))
+        histogram.observe(value)
+
+    #Gets the histogram for a set of labels (None if nothing was recorded)
+    def get(self, labels=None):
+        return self.values.get(self.label_key(labels))
+
+    def render(self):
+        lines = [
+            '# HELP ' + self.name + ' ' + self.help_text,
+            '# TYPE ' + self.name + ' histogram'
+        ]
+        for key, histogram in self.samples():
+            cumulative, total, count = histogram.cumulative()
+            for bound, bound_count in cumulative:
+                lines.append(self.name + '_bucket' + self.format_labels(key, 'le="' + str(bound) + '"') + ' ' + str(bound_count))
+            lines.append(self.name + '_sum' + self.format_labels(key) + ' ' + format_value(total))
+            lines.append(self.name + '_count' + self.format_labels(key) + ' ' + str(count))
+        return lines
+
+
+#Times a block of code into a histogram and counts it as an error if it raises
+class Timer():
+
+    def __init__(self, histogram, labels=None, errors=None):
+        self.histogram = histogram
+        self.labels = labels
+        self.errors = errors
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+        if(exc_type is not None and self.errors is not None):
+            self.errors.inc(1, self.labels)
+        return False
+
+
+#Holds every metric of the controller
+class Registry():
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    #Gets the metric with this name, creating it if needed
+    def get_or_create(self, metric_class, name, help_text, label_names=(), **kwargs):
+        with self.lock:
+            if(name not in self.metrics):
+                self.metrics[name] = metric_class(name, help_text, label_names, **kwargs)
+            return self.metrics[name]
+
+    #Renders every metric in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+#Gets or creates a counter in the controller registry
+def counter(name, help_text, label_names=()):
+    return REGISTRY.get_or_create(Counter, name, help_text, label_names)
+
+#Gets or creates a gauge in the controller registry
+def gauge(name, help_text, label_names=()):
+    return REGISTRY.get_or_create(Gauge, name, help_text, label_names)
+
+#Gets or creates a histogram in the controller registry
+def histogram(name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get_or_create(HistogramMetric, name, help_text, label_names, buckets=buckets)
+
+#Escapes a label value for the text exposition format
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#Formats a sample value for the text exposition format
+def format_value(value):
+    if(isinstance(value, bool)):
+        return '1' if value else '0'
+    return repr(float(value))
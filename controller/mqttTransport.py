@@ -0,0 +1,391 @@
+import json
+import time
+import types
+import queue
+import threading
+import itertools
+from os import path
+import logging
+
+logger = logging.getLogger(__name__)
+
+#MQTT transports used by IoTManager. Each one offers the same small interface:
+#   connect(), disconnect(), subscribe(topic, callback), publish(topic, payload),
+#   set_connection_callbacks(on_online, on_offline) and create_shadow_handler(thing_name)
+#where callback is called like the AWS SDK's (client, userdata, message) with message.topic and message.payload, and the
+#shadow handler has the SDK's shadowUpdate/shadowGet/shadowRegisterDeltaCallback methods.
+#
+#   aws    - AWS IoT Core with the certificates in certs/ (the default)
+#   local  - a plain MQTT broker such as mosquitto (needs paho-mqtt); shadows use the AWS shadow topics, so run a ShadowService against the broker
+#   memory - an in-process broker with a built-in shadow service (no network at all)
+
+#Raised when a transport can't be created (e.g. missing certificates or libraries)
+class TransportUnavailable(Exception):
+    pass
+
+
+#Gets whether an MQTT topic filter (with + and # wildcards) matches a topic
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i in range(0, len(filter_parts)):
+        if(filter_parts[i] == '#'):
+            return True
+        if(i >= len(topic_parts)):
+            return False
+        if(filter_parts[i] != '+' and filter_parts[i] != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+def get_shadow_topic(thing_name, operation):
+    return '$aws/things/' + thing_name + '/shadow/' + operation
+
+
+#AWS IoT Core through the AWS IoT SDK (endpoint from certs/iotDetails.json)
+class AwsIotTransport():
+
+    def __init__(self, settings):
+        #Imported here so the local and memory transports work without the AWS IoT SDK
+        try:
+            from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient, AWSIoTMQTTClient, DROP_OLDEST
+        except ImportError:
+            raise TransportUnavailable('AWSIoTPythonSDK is not installed')
+
+        if not path.exists('./certs/iotDetails.json'):
+            raise TransportUnavailable('IoT files don\'t exist')
+
+        #Load AWS IoT Core details from json file
+        with open('./certs/iotDetails.json', 'r') as file:
+            self.iot_details = json.load(file)
+        self.client_id = settings.get('clientId', 'barbot')
+
+        self.mqtt_client = AWSIoTMQTTClient(self.client_id)
+        self.mqtt_client.configureEndpoint(self.iot_details['endpoint'], 8883)
+        self.mqtt_client.configureCredentials('./certs/root-CA.crt', './certs/BarBot-private.pem.key', './certs/BarBot-certificate.pem.crt')
+
+        #Keep only a few responses in memory while offline (telemetry spools to disk itself)
+        self.mqtt_client.configureOfflinePublishQueueing(20, DROP_OLDEST)
+        self.mqtt_client.configureDrainingFrequency(2)
+        self.mqtt_client.configureConnectDisconnectTimeout(15)
+        self.mqtt_client.configureMQTTOperationTimeout(5)
+
+        #Setup Shadow client
+        self.shadow_client = AWSIoTMQTTShadowClient(self.client_id + '-shadow')
+        self.shadow_client.configureEndpoint(self.iot_details['endpoint'], 8883)
+        self.shadow_client.configureCredentials('./certs/root-CA.crt', './certs/BarBot-private.pem.key', './certs/BarBot-certificate.pem.crt')
+        self.shadow_client.configureAutoReconnectBackoffTime(1, 32, 20)
+        self.shadow_client.configureConnectDisconnectTimeout(10)
+        self.shadow_client.configureMQTTOperationTimeout(5)
+
+    def set_connection_callbacks(self, on_online, on_offline):
+        self.mqtt_client.onOnline = on_online
+        self.mqtt_client.onOffline = on_offline
+
+    def connect(self):
+        self.mqtt_client.connect()
+        logger.info('Connected to AWS IoT Core!')
+        self.shadow_client.connect()
+        logger.info("Connected to BarBot's IoT Shadow")
+
+    def disconnect(self):
+        self.shadow_client.disconnect()
+        self.mqtt_client.disconnect()
+
+    def subscribe(self, topic, callback):
+        self.mqtt_client.subscribe(topic, 0, callback)
+
+    def publish(self, topic, payload):
+        return self.mqtt_client.publish(topic, payload, 0)
+
+    def create_shadow_handler(self, thing_name):
+        return self.shadow_client.createShadowHandlerWithName(thing_name, True)
+
+
+#Plain MQTT broker through paho-mqtt (host and port from the 'mqtt' settings)
+class LocalBrokerTransport():
+
+    def __init__(self, settings):
+        try:
+            import paho.mqtt.client as paho
+        except ImportError:
+            raise TransportUnavailable('paho-mqtt is not installed')
+
+        self.host = settings.get('host', 'localhost')
+        self.port = settings.get('port', 1883)
+        self.client_id = settings.get('clientId', 'barbot')
+        self.keepalive = settings.get('keepalive', 30)
+        self.subscriptions = {} #Topic -> callback (resubscribed after every reconnect)
+        self.on_online = None
+        self.on_offline = None
+        self.connected = threading.Event()
+
+        if(hasattr(paho, 'CallbackAPIVersion')):
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+        else:
+            self.client = paho.Client(client_id=self.client_id)
+        self.client.on_connect = self.handle_connect
+        self.client.on_disconnect = self.handle_disconnect
+        self.client.reconnect_delay_set(1, 32)
+
+    def set_connection_callbacks(self, on_online, on_offline):
+        self.on_online = on_online
+        self.on_offline = on_offline
+
+    #Connects and waits for the broker to accept the connection
+    def connect(self, timeout=10):
+        self.client.connect(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+        if(not self.connected.wait(timeout)):
+            self.client.loop_stop()
+            raise TimeoutError('No CONNACK from ' + self.host + ':' + str(self.port))
+        logger.info('Connected to MQTT broker at %s:%s', self.host, self.port)
+
+    def disconnect(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    #paho calls these with different arguments depending on its callback API version
+    def handle_connect(self, client, userdata, flags, reason_code, *args):
+        self.connected.set()
+        for topic in self.subscriptions:
+            self.client.subscribe(topic, 0)
+        if(self.on_online is not None):
+            self.on_online()
+
+    def handle_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+        if(self.on_offline is not None):
+            self.on_offline()
+
+    def subscribe(self, topic, callback):
+        self.subscriptions[topic] = callback
+        self.client.message_callback_add(topic, lambda client, userdata, message: callback(client, userdata, message))
+        if(self.connected.is_set()):
+            self.client.subscribe(topic, 0)
+
+    def publish(self, topic, payload):
+        return self.client.publish(topic, payload, 0).rc == 0
+
+    def create_shadow_handler(self, thing_name):
+        return TopicShadowHandler(self, thing_name)
+
+
+#In-process broker: delivers every message on one callback thread (like the SDK does), optionally after a fixed latency,
+#and answers shadow requests itself
+class MemoryBroker():
+
+    def __init__(self, latency=0.0, shadow=True):
+        self.latency = latency #Seconds each delivery is delayed by
+        self.lock = threading.Lock()
+        self.subscriptions = [] #(topic filter, transport, callback)
+        self.deliveries = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='memory-broker', daemon=True)
+        self.thread.start()
+        self.shadow_service = ShadowService(MemoryTransport(self, 'shadow-service')) if shadow else None
+
+    def subscribe(self, topic_filter, transport, callback):
+        with self.lock:
+            self.subscriptions.append((topic_filter, transport, callback))
+
+    def unsubscribe_all(self, transport):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s[1] is not transport]
+
+    def publish(self, topic, payload):
+        if(isinstance(payload, str)):
+            payload = payload.encode()
+        with self.lock:
+            callbacks = [s[2] for s in self.subscriptions if topic_matches(s[0], topic)]
+        message = types.SimpleNamespace(topic=topic, payload=bytes(payload))
+        due = time.monotonic() + self.latency
+        for callback in callbacks:
+            self.deliveries.put((due, callback, message))
+        return True
+
+    def run(self):
+        while True:
+            due, callback, message = self.deliveries.get()
+            wait = due - time.monotonic()
+            if(wait > 0):
+                time.sleep(wait)
+            try:
+                callback(None, None, message)
+            except Exception as e:
+                logger.exception('Error delivering message on %s', message.topic)
+
+
+#Client of a MemoryBroker
+class MemoryTransport():
+
+    def __init__(self, broker, client_id='barbot'):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_online = None
+        self.on_offline = None
+        self.connected = False
+
+    def set_connection_callbacks(self, on_online, on_offline):
+        self.on_online = on_online
+        self.on_offline = on_offline
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.unsubscribe_all(self)
+        if(self.on_offline is not None):
+            self.on_offline()
+
+    def subscribe(self, topic, callback):
+        self.broker.subscribe(topic, self, callback)
+
+    def publish(self, topic, payload):
+        if(not self.connected):
+            return False
+        return self.broker.publish(topic, payload)
+
+    def create_shadow_handler(self, thing_name):
+        return TopicShadowHandler(self, thing_name)
+
+
+#Device shadow client over the AWS shadow topics (same calls and callbacks as the SDK's deviceShadow)
+class TopicShadowHandler():
+
+    def __init__(self, transport, thing_name):
+        self.transport = transport
+        self.thing_name = thing_name
+        self.lock = threading.Lock()
+        self.pending = {} #Client token -> (callback, timeout timer)
+        self.tokens = itertools.count()
+        self.delta_callback = None
+
+        for operation in ('update/accepted', 'update/rejected', 'get/accepted', 'get/rejected'):
+            self.transport.subscribe(get_shadow_topic(thing_name, operation), self.handle_response)
+
+    def shadowUpdate(self, payload, callback, timeout):
+        document = json.loads(payload)
+        return self.request('update', document, callback, timeout)
+
+    def shadowGet(self, callback, timeout):
+        return self.request('get', {}, callback, timeout)
+
+    def shadowRegisterDeltaCallback(self, callback):
+        self.delta_callback = callback
+        self.transport.subscribe(get_shadow_topic(self.thing_name, 'update/delta'), self.handle_delta)
+
+    #Publishes a shadow request, calling back with 'timeout' if nothing comes back in time
+    def request(self, operation, document, callback, timeout):
+        token = self.thing_name + '-' + str(next(self.tokens))
+        document['clientToken'] = token
+        timer = threading.Timer(timeout, self.expire, [token])
+        timer.daemon = True
+        with self.lock:
+            self.pending[token] = (callback, timer)
+        timer.start()
+        self.transport.publish(get_shadow_topic(self.thing_name, operation), json.dumps(document))
+        return token
+
+    def expire(self, token):
+        with self.lock:
+            pending = self.pending.pop(token, None)
+        if(pending is not None and pending[0] is not None):
+            pending[0](None, 'timeout', token)
+
+    def handle_response(self, client, userdata, message):
+        payload = message.payload.decode() if isinstance(message.payload, bytes) else message.payload
+        try:
+            token = json.loads(payload).get('clientToken')
+        except ValueError:
+            return
+        with self.lock:
+            pending = self.pending.pop(token, None)
+        if(pending is None):
+            return
+        pending[1].cancel()
+        if(pending[0] is not None):
+            pending[0](payload, message.topic.rsplit('/', 1)[1], token)
+
+    def handle_delta(self, client, userdata, message):
+        payload = message.payload.decode() if isinstance(message.payload, bytes) else message.payload
+        if(self.delta_callback is not None):
+            self.delta_callback(payload, 'delta/' + self.thing_name, None)
+
+
+#Minimal device shadow service for brokers without one (desired/reported state, versions and deltas; values are compared whole)
+class ShadowService():
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.documents = {} #Thing name -> {"desired": {}, "reported": {}, "version": n}
+        self.updates = 0
+        self.transport.connect()
+        self.transport.subscribe(get_shadow_topic('+', 'update'), self.handle_update)
+        self.transport.subscribe(get_shadow_topic('+', 'get'), self.handle_get)
+
+    def get_document(self, thing_name):
+        return self.documents.setdefault(thing_name, {"desired": {}, "reported": {}, "version": 0})
+
+    #Gets the desired values that differ from the reported ones
+    def get_delta(self, document):
+        return {key: value for key, value in document['desired'].items() if document['reported'].get(key) != value}
+
+    def handle_update(self, client, userdata, message):
+        thing_name = message.topic.split('/')[2]
+        try:
+            request = json.loads(message.payload)
+            state = request['state']
+        except (ValueError, KeyError, TypeError):
+            self.transport.publish(get_shadow_topic(thing_name, 'update/rejected'), json.dumps({"code": 400, "message": 'Bad update'}))
+            return
+
+        with self.lock:
+            self.updates += 1
+            document = self.get_document(thing_name)
+            for section in ('desired', 'reported'):
+                for key, value in (state.get(section) or {}).items():
+                    if(value is None):
+                        document[section].pop(key, None)
+                    else:
+                        document[section][key] = value
+            document['version'] += 1
+            version = document['version']
+            delta = self.get_delta(document) if 'desired' in state else {}
+
+        accepted = {"state": state, "version": version, "timestamp": int(time.time())}
+        if('clientToken' in request):
+            accepted['clientToken'] = request['clientToken']
+        self.transport.publish(get_shadow_topic(thing_name, 'update/accepted'), json.dumps(accepted))
+        if(len(delta) > 0):
+            self.transport.publish(get_shadow_topic(thing_name, 'update/delta'), json.dumps({"state": delta, "version": version, "timestamp": int(time.time())}))
+
+    def handle_get(self, client, userdata, message):
+        thing_name = message.topic.split('/')[2]
+        try:
+            request = json.loads(message.payload) if len(message.payload) > 0 else {}
+        except ValueError:
+            request = {}
+
+        with self.lock:
+            document = self.get_document(thing_name)
+            state = {"desired": dict(document['desired']), "reported": dict(document['reported'])}
+            delta = self.get_delta(document)
+            if(len(delta) > 0):
+                state['delta'] = delta
+            response = {"state": state, "version": document['version'], "timestamp": int(time.time())}
+        if('clientToken' in request):
+            response['clientToken'] = request['clientToken']
+        self.transport.publish(get_shadow_topic(thing_name, 'get/accepted'), json.dumps(response))
+
+
+#Creates the transport named by the 'mqtt' block of settings.json
+def create_transport(settings, broker=None):
+    name = settings.get('transport', 'aws')
+    if(name == 'aws'):
+        return AwsIotTransport(settings)
+    elif(name == 'local'):
+        return LocalBrokerTransport(settings)
+    elif(name == 'memory'):
+        return MemoryTransport(broker if broker is not None else MemoryBroker(settings.get('latency', 0.0)), settings.get('clientId', 'barbot'))
+    raise TransportUnavailable('Unknown MQTT transport: ' + str(name))
@@ -1,31 +1,144 @@
-from flask import request, url_for
+from flask import request, url_for, g, Response
 from flask_api import FlaskAPI, status, exceptions
 from main import Main
+from pourProcess import start_pour_process
 from iotBridge import IoTManager
+from profiler import RequestProfiler
+import metrics
+import logConfig
+import tracing
+import commandRecorder
+import telemetry
+import configWatcher
+import cloud
+import recipe
+import recipeImport
+import logging
 import threading
 import time
 import json
 import subprocess
+import io
 import requests
-import traceback
 import RPi.GPIO as GPIO
 import sys
 
 #sys.stdout = open('./logs/out.txt', 'w')
 #sys.stderr = open('./logs/err.txt', 'w')
 
+with open('settings.json', 'r') as settings_file:
+    settings = json.load(settings_file)
+
+#Fork the pour process while this is still the only thread (before the log listener, scheduler and pump threads start)
+pour_process = start_pour_process(settings.get('pourProcess', {}))
+
+#Start logging before anything else so startup messages go through the background log writer
+logConfig.setup_logging(settings.get('logging', {}))
+tracing.setup_tracing(settings.get('tracing', {}))
+commandRecorder.setup_recording(settings.get('recording', {}))
+cloud.setup_cloud(settings.get('cloud', {}))
+recipe.setup_cache(settings.get('recipeCache', {}))
+logger = logging.getLogger('network')
+
 app = FlaskAPI(__name__) #Create REST API object
-main = Main() #Starts the primary initalization of BarBot
-iot_manager = IoTManager(main) #Start AWS IoT Manage (TODO: Enable or disable this in settings)
+main = Main(pour_process) #Starts the primary initalization of BarBot
+cloud.breaker.set_scheduler(main.scheduler) #Probe the cloud in the background while it's unreachable
+iot_manager = IoTManager(main, settings.get('mqttDispatch', {}), settings.get('mqtt', {})) #Start AWS IoT Manage (TODO: Enable or disable this in settings)
+
+telemetry.setup_telemetry(settings.get('telemetry', {}), iot_manager.publish_telemetry, main.scheduler, iot_manager.is_online, lambda: {
+    "busy": main.busy_flag,
+    "mqttQueue": iot_manager.command_queue.qsize()
+})
+
+#Applies a settings.json edited on disk: the logging, cloud and recipeCache blocks take effect now, everything else needs a restart
+def apply_settings(data):
+    global settings
+    if(not isinstance(data, dict)):
+        raise ValueError('settings.json must hold an object')
+    for key in ('logging', 'cloud', 'recipeCache'):
+        if(not isinstance(data.get(key, {}), dict)):
+            raise ValueError(key + ' must be an object')
+    logging_settings = data.get('logging', {})
+    for level in [logging_settings.get('level', 'INFO')] + list(logging_settings.get('levels', {}).values()):
+        if(not isinstance(logging.getLevelName(str(level).upper()), int)):
+            raise ValueError('Unknown log level: ' + str(level))
+    main.apply_settings(data)
+
+    #Everything is valid, so apply it
+    if(logging_settings != settings.get('logging', {})):
+        logConfig.setup_logging(logging_settings)
+    if(data.get('cloud', {}) != settings.get('cloud', {})):
+        cloud.setup_cloud(data.get('cloud', {}))
+    if(data.get('recipeCache', {}) != settings.get('recipeCache', {})):
+        recipe.setup_cache(data.get('recipeCache', {}))
+    for key in ('tracing', 'recording', 'telemetry', 'mqtt', 'mqttDispatch', 'configWatch'):
+        if(data.get(key) != settings.get(key)):
+            logger.warning('%s changed in settings.json; restart BarBot to apply it', key)
+    settings = data
+
+#Hot reload the config files when they change on disk
+configWatcher.setup_config_watch(settings.get('configWatch', {}), {
+    'settings.json': apply_settings,
+    'pumpConfig.json': main.apply_pump_config,
+    'alcohol.json': main.apply_alcohol_list,
+    'ignoreList.json': main.apply_ignore_list
+}, main.scheduler)
+
+request_latency = metrics.histogram('barbot_http_request_seconds', 'REST API request latency by route', ['route', 'method', 'status'])
+profiler = RequestProfiler() #Armed on demand through /profile/start/
+
+#Starts timing every request and starts its trace (continuing the caller's trace if it sent a traceparent header)
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_time = time.time()
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    trace_id, parent_id = tracing.parse_traceparent(request.headers.get('traceparent'))
+    g.request_span = tracing.start_trace(request.method + ' ' + route, {'http.method': request.method, 'http.route': route, 'http.target': request.path}, trace_id, parent_id)
+    g.request_span.__enter__()
+
+    #Profile the handler (and the Main work it calls) if a profiling window is open, but never the profiler's own routes
+    if(not request.path.startswith('/profile/')):
+        g.profile_token = profiler.begin_request()
+
+#Records the latency of every request against its route
+@app.after_request
+def record_request_latency(response):
+    if('request_start' in g):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        duration = time.perf_counter() - g.request_start
+        request_latency.observe(duration, {'route': route, 'method': request.method, 'status': response.status_code})
+        commandRecorder.record_rest(g.request_time, request.method, request.full_path if request.query_string else request.path, route, request.get_json(silent=True), response.status_code, duration)
+    if('request_span' in g):
+        g.request_span.span.set_attribute('http.status_code', response.status_code)
+        response.headers['X-Trace-Id'] = g.request_span.span.trace_id
+    return response
+
+#Ends the trace of every request, even ones that raised
+@app.teardown_request
+def end_request_trace(error=None):
+    if('profile_token' in g):
+        profiler.end_request(g.pop('profile_token'))
+    if('request_span' in g):
+        if(error is not None):
+            g.request_span.__exit__(type(error), error, None)
+        else:
+            g.request_span.__exit__(None, None, None)
+        g.pop('request_span')
+
+#Exposes controller metrics in the Prometheus text format
+@app.route('/metrics', strict_slashes=False, methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 #Makes a specific cocktail
 @app.route('/cocktail/<string:name>/', strict_slashes=False, methods=['GET'])
 def call_make_cocktail(name):
     res = main.make_cocktail(name)
     if(res != 'true'):
-        print("Issues making cocktail: " + name + "\n" + "Response: " + str(res))
+        logger.warning('Issues making cocktail: %s Response: %s', name, res)
     else:
-        print('Made cocktail ' + name + '\n')
+        logger.info('Made cocktail %s', name)
     return res
 
 #Starts the clean function
@@ -38,7 +151,7 @@ def call_clean_pumps():
 @app.route('/ingredients/<string:cocktail>/', strict_slashes=False, methods=['GET'])
 def get_ingredients(cocktail):
     res = main.get_ingredients(cocktail)
-    print(res)
+    logger.debug('%s', res)
 
     return res
 
@@ -72,8 +185,7 @@ def add_bottle(bottle_name, pump_num, volume, original_volume):
         main.add_bottle(bottle_name, pump_num, volume, original_volume)
         return 'true'
     except Exception as e:
-        print("Failed adding bottle in app!")
-        traceback.print_exc()
+        logger.exception('Failed adding bottle in app!')
         return 'false'
 
 
@@ -98,7 +210,7 @@ def get_new_bottles():
 def get_all_bottles():
     all_bottles = list(main.new_bottles)
 
-    for bottle in main.pump_map.keys():
+    for bottle in main.bottles.keys():
         all_bottles.append(bottle)
 
     return all_bottles
@@ -127,9 +239,20 @@ def get_bottle_init_volume(bottle_name):
         return str(vol)
 
 #Gets the list of available cocktails
+#Optional: ?servings=true returns {"name", "servings"} objects, ?sort=name|servings (most first) and ?minServings=1 drops what can't be poured
 @app.route('/cocktailList/', strict_slashes=False, methods=['GET'])
 def get_cocktail_list():
-    available_cocktails = main.get_cocktail_list()
+    with_servings = request.args.get('servings', 'false') == 'true'
+    sort = request.args.get('sort')
+    if(sort not in (None, 'name', 'servings')):
+        return 'Unknown sort', status.HTTP_400_BAD_REQUEST
+    try:
+        min_servings = int(request.args['minServings']) if 'minServings' in request.args else None
+    except ValueError:
+        return 'minServings must be an integer', status.HTTP_400_BAD_REQUEST
+    cocktails = main.get_cocktail_list(with_servings, sort, min_servings)
+    #The shadow menu stays the plain list of every available cocktail whatever the request filtered
+    available_cocktails = main.get_cocktail_list() if with_servings or min_servings is not None else cocktails
 
     iot_obj = {
         'state': {
@@ -140,18 +263,42 @@ def get_cocktail_list():
     }
 
     #Update menu in device shadow
-    shadow_thread = threading.Thread(target=iot_manager.update_shadow, args=[iot_obj])
+    shadow_thread = threading.Thread(target=tracing.wrap(iot_manager.update_shadow), args=[iot_obj])
     shadow_thread.daemon = True
     shadow_thread.start()
     #iotManager.update_shadow(iotObj)
 
-    return available_cocktails
+    return cocktails
 
 #Adds a cocktail recipe to local cache and Dynamo
 @app.route('/addRecipe/', strict_slashes=False, methods=['POST'])
 def add_cocktail_recipe():
     return main.add_cocktail_recipe(request.json)
 
+#Imports recipes in bulk from a JSON Lines (default) or CSV request body (?format=csv)
+@app.route('/recipes/import/', strict_slashes=False, methods=['POST'])
+def import_recipes():
+    format = request.args.get('format', 'jsonl')
+    if(format not in recipeImport.FORMATS):
+        return 'Unknown format', status.HTTP_400_BAD_REQUEST
+    try:
+        workers = int(request.args.get('workers', 4))
+    except ValueError:
+        return 'workers must be an integer', status.HTTP_400_BAD_REQUEST
+    if(workers < 1 or workers > recipeImport.MAX_WORKERS):
+        return 'workers must be between 1 and ' + str(recipeImport.MAX_WORKERS), status.HTTP_400_BAD_REQUEST
+    rows = recipeImport.read_rows(io.TextIOWrapper(request.stream, encoding='utf-8', newline=''), format)
+    return main.import_recipes(rows, workers)
+
+#Streams every recipe in the cloud as JSON Lines (default) or CSV (?format=csv)
+@app.route('/recipes/export/', strict_slashes=False, methods=['GET'])
+def export_recipes():
+    format = request.args.get('format', 'jsonl')
+    if(format not in recipeImport.FORMATS):
+        return 'Unknown format', status.HTTP_400_BAD_REQUEST
+    mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    return Response(recipeImport.export_recipes(format), mimetype=mimetype, headers={'Content-Disposition': 'attachment; filename=recipes.' + format})
+
 #Disables or enables alcohol mode
 @app.route('/alcoholMode/', strict_slashes=False, methods=['POST'])
 def set_alcohol_mode():
@@ -168,6 +315,17 @@ def get_bottle_percent(name):
 def get_alcohol_mode():
     return json.dumps(main.alcohol_mode)
 
+#Aborts the cocktail being made and turns off every pump
+@app.route('/abort/', strict_slashes=False, methods=['GET'])
+def abort_pumps():
+    main.abort_pumps()
+    return 'true'
+
+#Gets the abort count, latency until all pins were off and the last refund
+@app.route('/abortStats/', strict_slashes=False, methods=['GET'])
+def get_abort_stats():
+    return main.get_abort_stats()
+
 #Turns on a specific pump number
 @app.route('/pumpOn/<int:num>/', strict_slashes=False, methods=['GET'])
 def pump_on(num):
@@ -182,6 +340,24 @@ def pump_off(num):
         main.pump_off(num)
     return "Pump off!\n"
 
+#Gets whether each pump and pressure pump is currently on
+@app.route('/pumpStates/', strict_slashes=False, methods=['GET'])
+def get_pump_states():
+    return {
+        'pumps': main.get_pump_states(),
+        'pressure': main.get_pressure_states()
+    }
+
+#Gets histograms of how far actual pump timing drifted from the requested pour times
+@app.route('/pourTiming/', strict_slashes=False, methods=['GET'])
+def get_pour_timing():
+    return main.pour_timing.get_stats()
+
+#Gets the most recent pump pin edges with their monotonic timestamps
+@app.route('/pourTiming/edges/', strict_slashes=False, methods=['GET'])
+def get_pour_edges():
+    return main.pour_timing.get_edges()
+
 #Turns on a particular air pressure pump (number is same as associated solenoid)
 @app.route('/pressureOn/<int:num>/', strict_slashes=False, methods=['GET'])
 def pressure_on(num):
@@ -205,7 +381,7 @@ def calibrate_pump(num, time):
 @app.route('/reverse/', strict_slashes=False, methods=['GET'])
 def reverse_polarity():
     polarity_normal = main.reverse_polarity()
-    print('polarityNormal: ' + str(polarity_normal))
+    logger.info('polarityNormal: %s', polarity_normal)
     return str(polarity_normal) + '\n'
 
 #Gets full volume object for an ingredient
@@ -214,18 +390,23 @@ def get_ingredient_volume(ingredient):
     vol = main.get_ingredient_volume(ingredient)
     return vol
 
-#Refreshes all local caches
+#Refreshes the local recipes from the cloud (and the menu)
 @app.route('/refreshRecipes/', strict_slashes=False, methods=['GET'])
 def refresh_recipes():
-    res = main.refresh_cocktail_files()
+    res = main.refresh('recipes')
     return res
 
+#Gets how far the last (or current) recipe refresh got
+@app.route('/refreshRecipes/progress/', strict_slashes=False, methods=['GET'])
+def get_refresh_progress():
+    return main.recipe_refresh
+
 #Adds or removes a specific ingredient from the "ignore list"
 @app.route('/ignoreIngredient/', strict_slashes=False, methods=['POST'])
 def ignore_ingredient():
     #param check
     if('action' not in request.json or 'ingredient' not in request.json):
-        print('Error ignoring ingredient')
+        logger.warning('Error ignoring ingredient')
         return 'false'
 
     action = request.json['action'] #Add or remove
@@ -239,7 +420,7 @@ def ignore_ingredient():
         main.remove_ignore_item(item)
     else:
         #Unknown action error
-        print('Error ignoring ingredient')
+        logger.warning('Error ignoring ingredient')
         return 'false'
     
     return 'true'
@@ -252,6 +433,91 @@ def get_ignore_ingredients():
 
     return res
 
+#Gets the log level of every module logger that has one set
+@app.route('/logLevel/', strict_slashes=False, methods=['GET'])
+def get_log_levels():
+    return logConfig.get_levels()
+
+#Sets the log level of a module logger at runtime (e.g. {"logger": "main", "level": "DEBUG"})
+@app.route('/logLevel/', strict_slashes=False, methods=['POST'])
+def set_log_level():
+    if('level' not in request.json):
+        return 'false'
+    try:
+        logConfig.set_level(request.json.get('logger', 'root'), request.json['level'])
+    except ValueError as e:
+        logger.warning('%s', e)
+        return 'false'
+    return 'true'
+
+#Profiles the next N requests and/or the next T seconds (e.g. {"mode": "cprofile", "requests": 10} or {"mode": "sampling", "seconds": 60})
+@app.route('/profile/start/', strict_slashes=False, methods=['POST'])
+def start_profile():
+    body = request.json if request.json is not None else {}
+    try:
+        profiler.start(body.get('mode', 'cprofile'), body.get('requests'), body.get('seconds'))
+    except (ValueError, TypeError) as e:
+        logger.warning('%s', e)
+        return 'false'
+    return profiler.status()
+
+#Closes the profiling window early
+@app.route('/profile/stop/', strict_slashes=False, methods=['GET'])
+def stop_profile():
+    profiler.stop()
+    return profiler.status()
+
+#Gets whether profiling is running and how much has been collected
+@app.route('/profile/status/', strict_slashes=False, methods=['GET'])
+def get_profile_status():
+    return profiler.status()
+
+#Downloads the aggregated profile (a pstats file for cprofile, folded stacks for sampling)
+@app.route('/profile/download/', strict_slashes=False, methods=['GET'])
+def download_profile():
+    file_name, data = profiler.get_result()
+    if(data is None):
+        return Response('No profile collected\n', status=404, mimetype='text/plain')
+    return Response(data, mimetype='application/octet-stream', headers={'Content-Disposition': 'attachment; filename=' + file_name})
+
+#Gets the top functions of the cprofile profile by cumulative time as text
+@app.route('/profile/summary/', strict_slashes=False, methods=['GET'])
+def get_profile_summary():
+    try:
+        limit = int(request.args.get('limit', 30))
+    except ValueError:
+        return 'limit must be an integer', status.HTTP_400_BAD_REQUEST
+    if(limit < 1):
+        return 'limit must be positive', status.HTTP_400_BAD_REQUEST
+    return Response(profiler.get_summary(limit), mimetype='text/plain')
+
+#Gets every job registered with the controller scheduler
+@app.route('/scheduler/', strict_slashes=False, methods=['GET'])
+def get_scheduler_jobs():
+    return main.scheduler.get_jobs()
+
+#Gets the state of the cloud circuit breaker
+@app.route('/cloud/', strict_slashes=False, methods=['GET'])
+def get_cloud_status():
+    return cloud.breaker.to_dict()
+
+#Gets the refresh pipeline: its sources, which are dirty and when each step last ran
+@app.route('/refresh/', strict_slashes=False, methods=['GET'])
+def get_refresh_status():
+    return main.refresh_pipeline.to_dict()
+
+#Rebuilds everything from the local files and the cloud (admin operation; normal changes only refresh what they affect)
+@app.route('/rebuild/', strict_slashes=False, methods=['POST'])
+def rebuild_all():
+    return main.rebuild_all()
+
+#Gets the result of the last hot reload of each config file
+@app.route('/config/', strict_slashes=False, methods=['GET'])
+def get_config_status():
+    if(configWatcher.watcher is None):
+        return {"enabled": False}
+    return configWatcher.watcher.to_dict()
+
 #Tells BarBot to fetch and install updates
 @app.route('/update/', strict_slashes=False, methods=['GET'])
 def update():
@@ -280,4 +546,11 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             GPIO.cleanup()
             break
-    print('Exitting...')
\ No newline at end of file
+    logger.info('Exitting...')
+    configWatcher.stop_config_watch()
+    telemetry.stop_telemetry()
+    iot_manager.stop_dispatch()
+    main.scheduler.stop()
+    tracing.stop_tracing()
+    commandRecorder.stop_recording()
+    logConfig.stop_logging()
\ No newline at end of file
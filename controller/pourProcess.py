@@ -0,0 +1,268 @@
+import multiprocessing
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Runs pump timing in a dedicated process so the API process (Flask, MQTT, boto3) can't delay pin edges.
+#Has the same interface as PumpWorkerPool, so Main can use either one.
+class PourProcess():
+
+    #Starts the pour process, optionally with real-time priority and pinned to a cpu
+    def __init__(self, priority=0, cpu=None, edge_listener=None):
+        #Forked, so it must be created before any other thread starts (see start_pour_process): a lock some thread held at the
+        #fork (logging, a scheduler Condition) would stay locked for good in the child. Spawn would re-import network.py and build a
+        #second Main in the child.
+        ctx = multiprocessing.get_context('fork')
+        self.conn, child_conn = ctx.Pipe()
+        self.send_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.pins = []
+        self.states = {} #Pin -> whether it is on, as reported by the pour process
+        self.off_events = {} #Pin -> event set while the pin is off
+        self.timelines = {} #Timeline id -> PourTimeline waiting on edges
+        self.next_id = 0
+        self.edge_listener = edge_listener #Called with (pin, on, monotonic time) for every reported edge
+
+        self.process = ctx.Process(target=run_pour_process, args=[child_conn, self.conn, priority, cpu], name='pour-process', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        reader_thread = threading.Thread(target=self.read_edges, name='pour-process-reader', daemon=True)
+        reader_thread.start()
+
+    #Sends a command to the pour process
+    def send(self, command):
+        with self.send_lock:
+            self.conn.send(command)
+
+    #Hands a pin over to the pour process
+    def add(self, pin, label):
+        if(pin in self.states):
+            return
+        with self.state_lock:
+            self.pins.append(pin)
+            self.states[pin] = False
+            self.off_events[pin] = threading.Event()
+            self.off_events[pin].set()
+        self.send(('add', pin))
+
+    #Turns a pin on, for a duration (seconds) if one is given
+    def on(self, pin, duration=None, timeline=None, entry=None):
+        if(timeline is not None):
+            timeline_id = self.register_timeline(timeline)
+            index = [i for i in range(0, len(timeline.entries)) if timeline.entries[i] is entry][0]
+            self.send(('timeline', timeline_id, [(pin, duration, index)]))
+        else:
+            self.send(('on', pin, duration))
+
+    #Turns a pin off
+    def off(self, pin):
+        self.send(('off', pin))
+
+    #Keeps track of a timeline until every one of its edges has been reported
+    def register_timeline(self, timeline):
+        with self.state_lock:
+            timeline_id = self.next_id
+            self.next_id += 1
+            self.timelines[timeline_id] = timeline
+        return timeline_id
+
+    #Sends a compiled pour timeline to the pour process in a single message
+    def run_timeline(self, timeline):
+        if(timeline.is_cancelled()):
+            for entry in timeline.entries:
+                timeline.mark_off(entry)
+            return
+
+        timeline_id = self.register_timeline(timeline)
+        compiled = []
+        for i in range(0, len(timeline.entries)):
+            compiled.append((timeline.entries[i]['pin'], timeline.entries[i]['duration'], i))
+        self.send(('timeline', timeline_id, compiled))
+
+    #Turns every pin off as soon as possible
+    def cancel_all(self):
+        with self.state_lock:
+            for pin in self.pins:
+                if(self.states[pin]):
+                    self.off_events[pin].clear()
+        self.send(('cancel',))
+
+    #Waits until every pin is reported off; returns False on timeout
+    def wait_all_off(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        for pin in self.pins:
+            remaining = None if end is None else max(0.0, end - time.monotonic())
+            if(not self.off_events[pin].wait(remaining)):
+                return False
+        return True
+
+    #Gets the current state of every pin without reading GPIO
+    def get_states(self):
+        with self.state_lock:
+            return self.states.copy()
+
+    #Gets every pin owned by the pour process
+    def get_pins(self):
+        return list(self.pins)
+
+    #Stops the pour process (turns all pins off first)
+    def stop(self):
+        try:
+            self.send(('stop',))
+        except (OSError, EOFError):
+            pass
+        self.process.join(2)
+
+    #Applies the edges reported back by the pour process
+    def read_edges(self):
+        while True:
+            try:
+                edges = self.conn.recv()
+            except (EOFError, OSError):
+                logger.error('Pour process exited!')
+                return
+
+            for timeline_id, index, pin, on, timestamp in edges:
+                with self.state_lock:
+                    self.states[pin] = on
+                    if(on):
+                        self.off_events[pin].clear()
+                    else:
+                        self.off_events[pin].set()
+                    timeline = self.timelines.get(timeline_id)
+
+                if(self.edge_listener is not None):
+                    self.edge_listener(pin, on, timestamp)
+
+                if(timeline is None):
+                    continue
+
+                entry = timeline.entries[index]
+                if(on):
+                    timeline.mark_on(entry, timestamp)
+                else:
+                    timeline.mark_off(entry, timestamp)
+                    if(timeline.done_event.is_set()):
+                        with self.state_lock:
+                            self.timelines.pop(timeline_id, None)
+
+
+#Gives the pour process real-time priority and cpu affinity when requested
+def set_realtime(priority, cpu):
+    if(cpu is not None):
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logger.warning('Could not pin pour process to cpu %s: %s', cpu, e)
+
+    if(priority > 0):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            logger.warning('Could not set real-time priority for pour process: %s', e)
+
+
+#Starts the pour process if the 'pourProcess' block of settings.json enables it (None otherwise).
+#Call it first thing, while the process still has a single thread; Main reports edges to it once it's built.
+def start_pour_process(settings):
+    if(settings is None or not settings.get('enabled', False)):
+        return None
+    return PourProcess(settings.get('priority', 0), settings.get('cpu', None))
+
+#Timing loop of the pour process; owns the pump pins and reports every edge with its monotonic time
+def run_pour_process(conn, parent_conn, priority, cpu):
+    import RPi.GPIO as GPIO
+    import logConfig
+
+    logConfig.setup_child_logging() #The API process's log listener thread isn't forked along
+    parent_conn.close() #Only the API process keeps its end, so the pipe closes if it exits
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+    set_realtime(priority, cpu)
+
+    active = {} #Pin -> [deadline, timeline id, entry index]
+    pins = []
+
+    #Switches a pin and queues the edge to report
+    def switch(pin, on, timeline_id, index, edges):
+        GPIO.output(pin, GPIO.LOW if on else GPIO.HIGH) #Relays are active low
+        edges.append((timeline_id, index, pin, on, time.monotonic()))
+
+    #Turns a pin off if it is on
+    def turn_off(pin, edges):
+        if(pin in active):
+            item = active.pop(pin)
+            switch(pin, False, item[1], item[2], edges)
+
+    #Turns a pin on, closing out whatever it was running before
+    def turn_on(pin, duration, timeline_id, index, edges):
+        if(pin in active):
+            #Pin stays on; only the command it belongs to changes
+            item = active.pop(pin)
+            edges.append((item[1], item[2], pin, False, time.monotonic()))
+            edges.append((timeline_id, index, pin, True, time.monotonic()))
+        else:
+            switch(pin, True, timeline_id, index, edges)
+
+        deadline = None if duration is None else edges[-1][4] + duration
+        active[pin] = [deadline, timeline_id, index]
+
+    running = True
+    while running:
+        edges = []
+
+        #Sleep until the next off edge or until a command arrives
+        timeout = None
+        for pin in active:
+            deadline = active[pin][0]
+            if(deadline is not None):
+                remaining = max(0.0, deadline - time.monotonic())
+                if(timeout is None or remaining < timeout):
+                    timeout = remaining
+
+        if(conn.poll(timeout)):
+            try:
+                command = conn.recv()
+            except EOFError:
+                command = ('stop',)
+
+            action = command[0]
+            if(action == 'timeline'):
+                for pin, duration, index in command[2]:
+                    turn_on(pin, duration, command[1], index, edges)
+            elif(action == 'on'):
+                turn_on(command[1], command[2], None, None, edges)
+            elif(action == 'off'):
+                turn_off(command[1], edges)
+            elif(action == 'cancel'):
+                for pin in list(active):
+                    turn_off(pin, edges)
+            elif(action == 'add'):
+                GPIO.setup(command[1], GPIO.OUT)
+                GPIO.output(command[1], GPIO.HIGH)
+                pins.append(command[1])
+            elif(action == 'stop'):
+                for pin in list(active):
+                    turn_off(pin, edges)
+                running = False
+
+        #Turn off every pin whose time is up
+        now = time.monotonic()
+        for pin in list(active):
+            deadline = active[pin][0]
+            if(deadline is not None and deadline <= now):
+                turn_off(pin, edges)
+
+        if(len(edges) > 0):
+            try:
+                conn.send(edges)
+            except (OSError, EOFError):
+                running = False
+
+    #Leave every pin off on the way out
+    for pin in pins:
+        GPIO.output(pin, GPIO.HIGH)
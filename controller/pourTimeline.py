@@ -0,0 +1,93 @@
+import threading
+import time
+
+#Holds the compiled pump schedule for one pour and records when each pin was actually on
+class PourTimeline():
+
+    #Initializes an empty timeline for the given cocktail
+    def __init__(self, cocktail_name):
+        self.cocktail_name = cocktail_name
+        self.entries = []
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self.lock = threading.Lock()
+        self.order_time = time.monotonic() #Monotonic time the order was received
+        self.start_time = 0.0 #Monotonic time the pour started
+        self.cancel_time = 0.0 #Monotonic time the pour was cancelled
+        self.pending = 0
+        self.refunded = False #Set once an abort has claimed the refund
+        self.refund_event = threading.Event() #Set once the refunded volumes have been saved
+
+    #Adds a pin that should be held on for a duration (seconds)
+    def add_entry(self, pin, duration, kind='pump', pump_num=None, ingredient=None, amount=0.0):
+        entry = {
+            "pin": pin,
+            "duration": duration,
+            "kind": kind, #'pump' or 'pressure'
+            "pumpNum": pump_num,
+            "ingredient": ingredient,
+            "amount": amount, #Shots requested (pump entries only)
+            "onTime": None,
+            "offTime": None
+        }
+        self.entries.append(entry)
+        return entry
+
+    #Gets the longest duration in the timeline
+    def get_total_time(self):
+        total = 0.0
+        for entry in self.entries:
+            if(entry['duration'] > total):
+                total = entry['duration']
+        return total
+
+    #Marks the start of the pour so entries can be tracked until they finish
+    def start(self):
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.pending = len(self.entries)
+            if(self.pending == 0):
+                self.done_event.set()
+
+    #Records the time a pin was switched on
+    def mark_on(self, entry, timestamp=None):
+        with self.lock:
+            if(entry['onTime'] is None):
+                entry['onTime'] = timestamp if timestamp is not None else time.monotonic()
+
+    #Records the time a pin was switched off (only the first off edge counts)
+    def mark_off(self, entry, timestamp=None):
+        with self.lock:
+            if(entry['offTime'] is not None):
+                return
+            entry['offTime'] = timestamp if timestamp is not None else time.monotonic()
+            self.pending -= 1
+            if(self.pending <= 0):
+                self.done_event.set()
+
+    #Cancels the pour; returns False if it had already been cancelled
+    def cancel(self):
+        with self.lock:
+            if(self.cancel_event.is_set()):
+                return False
+            self.cancel_time = time.monotonic()
+            self.cancel_event.set()
+            return True
+
+    #Whether the pour was cancelled before finishing
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    #Waits for every entry in the timeline to switch off
+    def wait(self, timeout=None):
+        return self.done_event.wait(timeout)
+
+    #Gets the number of seconds an entry's pin was actually on (optionally capped at end_time)
+    def get_on_time(self, entry, end_time=None):
+        with self.lock:
+            if(entry['onTime'] is None):
+                return 0.0
+            end = entry['offTime'] if entry['offTime'] is not None else time.monotonic()
+            if(end_time is not None and end_time < end):
+                end = end_time
+            return max(0.0, end - entry['onTime'])
@@ -0,0 +1,81 @@
+import threading
+import collections
+from metrics import Histogram
+
+#Bucket bounds in seconds for (actual - requested) on-time
+DURATION_ERROR_BUCKETS = [-0.5, -0.1, -0.05, -0.02, -0.01, -0.005, -0.002, -0.001, 0.0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5]
+#Bucket bounds in seconds for the delay between the order starting and a pin switching on
+START_SKEW_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0]
+#Bucket bounds in mL for the volume error caused by timing error
+VOLUME_ERROR_BUCKETS = [-5.0, -2.0, -1.0, -0.5, -0.2, -0.1, 0.0, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+#Collects every pin edge and how far actual pump timing drifts from what each pour requested
+class PourTimingStats():
+
+    def __init__(self, max_edges=500):
+        self.lock = threading.Lock()
+        self.edges = collections.deque(maxlen=max_edges) #Most recent edges as (pin, on, monotonic time)
+        self.pumps = {} #Pump label -> histograms
+
+    #Records a single pin edge (called by whatever owns the pins)
+    def record_edge(self, pin, on, timestamp):
+        self.edges.append((pin, on, timestamp))
+
+    #Gets (creating if needed) the histograms for a pump
+    def get_pump_stats(self, label):
+        with self.lock:
+            if(label not in self.pumps):
+                self.pumps[label] = {
+                    "durationError": Histogram(DURATION_ERROR_BUCKETS),
+                    "startSkew": Histogram(START_SKEW_BUCKETS),
+                    "volumeError": Histogram(VOLUME_ERROR_BUCKETS)
+                }
+            return self.pumps[label]
+
+    #Records the timing of every entry of a finished pour timeline
+    def record_timeline(self, timeline, shot_volume):
+        for entry in timeline.entries:
+            if(entry['onTime'] is None or entry['offTime'] is None):
+                continue
+
+            if(entry['kind'] == 'pump'):
+                label = str(entry['pumpNum'])
+            else:
+                label = 'pressure-' + str(entry['pumpNum'])
+            stats = self.get_pump_stats(label)
+
+            stats['startSkew'].observe(entry['onTime'] - timeline.order_time)
+
+            #Aborted pours are cut short on purpose, so only their start skew is meaningful
+            if(timeline.is_cancelled()):
+                continue
+
+            error = (entry['offTime'] - entry['onTime']) - entry['duration']
+            stats['durationError'].observe(error)
+
+            #Translate the timing error into mL using the pump's calibration for this pour
+            if(entry['kind'] == 'pump' and entry['duration'] > 0):
+                stats['volumeError'].observe(error * entry['amount'] * shot_volume / entry['duration'])
+
+    #Gets the histograms for every pump
+    def get_stats(self):
+        with self.lock:
+            labels = list(self.pumps.keys())
+
+        stats = {}
+        for label in labels:
+            stats[label] = {}
+            for name, histogram in self.pumps[label].items():
+                stats[label][name] = histogram.snapshot()
+        return stats
+
+    #Gets the most recent pin edges
+    def get_edges(self):
+        edges = []
+        for pin, on, timestamp in list(self.edges):
+            edges.append({
+                "pin": pin,
+                "on": on,
+                "time": timestamp
+            })
+        return edges
@@ -0,0 +1,181 @@
+import cProfile
+import pstats
+import marshal
+import threading
+import time
+import sys
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Profiles the REST handlers (and the Main work they call) for the next N requests or the next T seconds.
+#'cprofile' mode collects deterministic profiles; 'sampling' mode samples the stacks of the request threads.
+class RequestProfiler():
+
+    def __init__(self, sample_interval=0.005):
+        self.lock = threading.Lock()
+        self.sample_interval = sample_interval
+        self.active = False
+        self.mode = 'cprofile'
+        self.remaining = None #Requests left to profile (None for no limit)
+        self.deadline = None #Monotonic time the window ends (None for no limit)
+        self.started = 0.0
+        self.profiled = 0 #Requests profiled in the current window
+        self.in_flight = 0 #Profiled requests still running
+        self.stats = None #Merged pstats.Stats of every profiled request
+        self.samples = {} #Folded stack -> sample count
+        self.sampled_threads = set()
+        self.sampler_thread = None
+
+    #Starts a profiling window
+    def start(self, mode='cprofile', requests=None, seconds=None):
+        if(mode not in ('cprofile', 'sampling')):
+            raise ValueError('Unknown profiling mode: ' + str(mode))
+        if(requests is None and seconds is None):
+            requests = 1
+
+        with self.lock:
+            self.active = True
+            self.mode = mode
+            self.remaining = int(requests) if requests is not None else None
+            self.deadline = time.monotonic() + float(seconds) if seconds is not None else None
+            self.started = time.monotonic()
+            self.profiled = 0
+            self.in_flight = 0
+            self.stats = None
+            self.samples = {}
+            self.sampled_threads = set()
+
+        if(mode == 'sampling' and (self.sampler_thread is None or not self.sampler_thread.is_alive())):
+            self.sampler_thread = threading.Thread(target=self.sample_loop, name='profile-sampler', daemon=True)
+            self.sampler_thread.start()
+
+        logger.info('Profiling started', extra={'data': {'mode': mode, 'requests': requests, 'seconds': seconds}})
+
+    #Ends the profiling window early
+    def stop(self):
+        with self.lock:
+            self.active = False
+
+    #Whether the window has run out (lock must be held)
+    def expired(self):
+        if(self.deadline is not None and time.monotonic() >= self.deadline):
+            return True
+        return self.remaining is not None and self.remaining <= 0
+
+    #Called at the start of a request; returns a token for end_request, or None if it isn't profiled
+    def begin_request(self):
+        if(not self.active):
+            return None
+
+        with self.lock:
+            if(not self.active or self.expired()):
+                self.active = False
+                return None
+            if(self.remaining is not None):
+                self.remaining -= 1
+            self.profiled += 1
+            self.in_flight += 1
+            mode = self.mode
+
+        if(mode == 'sampling'):
+            ident = threading.get_ident()
+            with self.lock:
+                self.sampled_threads.add(ident)
+            return ('sampling', ident)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #Newer Pythons only allow one active cProfile at a time, so overlapping requests go unprofiled
+            with self.lock:
+                self.in_flight -= 1
+            return None
+        return ('cprofile', profile)
+
+    #Called at the end of a profiled request
+    def end_request(self, token):
+        if(token is None):
+            return
+
+        if(token[0] == 'cprofile'):
+            profile = token[1]
+            profile.disable()
+            with self.lock:
+                if(self.stats is None):
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+        else:
+            with self.lock:
+                self.sampled_threads.discard(token[1])
+
+        with self.lock:
+            self.in_flight -= 1
+            if(self.expired()):
+                self.active = False
+
+    #Samples the stacks of the threads serving profiled requests
+    def sample_loop(self):
+        while True:
+            with self.lock:
+                if(not self.active and self.in_flight <= 0):
+                    break
+                if(self.mode != 'sampling'):
+                    break
+                threads = set(self.sampled_threads)
+
+            if(len(threads) > 0):
+                frames = sys._current_frames()
+                for ident in threads:
+                    frame = frames.get(ident)
+                    if(frame is None):
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(code.co_filename.split('/')[-1] + ':' + code.co_name + ':' + str(frame.f_lineno))
+                        frame = frame.f_back
+                    folded = ';'.join(reversed(stack))
+                    with self.lock:
+                        self.samples[folded] = self.samples.get(folded, 0) + 1
+
+            time.sleep(self.sample_interval)
+
+    #Gets the current state of the profiler
+    def status(self):
+        with self.lock:
+            if(self.active and self.expired()):
+                self.active = False
+            return {
+                "active": self.active,
+                "mode": self.mode,
+                "profiled": self.profiled,
+                "inFlight": self.in_flight,
+                "remainingRequests": self.remaining,
+                "remainingSeconds": max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None,
+                "samples": sum(self.samples.values())
+            }
+
+    #Gets the aggregated profile as (file name, bytes): a pstats file for cprofile, folded stacks for sampling
+    def get_result(self):
+        with self.lock:
+            if(self.mode == 'sampling'):
+                lines = [stack + ' ' + str(count) for stack, count in self.samples.items()]
+                return 'barbot-profile.folded', ('\n'.join(lines) + '\n').encode()
+
+            if(self.stats is None):
+                return None, None
+            return 'barbot-profile.prof', marshal.dumps(self.stats.stats)
+
+    #Gets a readable summary of the top functions in the cprofile stats
+    def get_summary(self, limit=30):
+        with self.lock:
+            if(self.stats is None):
+                return ''
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            return out.getvalue()
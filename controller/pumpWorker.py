@@ -0,0 +1,170 @@
+import threading
+import queue
+import time
+
+#Long-lived thread that owns a single relay pin and runs the commands sent to its queue
+class PumpWorker(threading.Thread):
+
+    #Creates the worker for a pin; set_pin(pin, on) performs the actual output
+    def __init__(self, pin, label, set_pin, edge_listener=None):
+        super().__init__(name='pump-' + str(label), daemon=True)
+        self.pin = pin
+        self.label = label
+        self.set_pin = set_pin
+        self.edge_listener = edge_listener #Called with (pin, on, monotonic time) after every edge
+        self.commands = queue.Queue()
+        self.state = False #Whether the pin is currently on
+        self.off_event = threading.Event() #Set whenever the pin is off
+        self.off_event.set()
+        self.timeline = None #Timeline of the timed command being run
+        self.entry = None #Timeline entry of the timed command being run
+        self.deadline = None #Monotonic time the timed command ends
+
+    #Turns the pin on, for a duration (seconds) if one is given
+    def on(self, duration=None, timeline=None, entry=None):
+        self.commands.put(('on', duration, timeline, entry))
+
+    #Turns the pin off after any earlier commands
+    def off(self):
+        self.commands.put(('off',))
+
+    #Drops queued commands and turns the pin off as soon as possible
+    def cancel(self):
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            #Dropped timed commands still need to be closed out on their timeline
+            if(command[0] == 'on' and command[2] is not None):
+                command[2].mark_off(command[3])
+        self.off_event.clear()
+        self.commands.put(('cancel',))
+
+    #Stops the worker thread
+    def stop(self):
+        self.commands.put(('stop',))
+
+    #Waits until the pin is off
+    def wait_off(self, timeout=None):
+        return self.off_event.wait(timeout)
+
+    #Switches the pin and records the state
+    def switch(self, on):
+        self.set_pin(self.pin, on)
+        self.state = on
+        timestamp = time.monotonic()
+        if(on):
+            self.off_event.clear()
+        else:
+            self.off_event.set()
+        if(self.edge_listener is not None):
+            self.edge_listener(self.pin, on, timestamp)
+        return timestamp
+
+    #Closes out the timed command being run
+    def finish_entry(self, timestamp):
+        if(self.timeline is not None):
+            self.timeline.mark_off(self.entry, timestamp)
+        self.timeline = None
+        self.entry = None
+        self.deadline = None
+
+    #Main loop that waits for commands or for the current timed command to end
+    def run(self):
+        while True:
+            timeout = None
+            if(self.deadline is not None):
+                timeout = max(0.0, self.deadline - time.monotonic())
+
+            try:
+                command = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                #Timed command is done
+                self.finish_entry(self.switch(False))
+                continue
+
+            action = command[0]
+            if(action == 'on'):
+                duration, timeline, entry = command[1], command[2], command[3]
+                if(self.timeline is not None):
+                    self.finish_entry(time.monotonic())
+
+                #Don't start anything that belongs to a cancelled pour
+                if(timeline is not None and timeline.is_cancelled()):
+                    timeline.mark_off(entry)
+                    continue
+
+                timestamp = self.switch(True)
+                if(timeline is not None):
+                    timeline.mark_on(entry, timestamp)
+                    self.timeline = timeline
+                    self.entry = entry
+                if(duration is not None):
+                    self.deadline = timestamp + duration
+            elif(action == 'off' or action == 'cancel'):
+                self.finish_entry(self.switch(False))
+            elif(action == 'stop'):
+                self.finish_entry(self.switch(False))
+                break
+
+
+#Collection of pump workers keyed by pin
+class PumpWorkerPool():
+
+    def __init__(self, set_pin, edge_listener=None):
+        self.set_pin = set_pin
+        self.edge_listener = edge_listener
+        self.workers = {}
+
+    #Creates and starts the worker for a pin
+    def add(self, pin, label):
+        if(pin in self.workers):
+            return self.workers[pin]
+        worker = PumpWorker(pin, label, self.set_pin, self.edge_listener)
+        self.workers[pin] = worker
+        worker.start()
+        return worker
+
+    #Turns a pin on, for a duration (seconds) if one is given
+    def on(self, pin, duration=None, timeline=None, entry=None):
+        self.workers[pin].on(duration, timeline, entry)
+
+    #Turns a pin off
+    def off(self, pin):
+        self.workers[pin].off()
+
+    #Hands every entry of a pour timeline to the worker that owns its pin
+    def run_timeline(self, timeline):
+        for entry in timeline.entries:
+            self.on(entry['pin'], entry['duration'], timeline, entry)
+
+    #Cancels every worker's commands and turns all pins off
+    def cancel_all(self):
+        for pin in self.workers:
+            self.workers[pin].cancel()
+
+    #Waits until every pin is off; returns False on timeout
+    def wait_all_off(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        for pin in self.workers:
+            remaining = None if end is None else max(0.0, end - time.monotonic())
+            if(not self.workers[pin].wait_off(remaining)):
+                return False
+        return True
+
+    #Gets the current state of every pin without reading GPIO
+    def get_states(self):
+        states = {}
+        for pin in self.workers:
+            states[pin] = self.workers[pin].state
+        return states
+
+    #Gets every pin that has a worker
+    def get_pins(self):
+        return list(self.workers)
+
+    #Stops all workers
+    def stop(self):
+        for pin in self.workers:
+            self.workers[pin].stop()
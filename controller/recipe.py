@@ -1,10 +1,22 @@
-import boto3
+import cloud
+import copy
+import queue
+import threading
 import time
 import json
 import decimal
+import metrics
+import tracing
+import logging
+from ttlCache import TTLCache, MISSING
 
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-table = dynamodb.Table('BarBot-Recipe')
+TABLE_NAME = 'BarBot-Recipe'
+logger = logging.getLogger(__name__)
+
+dynamo_latency = metrics.histogram('barbot_dynamodb_call_seconds', 'Latency of DynamoDB calls', ['operation'])
+dynamo_errors = metrics.counter('barbot_dynamodb_errors_total', 'DynamoDB calls that raised an error', ['operation'])
+
+recipe_cache = TTLCache('recipe') #Single recipe reads by lowercase name (already converted from Decimals)
 
 #Uploads the provided recipe to dynamodb
 def upload_recipe(recipe):
@@ -17,19 +29,22 @@ def upload_recipe(recipe):
             'amounts': amount_item
         }
         
-        response = table.put_item(
-            Item={
-                'cocktailName': recipe['name'].lower(), #MUST BE LOWERCASE BECAUSE DYNAMO IS CASE SENSITIVE FOR KEYS
-                'ingredients': recipe['ingredients'],
-                'amounts': amount_item
-            }
-        )
+        with tracing.span('dynamodb.recipe_put_item'), metrics.Timer(dynamo_latency, {'operation': 'recipe_put_item'}, dynamo_errors):
+            response = cloud.call('recipe_put_item', cloud.get_table(TABLE_NAME).put_item,
+                Item={
+                    'cocktailName': recipe['name'].lower(), #MUST BE LOWERCASE BECAUSE DYNAMO IS CASE SENSITIVE FOR KEYS
+                    'ingredients': recipe['ingredients'],
+                    'amounts': amount_item
+                }
+            )
         
-        print('Successfully uploaded recipe: ' + recipe['name'])
+        recipe_cache.invalidate(recipe['name'].lower())
+        logger.info('Successfully uploaded recipe: %s', recipe['name'])
         return True
 
     except Exception as e:
-        print(e)
+        recipe_cache.invalidate(recipe['name'].lower()) #The write may still have gone through
+        logger.error('Error uploading recipe: %s', e)
         return False
 
 #Get the amounts for a recipe in Dynamo
@@ -40,47 +55,132 @@ def get_amounts(recipe):
     
     return data
 
-#Fetches a recipe from dynamo
+#Fetches a recipe from dynamo (through the recipe cache; gets {} if it doesn't exist or the cloud can't be reached)
 def get_recipe(recipe_name):
-    try:
-        response = table.get_item(
-            Key={
-                'cocktailName': recipe_name.lower() #MUST BE LOWERCASE
-            }
-        )
-    except Exception as e:
-        print(e)
-        return {}
-    else:
-        recipe = response['Item']
-        print('Successfully retrieved recipe from database')
-        return recipe
+    key = recipe_name.lower() #MUST BE LOWERCASE
+    found, recipe = recipe_cache.get(key)
+    if(found):
+        return {} if recipe is MISSING else copy.deepcopy(recipe)
 
-
-#Perform a table scan to return a list of all of the recipes
-def get_all_recipes():
-    new_cocktails = {}
+    version = recipe_cache.get_version(key) #Taken before the read, so an upload_recipe finishing meanwhile isn't overwritten by this read
     try:
-        response = table.scan()
-
-        for i in response['Items']:
-            cocktail_data = json.dumps(i, cls=DecimalEncoder)
-            new_cocktails[i['cocktailName']] = cocktail_data
-
-        while 'LastEvaluatedKey' in response:
-            response = table.scan(
-                ExclusiveStartKey=response['LastEvaluatedKey']
+        with tracing.span('dynamodb.recipe_get_item'), metrics.Timer(dynamo_latency, {'operation': 'recipe_get_item'}, dynamo_errors):
+            response = cloud.call('recipe_get_item', cloud.get_table(TABLE_NAME).get_item,
+                Key={
+                    'cocktailName': key
+                }
             )
-
-            for i in response['Items']:
-                cocktail_data = json.dumps(i, cls=DecimalEncoder)
-                new_cocktails[cocktail_data['cocktailName']] = cocktail_data
-
     except Exception as e:
-        print(e)
+        logger.error('Error getting recipe: %s', e)
         return {}
 
-    return new_cocktails
+    if('Item' not in response):
+        logger.debug('Recipe %s does not exist', key)
+        recipe_cache.put(key, MISSING, version)
+        return {}
+
+    recipe = from_dynamo(response['Item'])
+    recipe_cache.put(key, recipe, version)
+    logger.debug('Successfully retrieved recipe from database')
+    return copy.deepcopy(recipe)
+
+#Applies the optional 'recipeCache' block of settings.json
+def setup_cache(settings=None):
+    if(settings is None):
+        settings = {}
+    recipe_cache.configure(settings.get('maxSize', 128), settings.get('ttl', 300), settings.get('negativeTtl', 30))
+
+
+#Streams every recipe in the table, one scan page at a time (Decimals converted to numbers)
+def iter_recipes():
+    for page in scan_pages():
+        for item in page:
+            yield from_dynamo(item)
+
+#Scans the table (or one segment of a parallel scan), streaming its pages
+def scan_pages(segment=None, total_segments=None, stop_event=None):
+    response = None
+    while response is None or 'LastEvaluatedKey' in response:
+        if(stop_event is not None and stop_event.is_set()):
+            return
+        arguments = {}
+        if(total_segments is not None):
+            arguments['Segment'] = segment
+            arguments['TotalSegments'] = total_segments
+        if(response is not None):
+            arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        with tracing.span('dynamodb.recipe_scan', {'segment': segment} if segment is not None else None), metrics.Timer(dynamo_latency, {'operation': 'recipe_scan'}, dynamo_errors):
+            response = cloud.call('recipe_scan', cloud.get_table(TABLE_NAME).scan, **arguments)
+        yield response['Items']
+
+#Streams every recipe with a parallel segmented scan (one thread per segment), in whatever order the pages arrive.
+#progress(items, segments done, segments) is called after every page. Raises if any segment fails.
+def scan_recipes(segments=None, progress=None):
+    if(segments is None):
+        segments = cloud.settings.get('scanSegments', 4)
+    if(segments <= 1):
+        count = 0
+        for page in scan_pages():
+            for item in page:
+                yield from_dynamo(item)
+            count += len(page)
+            if(progress is not None):
+                progress(count, 0, 1)
+        if(progress is not None):
+            progress(count, 1, 1)
+        return
+
+    pages = queue.Queue(maxsize=segments * 2) #Bounded so a slow consumer holds the scan back instead of buffering the table
+    stop_event = threading.Event()
+
+    def scan_segment(segment):
+        try:
+            for page in scan_pages(segment, segments, stop_event):
+                pages.put(('page', page))
+            pages.put(('done', segment))
+        except Exception as e:
+            pages.put(('error', e))
+
+    threads = []
+    for segment in range(0, segments):
+        thread = threading.Thread(target=tracing.wrap(scan_segment), args=[segment], name='recipe-scan-' + str(segment), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    done = 0
+    count = 0
+    try:
+        while done < segments:
+            kind, value = pages.get()
+            if(kind == 'error'):
+                raise value
+            if(kind == 'done'):
+                done += 1
+            else:
+                for item in value:
+                    yield from_dynamo(item)
+                count += len(value)
+            if(progress is not None):
+                progress(count, done, segments)
+    finally:
+        #Let segments blocked on the full queue finish if the scan stopped early
+        stop_event.set()
+        for thread in threads:
+            while thread.is_alive():
+                try:
+                    pages.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+#Converts a DynamoDB item to plain json types (Decimals to int or float)
+def from_dynamo(value):
+    if(isinstance(value, dict)):
+        return {key: from_dynamo(v) for key, v in value.items()}
+    if(isinstance(value, list)):
+        return [from_dynamo(v) for v in value]
+    if(isinstance(value, decimal.Decimal)):
+        return float(value) if value % 1 > 0 else int(value)
+    return value
 
 
 # Helper class to convert a DynamoDB item to JSON.
@@ -0,0 +1,218 @@
+import csv
+import json
+import time
+import queue
+import decimal
+import threading
+import logging
+import cloud
+import metrics
+import recipe
+
+#Bulk recipe import and export.
+#Rows are read and validated as they stream in and written to DynamoDB in batches of up to 25 by several writer threads
+#(each writes its own segment of the rows), retrying unprocessed items with backoff. The caller refreshes the local catalog once at the end.
+#
+#JSON Lines: {"name": "mojito", "ingredients": ["white rum", "lime juice"], "amounts": [1.5, 0.5]} (amounts may also be {ingredient: amount})
+#CSV:        name,ingredients,amounts with the ingredients and amounts separated by ';' (e.g. mojito,white rum;lime juice,1.5;0.5)
+
+FORMATS = ('jsonl', 'csv')
+BATCH_LIMIT = 25 #Most items DynamoDB accepts in one BatchWriteItem
+MAX_ERRORS = 50 #Row errors kept in the report
+MAX_WORKERS = 8 #Most writer threads one import may start
+
+logger = logging.getLogger(__name__)
+
+import_rows = metrics.counter('barbot_recipe_import_rows_total', 'Bulk import rows by outcome', ['outcome'])
+batch_latency = metrics.histogram('barbot_recipe_batch_write_seconds', 'Latency of each BatchWriteItem call')
+
+#Gets the rows of a JSON Lines or CSV text stream as (line number, row) pairs
+def read_rows(stream, format):
+    if(format == 'jsonl'):
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if(line == ''):
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, ValueError('Bad json: ' + str(e))
+    elif(format == 'csv'):
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        raise ValueError('Unknown format: ' + str(format))
+
+#Lowercases a name and collapses its whitespace (keys are case sensitive in DynamoDB)
+def normalize_name(name):
+    if(not isinstance(name, str)):
+        raise ValueError('Names must be strings')
+    name = ' '.join(name.split()).lower()
+    if(name == ''):
+        raise ValueError('Empty name')
+    return name
+
+#Validates a row and gets it as a DynamoDB recipe item; raises ValueError if it isn't a valid recipe
+def normalize_row(row):
+    if(isinstance(row, Exception)):
+        raise row
+    if(not isinstance(row, dict)):
+        raise ValueError('Rows must be objects')
+
+    ingredients = row.get('ingredients')
+    amounts = row.get('amounts')
+    if(isinstance(ingredients, str)):
+        ingredients = [i for i in ingredients.split(';') if i.strip() != '']
+    if(isinstance(amounts, str)):
+        amounts = [a for a in amounts.split(';') if a.strip() != '']
+    if(isinstance(amounts, dict)):
+        if(ingredients is None):
+            ingredients = list(amounts.keys())
+        by_name = {normalize_name(key): value for key, value in amounts.items()}
+        amounts = [by_name.get(normalize_name(i)) for i in ingredients]
+
+    if(not isinstance(ingredients, list) or len(ingredients) == 0):
+        raise ValueError('No ingredients')
+    if(not isinstance(amounts, list) or len(amounts) != len(ingredients)):
+        raise ValueError('Ingredients and amounts don\'t match')
+
+    item_amounts = {}
+    item_ingredients = []
+    for i in range(0, len(ingredients)):
+        ingredient = normalize_name(ingredients[i])
+        try:
+            amount = decimal.Decimal(str(amounts[i]).strip())
+        except (decimal.InvalidOperation, TypeError):
+            raise ValueError('Bad amount for ' + ingredient + ': ' + str(amounts[i]))
+        if(not amount.is_finite() or amount <= 0):
+            raise ValueError('Bad amount for ' + ingredient + ': ' + str(amounts[i]))
+        if(ingredient in item_amounts):
+            raise ValueError('Duplicate ingredient: ' + ingredient)
+        item_ingredients.append(ingredient)
+        item_amounts[ingredient] = amount
+
+    return {
+        'cocktailName': normalize_name(row.get('name', row.get('cocktailName'))),
+        'ingredients': item_ingredients,
+        'amounts': item_amounts
+    }
+
+
+#Streams validated recipes into DynamoDB with batched writes on several writer threads
+class BulkImporter():
+
+    def __init__(self, workers=4, batch_size=BATCH_LIMIT, max_attempts=8, progress_interval=500):
+        self.workers = max(1, min(int(workers), MAX_WORKERS))
+        self.batch_size = min(batch_size, BATCH_LIMIT)
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval #Rows between progress log lines
+        self.lock = threading.Lock()
+        self.report = {"read": 0, "valid": 0, "invalid": 0, "written": 0, "failed": 0, "retries": 0, "seconds": 0.0, "errors": []}
+
+    #Imports (line number, row) pairs; gets the report
+    def run(self, rows):
+        start = time.monotonic()
+        segments = [queue.Queue(maxsize=self.batch_size * 4) for i in range(0, self.workers)]
+        threads = []
+        for i in range(0, self.workers):
+            thread = threading.Thread(target=self.writer, args=[segments[i]], name='recipe-import-' + str(i), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for number, row in rows:
+                self.report['read'] += 1
+                try:
+                    item = normalize_row(row)
+                except ValueError as e:
+                    self.add_error(number, str(e))
+                    continue
+                self.report['valid'] += 1
+                import_rows.inc(1, {'outcome': 'valid'})
+
+                #The same name always goes to the same writer, so later rows win
+                segments[hash(item['cocktailName']) % self.workers].put(item)
+                if(self.report['read'] % self.progress_interval == 0):
+                    logger.info('Recipe import: %d rows read, %d written', self.report['read'], self.report['written'])
+        finally:
+            for segment in segments:
+                segment.put(None)
+            for thread in threads:
+                thread.join()
+
+        self.report['seconds'] = time.monotonic() - start
+        logger.info('Recipe import done', extra={'data': {key: value for key, value in self.report.items() if key != 'errors'}})
+        return self.report
+
+    def add_error(self, number, error):
+        self.report['invalid'] += 1
+        import_rows.inc(1, {'outcome': 'invalid'})
+        if(len(self.report['errors']) < MAX_ERRORS):
+            self.report['errors'].append({"line": number, "error": error})
+
+    #Writes one segment of the rows in batches
+    def writer(self, segment):
+        batch = {}
+        while True:
+            item = segment.get()
+            if(item is not None):
+                batch[item['cocktailName']] = item #A batch can't hold the same key twice
+            if(len(batch) >= self.batch_size or (item is None and len(batch) > 0)):
+                self.write_batch(list(batch.values()))
+                batch = {}
+            if(item is None):
+                break
+
+    #Writes a batch, retrying whatever DynamoDB leaves unprocessed
+    def write_batch(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        attempt = 0
+        while len(requests) > 0:
+            attempt += 1
+            try:
+                with metrics.Timer(batch_latency):
+                    response = cloud.call('recipe_batch_write', cloud.get_resource().batch_write_item, RequestItems={recipe.TABLE_NAME: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(recipe.TABLE_NAME, [])
+            except cloud.CircuitOpen as e:
+                unprocessed = requests
+                attempt = self.max_attempts #No point waiting for the backoff
+            except Exception as e:
+                logger.warning('Error writing recipe batch: %s', e)
+                unprocessed = requests
+
+            with self.lock:
+                self.report['written'] += len(requests) - len(unprocessed)
+                if(len(unprocessed) > 0 and attempt < self.max_attempts):
+                    self.report['retries'] += 1
+            import_rows.inc(len(requests) - len(unprocessed), {'outcome': 'written'})
+
+            if(len(unprocessed) > 0 and attempt >= self.max_attempts):
+                with self.lock:
+                    self.report['failed'] += len(unprocessed)
+                import_rows.inc(len(unprocessed), {'outcome': 'failed'})
+                logger.error('Gave up writing %d recipes', len(unprocessed))
+                return
+            requests = unprocessed
+            if(len(requests) > 0):
+                time.sleep(min(2.0, 0.05 * (2 ** attempt)))
+
+
+#Streams every recipe in the cloud as JSON Lines or CSV text
+def export_recipes(format):
+    if(format not in FORMATS):
+        raise ValueError('Unknown format: ' + str(format))
+    if(format == 'csv'):
+        yield 'name,ingredients,amounts\r\n'
+
+    for item in recipe.iter_recipes():
+        ingredients = item.get('ingredients') or list(item['amounts'].keys())
+        amounts = [item['amounts'].get(i) for i in ingredients]
+        if(format == 'jsonl'):
+            yield json.dumps({"name": item['cocktailName'], "ingredients": ingredients, "amounts": amounts}) + '\n'
+        else:
+            yield csv_line([item['cocktailName'], ';'.join(ingredients), ';'.join(str(a) for a in amounts)])
+
+#Formats one CSV row
+def csv_line(values):
+    return ','.join('"' + v.replace('"', '""') + '"' if any(c in v for c in ',"\r\n') else v for v in values) + '\r\n'
@@ -0,0 +1,139 @@
+import threading
+import time
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+step_runs = metrics.counter('barbot_refresh_steps_total', 'Refresh pipeline steps run', ['step'])
+step_errors = metrics.counter('barbot_refresh_step_errors_total', 'Refresh pipeline steps that raised', ['step'])
+step_duration = metrics.histogram('barbot_refresh_step_seconds', 'Time taken by each refresh pipeline step', ['step'])
+
+#A step of the refresh pipeline: recomputes one piece of derived state from the sources (or earlier steps) it depends on
+class RefreshStep():
+
+    def __init__(self, name, depends_on, function):
+        self.name = name
+        self.depends_on = set(depends_on)
+        self.function = function
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+
+    #Gets the step details as a json friendly object
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "dependsOn": sorted(self.depends_on),
+            "runs": self.runs,
+            "errors": self.errors,
+            "lastRun": self.last_run,
+            "lastDuration": self.last_duration
+        }
+
+
+#Keeps derived state up to date with dirty tracking per data source.
+#A mutation marks the sources it changed and runs the pipeline, which runs (in the order they were added) only the steps depending on a
+#dirty source or on a step that already ran. If a step fails, the steps after it that don't depend on it still run (from the last good
+#state of the failed one), and the sources it depends on are kept as failed: they're only tried again when marked again, so a failed
+#cloud scan isn't retried by every unrelated mutation.
+class RefreshPipeline():
+
+    def __init__(self):
+        self.sources = set()
+        self.steps = []
+        self.dirty = set()
+        self.failed = set() #Sources whose steps failed on their last run
+        self.dirty_lock = threading.Lock()
+        self.run_lock = threading.RLock() #One run at a time; mutations can still mark sources while a run is in progress
+
+    def add_source(self, name):
+        self.sources.add(name)
+
+    #Adds a step depending on sources and/or steps added before it
+    def add_step(self, name, depends_on, function):
+        names = self.sources | set(step.name for step in self.steps)
+        unknown = set(depends_on) - names
+        if(len(unknown) > 0):
+            raise ValueError('Unknown refresh dependencies for ' + name + ': ' + ', '.join(sorted(unknown)))
+        self.steps.append(RefreshStep(name, depends_on, function))
+
+    #Marks sources as changed
+    def mark(self, *sources):
+        unknown = set(sources) - self.sources
+        if(len(unknown) > 0):
+            raise ValueError('Unknown refresh sources: ' + ', '.join(sorted(unknown)))
+        with self.dirty_lock:
+            self.dirty.update(sources)
+
+    def mark_all(self):
+        self.mark(*self.sources)
+
+    #Gets the sources a step or source depends on, directly or through earlier steps
+    def get_sources(self, name):
+        if(name in self.sources):
+            return set([name])
+        sources = set()
+        for step in self.steps:
+            if(step.name == name):
+                for dependency in step.depends_on:
+                    sources |= self.get_sources(dependency)
+        return sources
+
+    #Marks sources as changed and runs every step that depends on a dirty source; gets the names of the steps that ran
+    def run(self, *sources):
+        self.mark(*sources)
+        with self.run_lock:
+            with self.dirty_lock:
+                dirty = self.dirty
+                self.dirty = set()
+            if(len(dirty) == 0):
+                return []
+
+            changed = set(dirty)
+            ran = []
+            failed = set()
+            error = None
+            for step in self.steps:
+                if(len(step.depends_on & changed) == 0):
+                    continue
+                start = time.monotonic()
+                try:
+                    step.function()
+                except Exception as e:
+                    #Steps depending on this one don't see it as changed; the others carry on
+                    step.errors += 1
+                    step_errors.inc(1, {'step': step.name})
+                    failed |= self.get_sources(step.name) & dirty
+                    if(error is None):
+                        error = e
+                    continue
+                step.last_duration = time.monotonic() - start
+                step.last_run = time.time()
+                step.runs += 1
+                step_runs.inc(1, {'step': step.name})
+                step_duration.observe(step.last_duration, {'step': step.name})
+                changed.add(step.name)
+                ran.append(step.name)
+
+            with self.dirty_lock:
+                self.failed -= dirty
+                self.failed |= failed
+
+        logger.debug('Refreshed %s after changes to %s', ran, sorted(dirty))
+        if(error is not None):
+            raise error
+        return ran
+
+    #Gets the pipeline state as a json friendly object
+    def to_dict(self):
+        with self.dirty_lock:
+            dirty = sorted(self.dirty)
+            failed = sorted(self.failed)
+        return {
+            "sources": sorted(self.sources),
+            "dirty": dirty,
+            "failed": failed,
+            "steps": [step.to_dict() for step in self.steps]
+        }
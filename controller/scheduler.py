@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+job_duration = metrics.histogram('barbot_scheduler_job_seconds', 'Time taken by each scheduled job', ['job'])
+job_lateness = metrics.histogram('barbot_scheduler_lateness_seconds', 'How late each scheduled job started', ['job'], buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0])
+job_errors = metrics.counter('barbot_scheduler_job_errors_total', 'Scheduled jobs that raised', ['job'])
+
+#A periodic or one-shot job registered with the scheduler
+class Job():
+
+    def __init__(self, scheduler, name, function, interval=None, jitter=0.0):
+        self.scheduler = scheduler
+        self.name = name
+        self.function = function
+        self.interval = interval #None for one-shot jobs
+        self.jitter = jitter #Up to this many seconds are added to every run (spreads out jobs with the same interval)
+        self.due = 0.0 #Monotonic time of the next run
+        self.base_due = 0.0 #The same without jitter (periodic runs are counted from this, so jitter doesn't add up)
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+        self.cancelled = False
+
+    #Stops the job from running again
+    def cancel(self):
+        self.cancelled = True
+        self.scheduler.wake()
+
+    #Gets the job details as a json friendly object
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "dueIn": max(0.0, self.due - time.monotonic()),
+            "runs": self.runs,
+            "errors": self.errors,
+            "lastDuration": self.last_duration
+        }
+
+
+#Runs every periodic and one-shot housekeeping job of the controller on one thread.
+#Jobs are kept in a priority queue by their monotonic due time and the thread sleeps until the next one is due, so nothing polls.
+#Jobs should be short; anything that can block for long should hand off to its own worker.
+class Scheduler():
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queue = [] #Heap of (due, sequence, job)
+        self.sequence = itertools.count()
+        self.jobs = {} #Name -> job
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    #Runs a function every interval seconds (first run after first_delay, defaulting to one interval)
+    def every(self, interval, function, name=None, jitter=0.0, first_delay=None):
+        job = Job(self, name if name is not None else function.__name__, function, interval, jitter)
+        self.add(job, interval if first_delay is None else first_delay)
+        return job
+
+    #Runs a function once after delay seconds
+    def once(self, delay, function, name=None):
+        job = Job(self, name if name is not None else function.__name__, function)
+        self.add(job, delay)
+        return job
+
+    #Queues a job to run after delay seconds (replaces any job with the same name)
+    def add(self, job, delay):
+        with self.lock:
+            previous = self.jobs.get(job.name)
+            if(previous is not None):
+                previous.cancelled = True
+            self.jobs[job.name] = job
+            self.push(job, time.monotonic() + delay)
+            self.lock.notify()
+
+    #Puts a job on the heap (lock must be held)
+    def push(self, job, due):
+        job.base_due = due
+        if(job.jitter > 0):
+            due += random.uniform(0, job.jitter)
+        job.due = due
+        heapq.heappush(self.queue, (due, next(self.sequence), job))
+
+    #Wakes the scheduler thread so it rechecks the queue
+    def wake(self):
+        with self.lock:
+            self.lock.notify()
+
+    #Gets the job with this name (None if there isn't one)
+    def get_job(self, name):
+        with self.lock:
+            return self.jobs.get(name)
+
+    #Gets every job
+    def get_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job.to_dict() for job in jobs if not job.cancelled]
+
+    def run(self):
+        while True:
+            with self.lock:
+                #Drop cancelled jobs from the top and sleep until the next job is due
+                while self.running:
+                    while len(self.queue) > 0 and self.queue[0][2].cancelled:
+                        heapq.heappop(self.queue)
+                    if(len(self.queue) == 0):
+                        self.lock.wait()
+                        continue
+                    wait = self.queue[0][0] - time.monotonic()
+                    if(wait <= 0):
+                        break
+                    self.lock.wait(wait)
+
+                if(not self.running):
+                    return
+                due, sequence, job = heapq.heappop(self.queue)
+
+            self.run_job(job, due)
+
+            with self.lock:
+                if(job.cancelled):
+                    continue
+                if(job.interval is None):
+                    self.jobs.pop(job.name, None)
+                    continue
+
+                #Keep a fixed rate, but skip missed runs instead of bunching them up
+                next_due = job.base_due + job.interval
+                now = time.monotonic()
+                if(next_due < now):
+                    next_due = now + job.interval
+                self.push(job, next_due)
+
+    #Runs a single job, timing it and keeping the scheduler alive if it raises
+    def run_job(self, job, due):
+        start = time.monotonic()
+        job_lateness.observe(max(0.0, start - due), {'job': job.name})
+        try:
+            job.function()
+        except Exception as e:
+            job.errors += 1
+            job_errors.inc(1, {'job': job.name})
+            logger.exception('Scheduled job %s failed', job.name)
+        job.runs += 1
+        job.last_run = start
+        job.last_duration = time.monotonic() - start
+        job_duration.observe(job.last_duration, {'job': job.name})
+
+    #Stops the scheduler thread (jobs that haven't run yet are dropped)
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
@@ -0,0 +1,200 @@
+import json
+import zlib
+import os
+import time
+import itertools
+import threading
+import logging
+import metrics
+
+#Batched telemetry: pour events, volume changes and health snapshots are collected into batches and published
+#zlib-compressed on the telemetry topic once a batch is big or old enough. Batches that can't be sent are spooled
+#to disk (bounded) and sent once the connection is back.
+#Batch: {"v": 1, "b": batch id, "e": [{"k": kind, "t": unix time, ...event fields}]}
+
+logger = logging.getLogger(__name__)
+
+events_total = metrics.counter('barbot_telemetry_events_total', 'Telemetry events recorded by kind', ['kind'])
+batches_total = metrics.counter('barbot_telemetry_batches_total', 'Telemetry batches by outcome', ['outcome'])
+batch_bytes = metrics.histogram('barbot_telemetry_batch_bytes', 'Compressed size of each telemetry batch', buckets=[256, 512, 1024, 2048, 4096, 8192, 16384, 65536])
+spool_bytes = metrics.gauge('barbot_telemetry_spool_bytes', 'Telemetry bytes waiting on disk to be sent')
+
+batcher = None #Active TelemetryBatcher (None while telemetry is off)
+
+#Collects events into batches and publishes them (or spools them while offline)
+class TelemetryBatcher():
+
+    def __init__(self, publish, scheduler, settings=None, is_online=None):
+        if(settings is None):
+            settings = {}
+        self.publish = publish #publish(topic, payload bytes); raises or returns False on failure
+        self.scheduler = scheduler
+        self.is_online = is_online if is_online is not None else (lambda: True)
+        self.topic = settings.get('topic', 'barbot-telemetry')
+        self.max_bytes = settings.get('maxBatchBytes', 8192) #Uncompressed size that triggers a send
+        self.max_age = settings.get('maxBatchAge', 30) #Seconds the oldest event may wait
+        self.spool_path = settings.get('spoolPath', './telemetry')
+        self.max_spool_bytes = settings.get('maxSpoolBytes', 5*1024*1024)
+
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock() #Keeps batches (and the spool) going out in order
+        self.events = []
+        self.size = 0
+        self.sequence = itertools.count()
+
+        if(not os.path.exists(self.spool_path)):
+            os.makedirs(self.spool_path)
+        spool_bytes.set(self.get_spool_size())
+
+    #Adds an event to the current batch
+    def record(self, kind, data):
+        event = {"k": kind, "t": round(time.time(), 3)}
+        event.update(data)
+        size = len(json.dumps(event, separators=(',', ':'), default=str))
+        events_total.inc(1, {'kind': kind})
+
+        with self.lock:
+            first = len(self.events) == 0
+            self.events.append(event)
+            self.size += size
+            full = self.size >= self.max_bytes
+
+        #Sends happen on the scheduler thread so recording never blocks a pour
+        if(full):
+            self.scheduler.once(0, self.flush, 'telemetry.flush')
+        elif(first):
+            self.scheduler.once(self.max_age, self.flush, 'telemetry.flush')
+
+    #Sends the current batch and anything spooled
+    def flush(self):
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.size = 0
+
+        with self.send_lock:
+            #Older spooled batches go first so the dashboard sees events in order
+            self.drain_spool()
+            if(len(events) > 0):
+                payload = self.encode(events)
+                batch_bytes.observe(len(payload))
+                if(self.send(payload)):
+                    batches_total.inc(1, {'outcome': 'sent'})
+                else:
+                    self.spool(payload)
+
+    #Compresses a batch
+    def encode(self, events):
+        batch = {
+            "v": 1,
+            "b": str(int(time.time() * 1000)) + '-' + str(next(self.sequence)),
+            "e": events
+        }
+        return zlib.compress(json.dumps(batch, separators=(',', ':'), default=str).encode(), 9)
+
+    #Publishes a payload; gets False if it couldn't be sent
+    def send(self, payload):
+        if(not self.is_online()):
+            return False
+        try:
+            return self.publish(self.topic, payload) != False
+        except Exception as e:
+            logger.warning('Error publishing telemetry: %s', e)
+            return False
+
+    #Writes a batch to the spool directory, dropping the oldest batches to stay under the size limit
+    def spool(self, payload):
+        name = os.path.join(self.spool_path, '%015d-%d.z' % (int(time.time() * 1000), next(self.sequence)))
+        with open(name + '.tmp', 'wb') as file:
+            file.write(payload)
+        os.replace(name + '.tmp', name)
+        batches_total.inc(1, {'outcome': 'spooled'})
+
+        files = self.get_spool_files()
+        total = sum(os.path.getsize(f) for f in files)
+        while total > self.max_spool_bytes and len(files) > 1:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            batches_total.inc(1, {'outcome': 'dropped'})
+            logger.warning('Telemetry spool full, dropped %s', os.path.basename(oldest))
+        spool_bytes.set(total)
+
+    #Sends spooled batches, oldest first, stopping at the first failure
+    def drain_spool(self):
+        files = self.get_spool_files()
+        if(len(files) == 0 or not self.is_online()):
+            return
+        for path in files:
+            with open(path, 'rb') as file:
+                payload = file.read()
+            if(not self.send(payload)):
+                break
+            os.remove(path)
+            batches_total.inc(1, {'outcome': 'sent'})
+        spool_bytes.set(self.get_spool_size())
+
+    #Gets the spooled batch files, oldest first
+    def get_spool_files(self):
+        return sorted(os.path.join(self.spool_path, f) for f in os.listdir(self.spool_path) if f.endswith('.z'))
+
+    def get_spool_size(self):
+        return sum(os.path.getsize(f) for f in self.get_spool_files())
+
+
+#Gets a health snapshot of the Pi (load, memory and SoC temperature where available)
+def get_health():
+    health = {}
+    try:
+        with open('/proc/loadavg', 'r') as file:
+            health['load'] = float(file.read().split()[0])
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if(line.startswith('MemAvailable:')):
+                    health['memFreeKb'] = int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as file:
+            health['tempC'] = int(file.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        pass
+    return health
+
+#Records a telemetry event (does nothing while telemetry is off)
+def record(kind, data):
+    if(batcher is not None):
+        batcher.record(kind, data)
+
+#Starts telemetry; settings is the optional 'telemetry' block of settings.json, health_function adds controller state to health events
+def setup_telemetry(settings, publish, scheduler, is_online=None, health_function=None):
+    global batcher
+    if(settings is None or not settings.get('enabled', False)):
+        batcher = None
+        return None
+
+    batcher = TelemetryBatcher(publish, scheduler, settings, is_online)
+
+    def record_health():
+        health = get_health()
+        if(health_function is not None):
+            health.update(health_function())
+        record('health', health)
+
+    scheduler.every(settings.get('healthInterval', 60), record_health, 'telemetry.health', jitter=1.0)
+    return batcher
+
+#Sends the current batch and anything spooled as soon as possible (e.g. when the connection comes back)
+def flush_soon():
+    if(batcher is not None):
+        batcher.scheduler.once(0, batcher.flush, 'telemetry.flush')
+
+#Sends whatever is batched (or spools it) before shutting down
+def stop_telemetry():
+    global batcher
+    if(batcher is not None):
+        batcher.flush()
+        batcher = None
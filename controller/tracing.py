@@ -0,0 +1,230 @@
+import contextvars
+import functools
+import random
+import time
+import json
+import os
+import logging
+import logging.handlers
+import queue
+import logConfig
+
+#Span-based tracing. Spans are written one per line as OpenTelemetry JSON to a rotating local file.
+
+current_span = contextvars.ContextVar('current_span', default=None)
+trace_logger = logging.getLogger('barbot.trace')
+trace_logger.propagate = False #Spans only go to the trace file, never to stdout
+listener = None
+enabled = False
+
+#A single timed operation within a trace
+class Span():
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes if attributes is not None else {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    #Adds an attribute to the span
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    #Ends the span and writes it out
+    def end(self, end_ns=None):
+        if(self.end_ns is not None):
+            return
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+        export(self)
+
+    #Gets the span as an OpenTelemetry JSON span
+    def to_dict(self):
+        attributes = []
+        for key in self.attributes:
+            attributes.append({"key": key, "value": otel_value(self.attributes[key])})
+
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": attributes,
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 1}
+        }
+        if(self.parent_id is not None):
+            data['parentSpanId'] = self.parent_id
+        return data
+
+
+#Context manager that makes a span the current one while it runs
+class SpanScope():
+
+    def __init__(self, name, attributes=None, parent=None, trace_id=None, parent_id=None):
+        if(parent is None and trace_id is None):
+            parent = current_span.get()
+
+        if(parent is not None):
+            trace_id = parent.trace_id
+            parent_id = parent.span_id
+        elif(trace_id is None):
+            trace_id = new_trace_id()
+
+        self.span = Span(name, trace_id, parent_id, attributes)
+        self.token = None
+
+    def __enter__(self):
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if(exc_type is not None):
+            self.span.error = exc_type.__name__ + ': ' + str(exc_value)
+        self.span.end()
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            #Ended from a different context than it started in (e.g. a Flask teardown)
+            current_span.set(None)
+        return False
+
+
+#Starts a child of the current span (or a new trace if there is none)
+def span(name, attributes=None, parent=None):
+    return SpanScope(name, attributes, parent)
+
+#Starts a new trace, continuing the given trace id/parent span id if the caller sent one
+def start_trace(name, attributes=None, trace_id=None, parent_id=None):
+    if(trace_id is None):
+        return SpanScope(name, attributes, trace_id=new_trace_id())
+    return SpanScope(name, attributes, trace_id=trace_id, parent_id=parent_id)
+
+#Decorator that runs a function inside a span (or just runs it while tracing is disabled, without allocating or timing a span)
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if(not enabled):
+                return function(*args, **kwargs)
+            with SpanScope(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#Wraps a function so it runs in a copy of the caller's context (keeps the current span when handed to a thread)
+def wrap(function):
+    context = contextvars.copy_context()
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.run(function, *args, **kwargs)
+    return wrapper
+
+#Records a span that already happened (e.g. a pin edge pair reported by the pump scheduler)
+def record_span(name, start_ns, end_ns, parent=None, attributes=None):
+    if(parent is None):
+        parent = current_span.get()
+    if(parent is None):
+        return None
+    recorded = Span(name, parent.trace_id, parent.span_id, attributes)
+    recorded.start_ns = start_ns
+    recorded.end(end_ns)
+    return recorded
+
+#Converts a time.monotonic() timestamp to unix nanoseconds
+def monotonic_to_unix_ns(timestamp):
+    return time.time_ns() - int((time.monotonic() - timestamp) * 1e9)
+
+#Gets the current span (None outside of a trace)
+def get_current_span():
+    return current_span.get()
+
+#Gets the trace id of the current span (None outside of a trace)
+def get_trace_id():
+    active = current_span.get()
+    return active.trace_id if active is not None else None
+
+#Parses a W3C traceparent header into (trace id, parent span id)
+def parse_traceparent(header):
+    if(header is None):
+        return None, None
+    parts = header.split('-')
+    if(len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16):
+        return None, None
+    return parts[1], parts[2]
+
+#Creates a new random trace id
+def new_trace_id():
+    return '%032x' % random.getrandbits(128)
+
+#Converts an attribute value to an OpenTelemetry AnyValue
+def otel_value(value):
+    if(isinstance(value, bool)):
+        return {"boolValue": value}
+    if(isinstance(value, int)):
+        return {"intValue": str(value)}
+    if(isinstance(value, float)):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+#Writes a finished span to the trace file (formatting happens on the trace listener thread)
+def export(finished_span):
+    if(enabled):
+        trace_logger.info('', extra={'span': finished_span})
+
+
+#Formats the span attached to a log record as a JSON line
+class SpanFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.span.to_dict())
+
+
+#Stamps log records with the trace id of the calling thread
+def add_trace_id(record):
+    record.traceId = get_trace_id()
+    return True
+
+#Sets up the rotating trace file; settings is the optional 'tracing' block of settings.json
+def setup_tracing(settings=None):
+    global listener, enabled
+    if(settings is None):
+        settings = {}
+
+    if(listener is not None):
+        listener.stop()
+        listener = None
+
+    enabled = settings.get('enabled', False)
+    if(not enabled):
+        return
+
+    path = settings.get('path', './logs/trace.jsonl')
+    directory = os.path.dirname(path)
+    if(directory != '' and not os.path.exists(directory)):
+        os.makedirs(directory)
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=settings.get('maxBytes', 5*1024*1024), backupCount=settings.get('backupCount', 3))
+    file_handler.setFormatter(SpanFormatter())
+
+    trace_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(trace_queue, file_handler)
+    listener.start()
+
+    for handler in list(trace_logger.handlers):
+        trace_logger.removeHandler(handler)
+    trace_logger.addHandler(logConfig.DeferredQueueHandler(trace_queue))
+    trace_logger.setLevel(logging.INFO)
+
+    #Include the trace id in controller logs so they can be matched with spans (kept when the logging settings are reloaded)
+    logConfig.add_record_filter(add_trace_id)
+
+#Flushes and stops the trace writer
+def stop_tracing():
+    global listener
+    if(listener is not None):
+        listener.stop()
+        listener = None
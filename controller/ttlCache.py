@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+import metrics
+
+cache_requests = metrics.counter('barbot_cache_requests_total', 'Cache lookups by cache and result (hit, negativeHit, miss)', ['cache', 'result'])
+cache_size = metrics.gauge('barbot_cache_entries', 'Entries held by each cache', ['cache'])
+
+MISSING = object() #Cached marker for keys known not to exist
+MAX_GENERATIONS = 1024 #Invalidated keys tracked before every generation is forgotten at once (bumping the epoch)
+
+#Least recently used cache whose entries expire after a time to live.
+#Keys known not to exist can be cached too (for a shorter time) so repeated lookups of a bad name don't go to the cloud.
+class TTLCache():
+
+    def __init__(self, name, max_size=128, ttl=300.0, negative_ttl=30.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() #Key -> (expiry monotonic time, value or MISSING), oldest use first
+        self.generations = {} #Key -> times it was invalidated (so a read that started before an invalidate can't cache what it read)
+        self.epoch = 0 #Times the whole cache was cleared
+        cache_size.set(0, {'cache': name})
+
+    #Gets (True, value) for a cached key (value is MISSING for a cached miss) or (False, None)
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if(entry is not None and entry[0] <= now):
+                del self.entries[key]
+                entry = None
+            if(entry is None):
+                result = 'miss'
+            else:
+                self.entries.move_to_end(key)
+                result = 'negativeHit' if entry[1] is MISSING else 'hit'
+        cache_requests.inc(1, {'cache': self.name, 'result': result})
+        if(entry is None):
+            return False, None
+        return True, entry[1]
+
+    #Gets the version of a key to pass to put; take it before reading the value from its source
+    def get_version(self, key):
+        with self.lock:
+            return self.epoch, self.generations.get(key, 0)
+
+    #Caches a value (MISSING caches that the key doesn't exist); with a version from get_version, nothing is cached if the key
+    #was invalidated since (the value read may be older than the write that invalidated it)
+    def put(self, key, value, version=None):
+        ttl = self.negative_ttl if value is MISSING else self.ttl
+        if(ttl <= 0 or self.max_size <= 0):
+            return
+        with self.lock:
+            if(version is not None and version != (self.epoch, self.generations.get(key, 0))):
+                return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            size = len(self.entries)
+        cache_size.set(size, {'cache': self.name})
+
+    #Drops a key (e.g. after it was written)
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+            if(len(self.generations) > MAX_GENERATIONS):
+                #Keeps the dict bounded; a new epoch still stops every read in flight from being cached
+                self.generations.clear()
+                self.epoch += 1
+            size = len(self.entries)
+        cache_size.set(size, {'cache': self.name})
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+            self.epoch += 1
+        cache_size.set(0, {'cache': self.name})
+
+    #Changes the limits (drops every entry)
+    def configure(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clear()